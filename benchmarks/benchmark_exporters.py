@@ -0,0 +1,326 @@
+# Copyright (C) 2021 TIND.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+"""
+This script measures the throughput of the record and file exporters offline, against
+the local stand-in server of mock_contentdm_server.py. Each benchmark runs in its own
+process and reports records/s, pages/s, MB/s and the peak RSS of that process.
+
+Change the settings below to shape the synthetic collection, and the settings of the
+exporters themselves (NUM_WORKERS, CHUNK_SIZE, ...) to compare their performance.
+"""
+
+import contextlib
+import json
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from urllib.request import urlopen
+import mock_contentdm_server
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'contentdm_exporter'))
+
+# Settings
+
+# Benchmarks to run, in order. 'files' downloads the files of the records exported by
+# 'records', so it needs it to run first. 'async_records' and 'async_files' do the same
+# with the asyncio engine of contentdm_async_exporter.py (requires aiohttp), in their own
+# folder.
+BENCHMARKS = ('records', 'files')
+
+# The synthetic collection. See mock_contentdm_server.py.
+NUM_RECORDS = 1000
+LATENCY = 0.005
+ERROR_RATE = 0.0
+FILE_SIZES = (256 * 1024,)
+COMPOUND_RATIO = 0.3
+COMPOUND_DEPTH = 2
+PAGES_PER_NODE = 3
+
+# Settings of contentdm_client.py used during the benchmarks. The request rate governor
+# is disabled to measure the exporters rather than the governor, and the backoff is
+# shortened so that runs with ERROR_RATE do not spend their time sleeping.
+CLIENT_SETTINGS = {
+    'MAX_REQUESTS_PER_SECOND': 0,
+    'BACKOFF_BASE': 0.01,
+    'BACKOFF_MAX': 0.1,
+}
+
+# Folder of the exported records and files. None uses a temporary folder, removed at
+# the end.
+BENCHMARK_FOLDER = None
+
+# Append the results as a JSON line to this file, to compare runs over time. None
+# disables it.
+RESULTS_FILE = None
+
+# Hide the progress printed by the exporters.
+QUIET = True
+
+ALIAS = 'test'
+MEGABYTE = 1000 * 1000
+
+
+def get_peak_rss():
+    """
+    Return the peak resident set size of the current process in bytes, or None if it
+    can not be measured on this platform.
+    """
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes.
+    if sys.platform != 'darwin':
+        peak_rss *= 1024
+    return peak_rss
+
+
+def configure_client():
+    import contentdm_client
+    for name, value in CLIENT_SETTINGS.items():
+        setattr(contentdm_client, name, value)
+
+
+def benchmark_records(main_url, folder):
+    """
+    Export the records with run_batch() and return the measurements.
+    """
+    import contentdm_record_exporter
+    configure_client()
+    contentdm_record_exporter.MAIN_URL = main_url
+    contentdm_record_exporter.configure(ALIAS, folder)
+    contentdm_record_exporter.EXPORT_PAGE_METADATA = True
+    Path(contentdm_record_exporter.MIG_OUTPUT_FOLDER).mkdir(parents=True, exist_ok=True)
+
+    with open(os.devnull, 'w') as devnull, \
+            contextlib.redirect_stdout(devnull if QUIET else sys.stdout):
+        start = time.perf_counter()
+        total_recs, num_chunks = contentdm_record_exporter.run_preliminary_query()
+        contentdm_record_exporter.run_batch(total_recs,
+                                            num_chunks,
+                                            contentdm_record_exporter.START_AT)
+        seconds = time.perf_counter() - start
+
+    return get_record_results(seconds, contentdm_record_exporter.MIG_OUTPUT_FOLDER)
+
+
+def benchmark_async_records(main_url, folder):
+    """
+    Export the records with the asyncio engine and return the measurements.
+    """
+    import asyncio
+    import contentdm_async_exporter
+    import contentdm_record_exporter
+    configure_client()
+    contentdm_record_exporter.MAIN_URL = main_url
+    contentdm_record_exporter.configure(ALIAS, folder + 'async/')
+    contentdm_record_exporter.EXPORT_PAGE_METADATA = True
+    Path(contentdm_record_exporter.MIG_OUTPUT_FOLDER).mkdir(parents=True, exist_ok=True)
+    contentdm_async_exporter.EXPORT_RECORDS = True
+    contentdm_async_exporter.EXPORT_FILES = False
+
+    with open(os.devnull, 'w') as devnull, \
+            contextlib.redirect_stdout(devnull if QUIET else sys.stdout):
+        start = time.perf_counter()
+        asyncio.run(contentdm_async_exporter.run_export())
+        seconds = time.perf_counter() - start
+
+    return get_record_results(seconds, contentdm_record_exporter.MIG_OUTPUT_FOLDER)
+
+
+def get_record_results(seconds, output_folder):
+    from contentdm_xml import iter_records_from_file
+    num_records = 0
+    num_pages = 0
+    for file_path in Path(output_folder).glob('*.xml'):
+        for record in iter_records_from_file(file_path):
+            num_records += 1
+            num_pages += len(record.findall('.//page'))
+
+    return {'seconds': seconds,
+            'records': num_records,
+            'pages': num_pages,
+            'peak_rss': get_peak_rss()}
+
+
+def benchmark_files(file_url, folder):
+    """
+    Download the files of the exported records and return the measurements.
+    """
+    import contentdm_file_exporter
+    configure_client()
+    contentdm_file_exporter.FILE_URL = file_url
+    contentdm_file_exporter.configure(ALIAS, folder)
+
+    with open(os.devnull, 'w') as devnull, \
+            contextlib.redirect_stdout(devnull if QUIET else sys.stdout):
+        start = time.perf_counter()
+        contentdm_file_exporter.run_file_export()
+        seconds = time.perf_counter() - start
+
+    return get_file_results(seconds, contentdm_file_exporter.MIG_OUTPUT_FOLDER)
+
+
+def benchmark_async_files(file_url, folder):
+    """
+    Download the files of the records exported by the asyncio engine, with the asyncio
+    engine, and return the measurements.
+    """
+    import asyncio
+    import contentdm_async_exporter
+    import contentdm_file_exporter
+    configure_client()
+    contentdm_file_exporter.FILE_URL = file_url
+    contentdm_file_exporter.configure(ALIAS, folder + 'async/')
+    contentdm_async_exporter.EXPORT_RECORDS = False
+    contentdm_async_exporter.EXPORT_FILES = True
+
+    with open(os.devnull, 'w') as devnull, \
+            contextlib.redirect_stdout(devnull if QUIET else sys.stdout):
+        start = time.perf_counter()
+        asyncio.run(contentdm_async_exporter.run_export())
+        seconds = time.perf_counter() - start
+
+    return get_file_results(seconds, contentdm_file_exporter.MIG_OUTPUT_FOLDER)
+
+
+def get_file_results(seconds, output_folder):
+    num_files = 0
+    num_bytes = 0
+    for file_path in Path(output_folder).rglob('*'):
+        # The download manifest is not a downloaded file.
+        if file_path.is_file() and '.sqlite' not in file_path.name:
+            num_files += 1
+            num_bytes += file_path.stat().st_size
+
+    return {'seconds': seconds,
+            'files': num_files,
+            'bytes': num_bytes,
+            'peak_rss': get_peak_rss()}
+
+
+def get_server_stats(server_url):
+    with urlopen(server_url + 'stats') as response:
+        return json.loads(response.read())
+
+
+def format_results(name, results):
+    seconds = results['seconds']
+    lines = ['{}: {:.2f} s'.format(name, seconds)]
+    if 'records' in results:
+        lines.append('  {} records, {:.1f} records/s'.format(results['records'],
+                                                             results['records'] / seconds))
+        lines.append('  {} pages, {:.1f} pages/s'.format(results['pages'],
+                                                         results['pages'] / seconds))
+    if 'files' in results:
+        lines.append('  {} files, {:.1f} files/s'.format(results['files'],
+                                                         results['files'] / seconds))
+        lines.append('  {:.1f} MB, {:.1f} MB/s'.format(results['bytes'] / MEGABYTE,
+                                                       results['bytes'] / MEGABYTE / seconds))
+    if results['peak_rss'] is not None:
+        lines.append('  peak RSS {:.1f} MB'.format(results['peak_rss'] / MEGABYTE))
+    lines.append('  {} requests ({} errors), {:.1f} MB served'.format(
+        sum(results['server']['requests'].values()),
+        results['server']['errors'],
+        results['server']['bytes'] / MEGABYTE))
+    return '\n'.join(lines)
+
+
+def run_benchmarks():
+    benchmarks = {'records': benchmark_records,
+                  'files': benchmark_files,
+                  'async_records': benchmark_async_records,
+                  'async_files': benchmark_async_files}
+
+    folder = BENCHMARK_FOLDER or tempfile.mkdtemp(prefix='contentdm_benchmark_')
+    if not folder.endswith('/'):
+        folder += '/'
+
+    # The server and the benchmarks run in their own processes, so they do not compete
+    # for the GIL and the peak RSS is the one of the benchmark alone.
+    context = multiprocessing.get_context('spawn')
+    port_queue = context.Queue()
+    server = context.Process(target=mock_contentdm_server.serve,
+                             args=(port_queue,),
+                             kwargs={'port': 0,
+                                     'num_records': NUM_RECORDS,
+                                     'latency': LATENCY,
+                                     'error_rate': ERROR_RATE,
+                                     'file_sizes': FILE_SIZES,
+                                     'compound_ratio': COMPOUND_RATIO,
+                                     'compound_depth': COMPOUND_DEPTH,
+                                     'pages_per_node': PAGES_PER_NODE},
+                             daemon=True)
+    server.start()
+    server_url = 'http://{}:{}/'.format(mock_contentdm_server.HOST, port_queue.get())
+    urls = {'records': server_url + 'dmwebservices/index.php?q=',
+            'files': server_url + 'utils/getfile/collection/'}
+    urls['async_records'] = urls['records']
+    urls['async_files'] = urls['files']
+
+    all_results = {}
+    try:
+        for name in BENCHMARKS:
+            server_stats = get_server_stats(server_url)
+            with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+                results = executor.submit(benchmarks[name], urls[name], folder).result()
+
+            # Only count what was served during this benchmark.
+            new_stats = get_server_stats(server_url)
+            results['server'] = {
+                'requests': {endpoint: count - server_stats['requests'].get(endpoint, 0)
+                             for endpoint, count in new_stats['requests'].items()
+                             if endpoint != 'stats'
+                             and count != server_stats['requests'].get(endpoint, 0)},
+                'errors': new_stats['errors'] - server_stats['errors'],
+                'bytes': new_stats['bytes'] - server_stats['bytes']}
+            all_results[name] = results
+            print(format_results(name, results))
+    finally:
+        server.terminate()
+        if not BENCHMARK_FOLDER:
+            shutil.rmtree(folder, ignore_errors=True)
+
+    if RESULTS_FILE:
+        settings = {'num_records': NUM_RECORDS,
+                    'latency': LATENCY,
+                    'error_rate': ERROR_RATE,
+                    'file_sizes': FILE_SIZES,
+                    'compound_ratio': COMPOUND_RATIO,
+                    'compound_depth': COMPOUND_DEPTH,
+                    'pages_per_node': PAGES_PER_NODE}
+        with open(RESULTS_FILE, 'a') as f:
+            f.write(json.dumps({'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                                'settings': settings,
+                                'results': all_results}) + '\n')
+
+    return all_results
+
+
+if __name__ == '__main__':
+    run_benchmarks()
@@ -0,0 +1,344 @@
+# Copyright (C) 2021 TIND.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+"""
+Local stand-in for a CONTENTdm server, serving synthetic collections for the benchmarks.
+It answers dmQuery, dmGetItemInfo, dmGetCompoundObjectInfo, dmGetCollectionList and
+utils/getfile, with a configurable latency, error rate, file sizes and compound object
+depth. GET /stats returns the number of requests, errors and bytes served as JSON.
+
+Record n of the collection has the pointer n * stride, and the pages of a compound
+object the pointers right after it. Everything is generated from the pointer, so the
+server keeps no state besides its counters.
+"""
+
+import json
+import random
+import threading
+import time
+from http.server import (BaseHTTPRequestHandler,
+                         ThreadingHTTPServer)
+from urllib.parse import (unquote,
+                          urlparse)
+from xml.sax.saxutils import escape
+
+# Settings
+
+# Address to listen on when the server is run on its own.
+HOST = '127.0.0.1'
+PORT = 8765
+
+# Number of records in every collection.
+NUM_RECORDS = 1000
+
+# Seconds added to every response.
+LATENCY = 0.005
+
+# Fraction of the requests answered with a 503, to exercise the retries.
+ERROR_RATE = 0.0
+
+# Size in bytes of the files; a record or page uses FILE_SIZES[pointer % len(FILE_SIZES)].
+FILE_SIZES = (256 * 1024,)
+
+# Fraction of the records which are compound objects.
+COMPOUND_RATIO = 0.3
+
+# Levels of the compound objects. 1 puts all the pages directly in the object, 2 adds a
+# node with pages inside it, and so on.
+COMPOUND_DEPTH = 2
+
+# Number of pages on each level of a compound object.
+PAGES_PER_NODE = 3
+
+# Block the file contents are made of, after a header unique to each file.
+_FILE_BLOCK = bytes(random.Random(0).getrandbits(8) for i in range(64 * 1024))
+_FILE_HEADER_SIZE = 16
+
+_XML_DECLARATION = '<?xml version="1.0" encoding="UTF-8"?>\n'
+
+
+class MockContentdmServer(ThreadingHTTPServer):
+
+    daemon_threads = True
+
+    def __init__(self,
+                 address,
+                 num_records=NUM_RECORDS,
+                 latency=LATENCY,
+                 error_rate=ERROR_RATE,
+                 file_sizes=FILE_SIZES,
+                 compound_ratio=COMPOUND_RATIO,
+                 compound_depth=COMPOUND_DEPTH,
+                 pages_per_node=PAGES_PER_NODE):
+        super().__init__(address, MockContentdmHandler)
+        self.num_records = num_records
+        self.latency = latency
+        self.error_rate = error_rate
+        self.file_sizes = file_sizes
+        self.compound_ratio = compound_ratio
+        self.compound_depth = compound_depth
+        self.pages_per_node = pages_per_node
+        self.stride = compound_depth * pages_per_node + 1
+        self.stats = {'requests': {}, 'errors': 0, 'bytes': 0}
+        self._stats_lock = threading.Lock()
+
+    @property
+    def main_url(self):
+        return 'http://{}:{}/dmwebservices/index.php?q='.format(*self.server_address)
+
+    @property
+    def file_url(self):
+        return 'http://{}:{}/utils/getfile/collection/'.format(*self.server_address)
+
+    def count(self, endpoint, num_bytes=0, error=False):
+        with self._stats_lock:
+            requests = self.stats['requests']
+            requests[endpoint] = requests.get(endpoint, 0) + 1
+            self.stats['bytes'] += num_bytes
+            if error:
+                self.stats['errors'] += 1
+
+    def is_compound(self, n):
+        # Spread the compound objects evenly over the collection.
+        return (n * 0.6180339887) % 1 < self.compound_ratio
+
+    def get_item(self, pointer):
+        """
+        Return (record number, page number) of a pointer, the page number being 0 for
+        the record itself. Return None if there is no such item.
+        """
+        n, page = divmod(pointer, self.stride)
+        if not 1 <= n <= self.num_records:
+            return None
+        if page and not self.is_compound(n):
+            return None
+        return n, page
+
+    def get_file_size(self, pointer):
+        return self.file_sizes[pointer % len(self.file_sizes)]
+
+
+class MockContentdmHandler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+    # The headers and the body are written separately; without this, keep-alive
+    # connections stall on delayed ACKs.
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def send(self, endpoint, body, content_type='text/xml', status=200, headers=None):
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+        self.server.count(endpoint, len(body), error=status >= 500)
+
+    def do_HEAD(self):
+        self.do_GET()
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path == '/stats':
+            with self.server._stats_lock:
+                body = json.dumps(self.server.stats)
+            return self.send('stats', body, 'application/json')
+
+        if url.path.startswith('/utils/getfile/'):
+            endpoint = 'getfile'
+            args = url.path.split('/')[4:]
+        else:
+            args = unquote(url.query)[2:].split('/')
+            endpoint = args.pop(0)
+
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        if self.server.error_rate and random.random() < self.server.error_rate:
+            return self.send(endpoint, '', status=503)
+
+        handler = getattr(self, 'handle_' + endpoint, None)
+        if handler is None:
+            return self.send(endpoint, 'Unknown function', status=404)
+        return handler(args)
+
+    def handle_dmGetCollectionList(self, args):
+        collections = [{'alias': '/test', 'name': 'Test', 'path': '/test'}]
+        self.send('dmGetCollectionList', json.dumps(collections), 'application/json')
+
+    def handle_dmQuery(self, args):
+        # alias/searchstrings/fields/sortby/maxrecs/start/suppress/docptr/suggest/facets/format
+        alias, maxrecs, start = args[0], int(args[4]), int(args[5])
+        records = []
+        for n in range(start, min(self.server.num_records, start + maxrecs - 1) + 1):
+            pointer = n * self.server.stride
+            filetype = 'cpd' if self.server.is_compound(n) else 'jp2'
+            records.append({'collection': '/' + alias,
+                            'pointer': pointer,
+                            'filetype': filetype,
+                            'parentobject': -1,
+                            'dmrecord': str(pointer),
+                            'dmcreated': '2021-01-01',
+                            'dmmodified': '2021-01-01',
+                            'find': '{}.{}'.format(pointer, filetype)})
+        results = {'pager': {'start': str(start),
+                             'maxrecs': str(maxrecs),
+                             'total': self.server.num_records},
+                   'records': records}
+        self.send('dmQuery', json.dumps(results), 'application/json')
+
+    def handle_dmGetItemInfo(self, args):
+        alias, pointer, format = args[0], int(args[1]), args[2]
+        item = self.server.get_item(pointer)
+        if item is None:
+            return self.send_not_found('dmGetItemInfo', format)
+
+        n, page = item
+        if page:
+            title = 'Record {} page {}'.format(n, page)
+            find = '{}.jp2'.format(pointer)
+        else:
+            title = 'Record {}'.format(n)
+            find = '{}.{}'.format(pointer, 'cpd' if self.server.is_compound(n) else 'jp2')
+        fields = [('title', title),
+                  ('subjec', 'Subject {}'.format(n % 20)),
+                  ('descri', 'Synthetic record served by the benchmark server. ' * 4),
+                  ('date', '2021'),
+                  ('rights', ''),
+                  ('dmrecord', str(pointer)),
+                  ('dmcreated', '2021-01-01'),
+                  ('dmmodified', '2021-01-01'),
+                  ('find', find)]
+
+        if format == 'json':
+            # Empty fields come as empty objects in the JSON of CONTENTdm.
+            body = json.dumps({name: value or {} for name, value in fields})
+            return self.send('dmGetItemInfo', body, 'application/json')
+        body = _XML_DECLARATION + '<xml>{}</xml>'.format(''.join(
+            '<{0}>{1}</{0}>'.format(name, escape(value)) for name, value in fields))
+        self.send('dmGetItemInfo', body)
+
+    def handle_dmGetCompoundObjectInfo(self, args):
+        alias, pointer, format = args[0], int(args[1]), args[2]
+        item = self.server.get_item(pointer)
+        if item is None or item[1] or not self.server.is_compound(item[0]):
+            if format == 'json':
+                body = json.dumps({'code': '-2', 'message': 'Requested item is not compound'})
+                return self.send('dmGetCompoundObjectInfo', body, 'application/json')
+            body = (_XML_DECLARATION + '<xml><code>-2</code>'
+                    '<message>Requested item is not compound</message></xml>')
+            return self.send('dmGetCompoundObjectInfo', body)
+
+        # Build the levels from the deepest one up.
+        page_ptr = pointer + self.server.stride - 1
+        node = ''
+        for level in range(self.server.compound_depth, 0, -1):
+            pages = []
+            for i in range(self.server.pages_per_node):
+                pages.append('<page><pagetitle>Page {0}</pagetitle><pagefile>{0}.jp2</pagefile>'
+                             '<pageptr>{0}</pageptr></page>'.format(page_ptr))
+                page_ptr -= 1
+            node = ''.join(reversed(pages)) + node
+            if level > 1:
+                node = '<node><nodetitle>Level {}</nodetitle>{}</node>'.format(level, node)
+        body = _XML_DECLARATION + '<cpd><type>Document</type>{}</cpd>'.format(node)
+        if format == 'json':
+            # The benchmarks only use the XML; keep the JSON minimal.
+            body = json.dumps({'type': 'Document'})
+            return self.send('dmGetCompoundObjectInfo', body, 'application/json')
+        self.send('dmGetCompoundObjectInfo', body)
+
+    def handle_getfile(self, args):
+        # alias/id/pointer/filename/name
+        pointer = int(args[2])
+        if self.server.get_item(pointer) is None:
+            return self.send('getfile', 'Requested item not found', 'text/html', status=404)
+
+        size = self.server.get_file_size(pointer)
+        start = 0
+        status = 200
+        headers = {'Accept-Ranges': 'bytes', 'ETag': '"{}-{}"'.format(pointer, size)}
+        range_header = self.headers.get('Range')
+        if range_header and range_header.startswith('bytes='):
+            start = int(range_header[6:].split('-')[0])
+            if start >= size:
+                headers['Content-Range'] = 'bytes */{}'.format(size)
+                return self.send('getfile', '', status=416, headers=headers)
+            status = 206
+            headers['Content-Range'] = 'bytes {}-{}/{}'.format(start, size - 1, size)
+
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(size - start))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        if self.command != 'HEAD':
+            for block in iter_file_content(pointer, size, start):
+                self.wfile.write(block)
+        self.server.count('getfile', size - start if self.command != 'HEAD' else 0)
+
+    def send_not_found(self, endpoint, format):
+        if format == 'json':
+            body = json.dumps({'code': '-2', 'message': 'Requested item not found'})
+            return self.send(endpoint, body, 'application/json')
+        body = _XML_DECLARATION + '<xml><code>-2</code><message>Requested item not found</message></xml>'
+        self.send(endpoint, body)
+
+
+def iter_file_content(pointer, size, start=0):
+    """
+    Yield the bytes start to size of the synthetic file of a pointer, in blocks.
+    """
+    header = '{:0{}d}'.format(pointer, _FILE_HEADER_SIZE).encode('ascii')
+    position = start
+    if position < _FILE_HEADER_SIZE:
+        yield header[position:min(size, _FILE_HEADER_SIZE)]
+        position = _FILE_HEADER_SIZE
+    while position < size:
+        offset = (position - _FILE_HEADER_SIZE) % len(_FILE_BLOCK)
+        block = _FILE_BLOCK[offset:offset + size - position]
+        yield block
+        position += len(block)
+
+
+def serve(port_queue=None, host=HOST, port=PORT, **settings):
+    """
+    Run the server until the process is stopped. The port is put in port_queue once the
+    server listens, which is useful with port 0.
+    """
+    server = MockContentdmServer((host, port), **settings)
+    if port_queue is not None:
+        port_queue.put(server.server_address[1])
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    server = MockContentdmServer((HOST, PORT))
+    print('MAIN_URL = {!r}'.format(server.main_url))
+    print('FILE_URL = {!r}'.format(server.file_url))
+    server.serve_forever()
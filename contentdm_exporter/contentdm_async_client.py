@@ -0,0 +1,189 @@
+# Copyright (C) 2021 TIND.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+asyncio counterpart of contentdm_client.py, built on aiohttp. All the requests share one
+event loop instead of holding a thread each, so hundreds of them can be in flight from a
+single process. The timeouts, retries, backoff, request rate governor and cache set in
+contentdm_client.py apply.
+"""
+
+import asyncio
+import contextlib
+import time
+from concurrent.futures import ThreadPoolExecutor
+try:
+    import aiohttp
+except ImportError:
+    # aiohttp is only needed by the asyncio engine.
+    aiohttp = None
+import contentdm_client
+from contentdm_client import (CacheMissError,
+                              ContentdmRequestError,
+                              RETRY_STATUS_CODES,
+                              backoff_delay,
+                              get_cache,
+                              get_cache_key,
+                              get_endpoint,
+                              get_rate_limiter)
+from contentdm_metrics import (increment,
+                               observe)
+
+# Settings
+
+# Maximum number of API calls (dmQuery, dmGetItemInfo, dmGetCompoundObjectInfo) in flight.
+MAX_API_REQUESTS = 100
+
+# Maximum number of files downloaded at the same time.
+MAX_FILE_TRANSFERS = 16
+
+# Number of threads parsing the responses and writing to disk, so the event loop is
+# never blocked.
+NUM_PARSE_WORKERS = 4
+
+
+class AsyncClient(object):
+    """
+    aiohttp session shared by all the requests of an export. Semaphores limit the API
+    calls and the file transfers in flight, and a small executor runs the work which
+    would block the event loop. Use it as an async context manager:
+
+        async with AsyncClient() as client:
+            body = await client.get_api_content(url)
+    """
+
+    def __init__(self):
+        if aiohttp is None:
+            raise ImportError('The asyncio engine requires aiohttp: pip install -r '
+                              'requirements-async.txt')
+        self.rate_limiter = get_rate_limiter()
+        self.executor = None
+        self._session = None
+        self._api_semaphore = None
+        self._file_semaphore = None
+
+    async def __aenter__(self):
+        self._api_semaphore = asyncio.Semaphore(MAX_API_REQUESTS)
+        self._file_semaphore = asyncio.Semaphore(MAX_FILE_TRANSFERS)
+        self.executor = ThreadPoolExecutor(max_workers=NUM_PARSE_WORKERS)
+        # The semaphores limit the requests, not the connection pool.
+        connector = aiohttp.TCPConnector(limit=MAX_API_REQUESTS + MAX_FILE_TRANSFERS,
+                                         limit_per_host=0)
+        self._session = aiohttp.ClientSession(connector=connector)
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self._session.close()
+        self.executor.shutdown()
+        return False
+
+    async def run(self, func, *args):
+        """
+        Run func(*args) in the executor and return its result.
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, func, *args)
+
+    @contextlib.asynccontextmanager
+    async def get(self, url, timeout=None, retries=None, stream=False, headers=None):
+        """
+        GET the url, like contentdm_client.get(): connection errors, timeouts and
+        RETRY_STATUS_CODES responses are retried up to retries (default MAX_RETRIES)
+        times, and any other response is returned as is. Unless stream is set, the body
+        is read before the response is returned, so that its errors are retried too.
+        The request holds a file transfer slot for getfile urls, an API call slot
+        otherwise, until the context exits.
+        Raises ContentdmRequestError when all the retries failed.
+        """
+        if timeout is None:
+            timeout = (contentdm_client.CONNECT_TIMEOUT, contentdm_client.READ_TIMEOUT)
+        if retries is None:
+            retries = contentdm_client.MAX_RETRIES
+        client_timeout = aiohttp.ClientTimeout(sock_connect=timeout[0], sock_read=timeout[1])
+        endpoint = get_endpoint(url)
+        semaphore = self._file_semaphore if endpoint == 'getfile' else self._api_semaphore
+
+        attempt = 0
+        while True:
+            wait = self.rate_limiter.reserve()
+            if wait > 0:
+                await asyncio.sleep(wait)
+            retry_after = None
+            async with semaphore:
+                response = None
+                try:
+                    # For streamed downloads, this is the time until the headers arrived.
+                    start = time.perf_counter()
+                    response = await self._session.get(url, timeout=client_timeout,
+                                                       headers=headers)
+                    if not stream and response.status not in RETRY_STATUS_CODES:
+                        await response.read()
+                    observe('api_request_seconds', time.perf_counter() - start,
+                            endpoint=endpoint)
+                except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    if response is not None:
+                        response.close()
+                    error = e
+                else:
+                    increment('api_responses', endpoint=endpoint, status=response.status)
+                    if response.status not in RETRY_STATUS_CODES:
+                        self.rate_limiter.succeeded()
+                        try:
+                            yield response
+                        finally:
+                            response.release()
+                        return
+                    if response.status in (429, 503):
+                        self.rate_limiter.throttled()
+                    error = 'HTTP {}'.format(response.status)
+                    retry_after = response.headers.get('Retry-After')
+                    response.release()
+
+            if attempt >= retries:
+                increment('api_errors', endpoint=endpoint)
+                raise ContentdmRequestError('{} failed after {} attempts: {}'.format(
+                    url, attempt + 1, str(error) or repr(error)))
+            increment('api_retries', endpoint=endpoint)
+            await asyncio.sleep(backoff_delay(attempt, retry_after))
+            attempt += 1
+
+    async def get_api_content(self, url, use_cache=True, retries=None):
+        """
+        Return the body of a CONTENTdm API call, like contentdm_client.get_api_content().
+        Raises ContentdmRequestError when the request failed, or CacheMissError in
+        CACHE_ONLY mode.
+        """
+        cache = get_cache() if use_cache else None
+        if cache:
+            key = get_cache_key(url)
+            body = await self.run(cache.get, key)
+            if body is not None:
+                increment('cache_hits', endpoint=get_endpoint(url))
+                return body
+            if contentdm_client.CACHE_ONLY:
+                raise CacheMissError('{} is not in the cache'.format(url))
+
+        async with self.get(url, retries=retries) as response:
+            body = await response.read()
+            status = response.status
+        increment('api_bytes', len(body), endpoint=get_endpoint(url))
+        if cache and status == 200:
+            await self.run(cache.put, key, body)
+        return body
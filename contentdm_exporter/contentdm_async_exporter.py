@@ -0,0 +1,459 @@
+# Copyright (C) 2021 TIND.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+This script exports the records and the files of a CONTENTdm collection with asyncio, as
+an alternative to the threads of contentdm_record_exporter.py, contentdm_file_exporter.py
+and contentdm_pipeline.py. The dmQuery paging, the record fetches and the file downloads
+all run on one event loop, limited by the semaphores of contentdm_async_client.py, while
+the parsing and the writes run on a small executor. The output is the same as with the
+other scripts, and their settings are used. Requires aiohttp.
+"""
+
+import asyncio
+import time
+from pathlib import Path
+import contentdm_async_client
+import contentdm_file_exporter
+import contentdm_record_exporter
+from contentdm_async_client import AsyncClient
+from contentdm_client import (CONNECT_TIMEOUT,
+                              ContentdmRequestError,
+                              get_bandwidth_limiter)
+from contentdm_journal import ExportJournal
+from contentdm_metrics import (increment,
+                               reporting)
+
+# Settings
+
+# Export the records, download their files, or both at the same time. The files are then
+# downloaded while the next records are still being exported. When only the files are
+# exported, they are taken from the structure files of an earlier record export.
+EXPORT_RECORDS = True
+EXPORT_FILES = True
+
+# Number of files waiting for a transfer slot. The record export pauses when it is reached.
+MAX_PENDING_DOWNLOADS = 100
+
+
+async def query_contentdm(client, start_at, searchstrings=None, use_cache=True,
+                          maxrecs=None, retries=None):
+    """
+    Query CONTENTdm with the values in $query_map and return an array of records. See
+    contentdm_record_exporter.query_contentdm().
+    """
+    query_url = contentdm_record_exporter.get_query_url(start_at, searchstrings, maxrecs)
+    try:
+        body = await client.get_api_content(query_url, use_cache=use_cache, retries=retries)
+        return await client.run(contentdm_record_exporter.parse_query_results, body)
+    except (ContentdmRequestError, ValueError) as e:
+        print('Query failed: ', e)
+        return []
+
+
+async def run_preliminary_query(client):
+    """
+    Return the total number of records and the number of chunks.
+    """
+    # Only the pager is needed, so keep the query small.
+    prelim_results = await query_contentdm(client, contentdm_record_exporter.START_AT,
+                                           maxrecs=1)
+    return contentdm_record_exporter.count_records(prelim_results)
+
+
+async def get_item_info(client, alias, item_number):
+    """
+    Get the item information as xml, without the xml declaration.
+    """
+    url = contentdm_record_exporter.get_item_info_url(alias, item_number, 'xml')
+    body = await client.get_api_content(url)
+    return contentdm_record_exporter.strip_xml_declaration(body.decode('utf-8'))
+
+
+async def get_compound_object_info(client, alias, pointer):
+    url = contentdm_record_exporter.get_compound_object_info_url(alias, pointer, 'xml')
+    body = await client.get_api_content(url)
+    return body.decode('utf-8')
+
+
+async def get_page_metadata(client, alias, pageptr):
+    file_level_info = await get_item_info(client, alias, pageptr)
+    return await client.run(contentdm_record_exporter.parse_page_metadata, file_level_info)
+
+
+async def fetch_record(client, results_record):
+    """
+    Fetch the metadata, compound object information and page metadata of a record. See
+    contentdm_record_exporter.fetch_record() for the return value.
+    """
+    alias = results_record['collection']
+    pointer = str(results_record['pointer'])
+    page_metadata = {}
+
+    bib_info, compound_info = await asyncio.gather(
+        get_item_info(client, alias, pointer),
+        get_compound_object_info(client, alias, pointer))
+    record, page_elems, pages = await client.run(contentdm_record_exporter.build_record,
+                                                 results_record, bib_info, compound_info)
+
+    if page_elems and contentdm_record_exporter.EXPORT_PAGE_METADATA:
+        # The pages are fetched all at once; the semaphores limit the requests in flight.
+        page_pointers = contentdm_record_exporter.get_page_pointers(page_elems)
+        fetched_pages = await asyncio.gather(*[get_page_metadata(client, alias, pageptr)
+                                               for elem, pageptr in page_pointers])
+        contentdm_record_exporter.add_page_metadata(page_pointers, fetched_pages,
+                                                    page_metadata)
+
+    return record, page_metadata, pages
+
+
+async def try_fetch_record(client, results_record):
+    """
+    Return the result of fetch_record(), or the error if the record could not be
+    exported.
+    """
+    try:
+        return await fetch_record(client, results_record)
+    except contentdm_record_exporter.FETCH_ERRORS as e:
+        return e
+
+
+async def run_queries(client, queries):
+    """
+    Run the dmQuery calls of a generator of contentdm_record_exporter.py, such as
+    iter_chunk_queries(), and return what it returns. See
+    contentdm_record_exporter.run_queries().
+    """
+    try:
+        query_args = next(queries)
+        while True:
+            query_args = queries.send(await query_contentdm(client, **query_args))
+    except StopIteration as e:
+        return e.value
+
+
+async def export_chunk(client, processed_chunks, chunk_start, num_records, journal,
+                       page_index, record_callback=None):
+    """
+    Export the records of one chunk, resuming from the journal. The records of the chunk
+    are fetched all at once, then written in the order of the query. record_callback is
+    a coroutine function, awaited for every record once the chunk is written.
+    """
+    written_records = []
+    collect_record = None
+    if record_callback:
+        collect_record = lambda record, pages: written_records.append((record, pages))
+
+    # Records exported before an interruption are taken from the journal.
+    journaled_records = await client.run(journal.get_records, processed_chunks)
+    if not await client.run(contentdm_record_exporter.skip_exported_chunk, processed_chunks,
+                            chunk_start, num_records, journaled_records, journal,
+                            collect_record):
+        print('Start at: ', chunk_start)
+        records = await run_queries(client, contentdm_record_exporter.iter_chunk_queries(
+            chunk_start, num_records))
+        missing_records = contentdm_record_exporter.get_missing_records(
+            processed_chunks, records, journaled_records)
+        fetched_records = await asyncio.gather(*[try_fetch_record(client, results_record)
+                                                 for results_record in missing_records])
+        await client.run(contentdm_record_exporter.write_chunk, processed_chunks,
+                         chunk_start, records, journaled_records, iter(fetched_records),
+                         journal, page_index, collect_record)
+
+    for record, pages in written_records:
+        await record_callback(record, pages)
+
+
+async def run_batch(client, total_recs, num_chunks, start_at, record_callback=None):
+    """
+    Export the records of the collection, NUM_PARALLEL_CHUNKS chunks at a time. See
+    export_chunk() for record_callback.
+    """
+    print("Retrieving structural file for the %s collection..." % (
+        contentdm_record_exporter.ALIAS,))
+
+    # Create output folder if it does not exists.
+    output_path = Path(contentdm_record_exporter.MIG_OUTPUT_FOLDER)
+    if not output_path.is_dir():
+        output_path.mkdir()
+
+    chunks = contentdm_record_exporter.plan_chunks(total_recs, num_chunks, start_at)
+
+    journal = ExportJournal(contentdm_record_exporter.JOURNAL_FILE)
+    run_date = await client.run(contentdm_record_exporter.get_run_date, journal)
+    page_index = contentdm_record_exporter.open_page_metadata_index()
+    chunk_semaphore = asyncio.Semaphore(contentdm_record_exporter.NUM_PARALLEL_CHUNKS)
+
+    async def export(processed_chunks, chunk_start, num_records):
+        async with chunk_semaphore:
+            await export_chunk(client, processed_chunks, chunk_start, num_records, journal,
+                               page_index, record_callback)
+
+    # Stop at the first error; the other chunks are cancelled with the event loop.
+    await asyncio.gather(*[export(*chunk) for chunk in chunks])
+
+    await client.run(contentdm_record_exporter.finish_batch, journal, page_index, run_date,
+                     start_at, len(chunks))
+
+
+async def run_delta(client, record_callback=None):
+    """
+    Export the records created or modified since the last run and patch them into the
+    existing output. See export_chunk() for record_callback.
+    """
+    since, run_date = contentdm_record_exporter.start_delta()
+    records = await run_queries(
+        client, contentdm_record_exporter.iter_modified_record_queries(since, run_date))
+    contentdm_record_exporter.count_modified_records(records)
+
+    results = await asyncio.gather(*[try_fetch_record(client, results_record)
+                                     for results_record in records])
+    fetched_records = contentdm_record_exporter.collect_fetched_records(records, results)
+    await client.run(contentdm_record_exporter.save_delta, fetched_records, run_date)
+
+    if record_callback:
+        for record, page_metadata, pages in fetched_records:
+            await record_callback(record, pages)
+
+
+async def download_file(client, dmrecord, output_path, filename):
+    """
+    Export file from CONTENTdm. See contentdm_file_exporter.download_file().
+    """
+    start = time.perf_counter()
+    result = await _download_file(client, dmrecord, output_path, filename)
+    await client.run(contentdm_file_exporter.record_download, dmrecord,
+                     Path(output_path, filename), result, time.perf_counter() - start)
+    return result
+
+
+def write_block(f, hasher, block):
+    f.write(block)
+    hasher.update(block)
+
+
+async def limit_bandwidth(num_bytes):
+    """
+    Wait as long as the bandwidth cap requires after receiving num_bytes.
+    """
+    wait = get_bandwidth_limiter().reserve(num_bytes)
+    if wait > 0:
+        await asyncio.sleep(wait)
+
+
+async def wait_for_disk_space():
+    """
+    Wait while the disk is low, see contentdm_file_exporter.MIN_FREE_DISK_SPACE. Return
+    False if the downloads must stop.
+    """
+    disk_space_guard = contentdm_file_exporter.get_disk_space_guard()
+    wait = disk_space_guard.reserve(None)
+    while wait:
+        await asyncio.sleep(wait)
+        wait = disk_space_guard.reserve(None)
+    return wait is not None
+
+
+async def _download_file(client, dmrecord, output_path, filename):
+    """
+    Export file from CONTENTdm, like contentdm_file_exporter._download_file(). The file
+    is written in blocks of DOWNLOAD_BLOCK_SIZE bytes from the executor.
+    """
+    block_size = contentdm_file_exporter.DOWNLOAD_BLOCK_SIZE
+    local_file_name = Path(output_path, filename)
+    temp_file_name = Path(output_path, filename + '.part')
+
+    # If the file already exists, skip downloading it again.
+    result = await client.run(contentdm_file_exporter.skip_download, dmrecord,
+                              local_file_name)
+    if result is not None:
+        return result
+
+    download_url, headers, info = await client.run(
+        contentdm_file_exporter.get_download_request, dmrecord, filename, temp_file_name)
+
+    # Download file
+    size = 0
+    try:
+        async with client.get(download_url, timeout=(CONNECT_TIMEOUT, 3600), stream=True,
+                              headers=headers) as response:
+            if response.status == 416:
+                # The server does not accept our range; start over once the transfer
+                # slot is released.
+                restart = True
+            elif response.status not in (200, 206):
+                return contentdm_file_exporter.get_error_result(dmrecord,
+                                                                await response.text())
+            elif (response.status == 206
+                  and not contentdm_file_exporter.is_requested_range(info,
+                                                                     response.headers)):
+                if not info or not info['bytes_written']:
+                    print('Unexpected range {} for a new download: {}'.format(
+                        response.headers.get('Content-Range'), local_file_name))
+                    return False
+                # The range is not the one we asked for; start over.
+                restart = True
+            else:
+                restart = False
+                info, size, hasher = await client.run(
+                    contentdm_file_exporter.start_download, local_file_name,
+                    temp_file_name, info, response.status, response.headers)
+                with open(str(temp_file_name), 'ab' if size else 'wb') as f:
+                    buffer = bytearray()
+                    async for data in response.content.iter_chunked(block_size):
+                        buffer += data
+                        if len(buffer) >= block_size:
+                            block, buffer = bytes(buffer), bytearray()
+                            await client.run(write_block, f, hasher, block)
+                            size += len(block)
+                            increment('download_bytes', len(block))
+                            await limit_bandwidth(len(block))
+                    if buffer:
+                        await client.run(write_block, f, hasher, bytes(buffer))
+                        size += len(buffer)
+                        increment('download_bytes', len(buffer))
+                        await limit_bandwidth(len(buffer))
+    except ContentdmRequestError as e:
+        print('File download failed: ', e)
+        return e
+    except (contentdm_async_client.aiohttp.ClientError, asyncio.TimeoutError) as e:
+        # The connection broke in the middle of the transfer. Keep what we have for
+        # the next run.
+        if info:
+            info['bytes_written'] = size
+            await client.run(contentdm_file_exporter.save_partial_download, temp_file_name,
+                             info)
+        print('File download failed: ', e)
+        return e
+
+    if restart:
+        contentdm_file_exporter.remove_partial_download(temp_file_name)
+        return await _download_file(client, dmrecord, output_path, filename)
+
+    return await client.run(contentdm_file_exporter.finish_download, dmrecord,
+                            local_file_name, temp_file_name, info, size, hasher)
+
+
+class DownloadScheduler(object):
+    """
+    Downloads the files handed to it in the background. schedule() waits while
+    MAX_PENDING_DOWNLOADS files are waiting, which in turn pauses the record export. The
+    downloads pause while the disk is low, and are left out once the disk space guard
+    gave up.
+    """
+
+    def __init__(self, client):
+        self.client = client
+        self._pending_downloads = asyncio.Semaphore(MAX_PENDING_DOWNLOADS)
+        self._tasks = set()
+
+    async def schedule(self, downloads):
+        """
+        Download the (dmrecord, output_path, filename) files in the background.
+        """
+        for download_args in downloads:
+            await self._pending_downloads.acquire()
+            task = asyncio.ensure_future(self._download(*download_args))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def schedule_record(self, record, pages):
+        """
+        Download the files of a record, as a record_callback of run_batch().
+        """
+        downloads = await self.client.run(contentdm_file_exporter.get_record_downloads,
+                                          record, pages)
+        await self.schedule(downloads)
+
+    async def _download(self, dmrecord, output_path, filename):
+        try:
+            if not await wait_for_disk_space():
+                return None
+            return await download_file(self.client, dmrecord, output_path, filename)
+        finally:
+            self._pending_downloads.release()
+
+    async def join(self):
+        """
+        Wait for all the downloads to finish.
+        """
+        while self._tasks:
+            await asyncio.gather(*self._tasks)
+
+
+async def run_file_export(scheduler):
+    """
+    Download the files of all the records of the structure files in MIG_INPUT_FOLDER.
+    """
+    journal = None
+    if Path(contentdm_file_exporter.JOURNAL_FILE).is_file():
+        journal = ExportJournal(contentdm_file_exporter.JOURNAL_FILE)
+
+    input_folder = Path(contentdm_file_exporter.MIG_INPUT_FOLDER)
+    for file_path in sorted(input_folder.glob('*.xml')):
+        downloads = await scheduler.client.run(contentdm_file_exporter.get_file_downloads,
+                                               file_path, journal)
+        await scheduler.schedule(downloads)
+    await scheduler.join()
+
+    if journal:
+        journal.close()
+
+
+def handle_exception(loop, context):
+    """
+    The exporters exit() on fatal errors. The exit goes through the event loop, so
+    asyncio does not need to report it as an error of the task which called exit().
+    """
+    if isinstance(context.get('exception'), SystemExit):
+        return
+    loop.default_exception_handler(context)
+
+
+async def run_export():
+    asyncio.get_running_loop().set_exception_handler(handle_exception)
+    async with AsyncClient() as client:
+        scheduler = DownloadScheduler(client)
+        if EXPORT_RECORDS:
+            record_callback = scheduler.schedule_record if EXPORT_FILES else None
+            if contentdm_record_exporter.DELTA_MODE:
+                await run_delta(client, record_callback)
+            else:
+                total_recs, num_chunks = await run_preliminary_query(client)
+                await run_batch(client, total_recs, num_chunks,
+                                contentdm_record_exporter.START_AT, record_callback)
+            await scheduler.join()
+        elif EXPORT_FILES:
+            await run_file_export(scheduler)
+    contentdm_file_exporter.close_manifest()
+    contentdm_file_exporter.close_failure_ledger()
+
+
+if __name__ == '__main__':
+    if contentdm_async_client.aiohttp is None:
+        print('The asyncio engine requires aiohttp: pip install -r requirements-async.txt')
+        exit()
+    if (EXPORT_RECORDS and EXPORT_FILES
+            and contentdm_record_exporter.ALIAS != contentdm_file_exporter.ALIAS):
+        print('ALIAS differs between contentdm_record_exporter.py and '
+              'contentdm_file_exporter.py.')
+        exit()
+    with reporting():
+        asyncio.run(run_export())
@@ -0,0 +1,106 @@
+# Copyright (C) 2021 TIND.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+On-disk cache of the CONTENTdm API responses, stored in SQLite. Entries expire after a
+time to live, and the least recently used entries are evicted when the cache grows
+beyond its maximum size.
+"""
+
+import sqlite3
+import threading
+import time
+
+
+class ResponseCache(object):
+
+    def __init__(self, path, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(path), check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS responses ('
+                           'key TEXT PRIMARY KEY, '
+                           'body BLOB, '
+                           'created REAL, '
+                           'accessed REAL, '
+                           'size INTEGER)')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS responses_accessed '
+                           'ON responses (accessed)')
+        self._conn.commit()
+        self._size = self._conn.execute(
+            'SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+
+    def get(self, key):
+        """
+        Return the cached body, or None if it is missing or expired.
+        """
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute('SELECT body, created FROM responses WHERE key = ?',
+                                     (key,)).fetchone()
+            if row is None:
+                return None
+            body, created = row
+            if self.ttl and now - created > self.ttl:
+                self._delete(key)
+                self._conn.commit()
+                return None
+            self._conn.execute('UPDATE responses SET accessed = ? WHERE key = ?', (now, key))
+            self._conn.commit()
+        return body
+
+    def put(self, key, body):
+        now = time.time()
+        with self._lock:
+            self._delete(key)
+            self._conn.execute('INSERT INTO responses VALUES (?, ?, ?, ?, ?)',
+                               (key, body, now, now, len(body)))
+            self._size += len(body)
+            self._evict()
+            self._conn.commit()
+
+    def _delete(self, key):
+        row = self._conn.execute('SELECT size FROM responses WHERE key = ?',
+                                 (key,)).fetchone()
+        if row is not None:
+            self._conn.execute('DELETE FROM responses WHERE key = ?', (key,))
+            self._size -= row[0]
+
+    def _evict(self):
+        """
+        Delete the least recently used entries until the cache fits in max_size.
+        """
+        while self.max_size and self._size > self.max_size:
+            rows = self._conn.execute('SELECT key, size FROM responses '
+                                      'ORDER BY accessed LIMIT 100').fetchall()
+            if not rows:
+                break
+            for key, size in rows:
+                if self._size <= self.max_size:
+                    break
+                self._conn.execute('DELETE FROM responses WHERE key = ?', (key,))
+                self._size -= size
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,367 @@
+# Copyright (C) 2021 TIND.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+HTTP client shared by the record and file exporters. Every request to CONTENTdm goes
+through one pooled keep-alive session, with timeouts, retries with exponential backoff
+and a governor keeping the request rate below what the server tolerates.
+"""
+
+import os
+import random
+import threading
+import time
+import requests
+from requests.adapters import HTTPAdapter
+from urllib.parse import urlparse
+from contentdm_cache import ResponseCache
+from contentdm_metrics import (increment,
+                               observe)
+
+# Settings
+
+# Number of connections kept alive per host. Should be at least the number of workers.
+POOL_SIZE = 16
+
+# Maximum number of requests in flight against a single host.
+MAX_REQUESTS_PER_HOST = 8
+
+# Seconds to wait for the connection to be established and for the server to answer.
+CONNECT_TIMEOUT = 10
+READ_TIMEOUT = 300
+
+# Number of times a failed request is retried before giving up.
+MAX_RETRIES = 5
+
+# The delay before retry n is a random value between 0 and
+# min(BACKOFF_MAX, BACKOFF_BASE * 2 ** n) seconds.
+BACKOFF_BASE = 1
+BACKOFF_MAX = 60
+
+# HTTP status codes worth retrying.
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+
+# Requests per second allowed against CONTENTdm. The rate is halved every time the
+# server throttles us (429/503) and slowly raised again, but never below
+# MIN_REQUESTS_PER_SECOND. Set MAX_REQUESTS_PER_SECOND to 0 to disable the governor.
+MAX_REQUESTS_PER_SECOND = 50
+MIN_REQUESTS_PER_SECOND = 1
+
+# Requests per second added back to the rate after every successful request.
+RATE_INCREASE_STEP = 0.1
+
+# Bytes per second allowed for all the file downloads together. 0 disables the cap.
+MAX_DOWNLOAD_BYTES_PER_SECOND = 0
+
+# Path of the on-disk cache of the API responses (dmQuery, dmGetItemInfo,
+# dmGetCompoundObjectInfo), e.g. "/Users/Demo/migration/my_project/cache.sqlite".
+# None disables the cache. Files are never cached.
+CACHE_FILE = None
+
+# Maximum size of the cache in bytes; the least recently used responses are evicted first.
+CACHE_MAX_SIZE = 2 * 1024 ** 3
+
+# Seconds a cached response stays valid. 0 keeps them until they are evicted.
+CACHE_TTL = 7 * 24 * 3600
+
+# Only answer from the cache, never query CONTENTdm. A response missing from the cache
+# raises CacheMissError.
+CACHE_ONLY = False
+
+
+class ContentdmRequestError(Exception):
+    """
+    Raised when a request to CONTENTdm still fails after MAX_RETRIES retries.
+    """
+
+
+class CacheMissError(ContentdmRequestError):
+    """
+    Raised in CACHE_ONLY mode when a response is not in the cache.
+    """
+
+
+class BandwidthLimiter(object):
+    """
+    Spaces out the blocks of the downloads to keep their total throughput below
+    max_bytes_per_second.
+    """
+
+    def __init__(self, max_bytes_per_second):
+        self.max_bytes_per_second = max_bytes_per_second
+        self._next_slot = 0
+        self._lock = threading.Lock()
+
+    def acquire(self, num_bytes):
+        wait = self.reserve(num_bytes)
+        if wait > 0:
+            time.sleep(wait)
+
+    def reserve(self, num_bytes):
+        """
+        Account for num_bytes received and return the number of seconds to wait before
+        receiving more.
+        """
+        if not self.max_bytes_per_second:
+            return 0
+        with self._lock:
+            now = time.monotonic()
+            wait = self._next_slot - now
+            self._next_slot = max(now, self._next_slot) + num_bytes / self.max_bytes_per_second
+        return wait
+
+
+class RateLimiter(object):
+    """
+    Spaces out the requests to stay below the current rate. The rate goes down when the
+    server throttles us and climbs back up towards max_rate as requests succeed.
+    """
+
+    def __init__(self, max_rate, min_rate):
+        self.max_rate = max_rate
+        self.min_rate = min(min_rate, max_rate)
+        self.rate = max_rate
+        self._next_slot = 0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        wait = self.reserve()
+        if wait > 0:
+            time.sleep(wait)
+
+    def reserve(self):
+        """
+        Reserve the next request slot and return the number of seconds to wait for it.
+        """
+        if not self.max_rate:
+            return 0
+        with self._lock:
+            now = time.monotonic()
+            wait = self._next_slot - now
+            self._next_slot = max(now, self._next_slot) + 1.0 / self.rate
+        return wait
+
+    def throttled(self):
+        with self._lock:
+            self.rate = max(self.min_rate, self.rate / 2)
+
+    def succeeded(self):
+        with self._lock:
+            self.rate = min(self.max_rate, self.rate + RATE_INCREASE_STEP)
+
+
+_session = None
+_rate_limiter = None
+_bandwidth_limiter = None
+_cache = None
+_host_semaphores = {}  # One semaphore per host to limit the in-flight requests.
+_lock = threading.Lock()
+
+
+def reset():
+    """
+    Forget the session, rate and bandwidth limiters, semaphores and cache. Called in the
+    child after a fork, as sockets and SQLite connections can not be shared between
+    processes.
+    """
+    global _session, _rate_limiter, _bandwidth_limiter, _cache, _host_semaphores, _lock
+    _session = None
+    _rate_limiter = None
+    _bandwidth_limiter = None
+    _cache = None
+    _host_semaphores = {}
+    _lock = threading.Lock()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=reset)
+
+
+def get_session():
+    """
+    Return the shared session, creating it on first use.
+    """
+    global _session
+    with _lock:
+        if _session is None:
+            adapter = HTTPAdapter(pool_connections=POOL_SIZE,
+                                  pool_maxsize=POOL_SIZE,
+                                  max_retries=0)
+            _session = requests.Session()
+            _session.mount('http://', adapter)
+            _session.mount('https://', adapter)
+        return _session
+
+
+def get_rate_limiter():
+    global _rate_limiter
+    with _lock:
+        if _rate_limiter is None:
+            _rate_limiter = RateLimiter(MAX_REQUESTS_PER_SECOND, MIN_REQUESTS_PER_SECOND)
+        return _rate_limiter
+
+
+def get_bandwidth_limiter():
+    global _bandwidth_limiter
+    with _lock:
+        if _bandwidth_limiter is None:
+            _bandwidth_limiter = BandwidthLimiter(MAX_DOWNLOAD_BYTES_PER_SECOND)
+        return _bandwidth_limiter
+
+
+def get_cache():
+    """
+    Return the response cache, or None if CACHE_FILE is not set.
+    """
+    global _cache
+    with _lock:
+        if _cache is None and CACHE_FILE:
+            _cache = ResponseCache(CACHE_FILE, CACHE_MAX_SIZE, CACHE_TTL)
+        return _cache
+
+
+def get_cache_key(url):
+    """
+    The API calls are cached by host and query, e.g.
+    "server16694.contentdm.oclc.org/dmGetItemInfo/alias/42/xml".
+    """
+    parsed_url = urlparse(url)
+    query = parsed_url.query
+    if query.startswith('q='):
+        query = query[2:]
+    return parsed_url.netloc + '/' + query
+
+
+def get_endpoint(url):
+    """
+    Return the API function (e.g. "dmGetItemInfo") or "getfile" called by the url, to
+    label the metrics.
+    """
+    parsed_url = urlparse(url)
+    if '/utils/getfile/' in parsed_url.path:
+        return 'getfile'
+    query = parsed_url.query
+    if query.startswith('q='):
+        query = query[2:]
+    return query.split('/', 1)[0] or 'other'
+
+
+def get_host_semaphore(url):
+    host = urlparse(url).netloc
+    with _lock:
+        if host not in _host_semaphores:
+            _host_semaphores[host] = threading.BoundedSemaphore(MAX_REQUESTS_PER_HOST)
+        return _host_semaphores[host]
+
+
+def backoff_delay(attempt, retry_after=None):
+    """
+    Return the number of seconds to wait before the next attempt. The server's
+    Retry-After header wins over our own exponential backoff with full jitter.
+    """
+    if retry_after:
+        try:
+            return min(BACKOFF_MAX, float(retry_after))
+        except ValueError:
+            pass
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+
+
+def get(url, timeout=None, retries=None, **kwargs):
+    return request('GET', url, timeout, retries, **kwargs)
+
+
+def head(url, timeout=None, retries=None, **kwargs):
+    return request('HEAD', url, timeout, retries, **kwargs)
+
+
+def request(method, url, timeout=None, retries=None, **kwargs):
+    """
+    Send the request with the shared session, retrying connection errors, timeouts and
+    RETRY_STATUS_CODES responses up to retries (default MAX_RETRIES) times. Any other
+    response is returned as is, so the caller decides what to do with e.g. a 404.
+    Raises ContentdmRequestError when all the retries failed.
+    """
+    if timeout is None:
+        timeout = (CONNECT_TIMEOUT, READ_TIMEOUT)
+    if retries is None:
+        retries = MAX_RETRIES
+    rate_limiter = get_rate_limiter()
+    semaphore = get_host_semaphore(url)
+    endpoint = get_endpoint(url)
+
+    attempt = 0
+    while True:
+        rate_limiter.acquire()
+        retry_after = None
+        try:
+            with semaphore:
+                # For streamed downloads, this is the time until the headers arrived.
+                start = time.perf_counter()
+                response = get_session().request(method, url, timeout=timeout, **kwargs)
+                observe('api_request_seconds', time.perf_counter() - start,
+                        endpoint=endpoint)
+        except (requests.exceptions.ConnectionError,
+                requests.exceptions.Timeout) as e:
+            error = e
+        else:
+            increment('api_responses', endpoint=endpoint, status=response.status_code)
+            if response.status_code not in RETRY_STATUS_CODES:
+                rate_limiter.succeeded()
+                return response
+            if response.status_code in (429, 503):
+                rate_limiter.throttled()
+            error = 'HTTP {}'.format(response.status_code)
+            retry_after = response.headers.get('Retry-After')
+            response.close()
+
+        if attempt >= retries:
+            increment('api_errors', endpoint=endpoint)
+            raise ContentdmRequestError('{} failed after {} attempts: {}'.format(
+                url, attempt + 1, error))
+        increment('api_retries', endpoint=endpoint)
+        time.sleep(backoff_delay(attempt, retry_after))
+        attempt += 1
+
+
+def get_api_content(url, use_cache=True, retries=None):
+    """
+    Return the body of a CONTENTdm API call, from the cache if possible. Only
+    successful responses are cached. Set use_cache to False for calls whose answer must
+    be fresh.
+    Raises ContentdmRequestError when the request failed, or CacheMissError in
+    CACHE_ONLY mode.
+    """
+    cache = get_cache() if use_cache else None
+    if cache:
+        key = get_cache_key(url)
+        body = cache.get(key)
+        if body is not None:
+            increment('cache_hits', endpoint=get_endpoint(url))
+            return body
+        if CACHE_ONLY:
+            raise CacheMissError('{} is not in the cache'.format(url))
+
+    response = get(url, retries=retries)
+    body = response.content
+    increment('api_bytes', len(body), endpoint=get_endpoint(url))
+    if cache and response.status_code == 200:
+        cache.put(key, body)
+    return body
@@ -0,0 +1,145 @@
+# Copyright (C) 2021 TIND.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+This script exports several CONTENTdm collections at the same time, each one in its own
+process and in its own folder (REL_PATH/{alias}/). The collections are listed in
+ALIASES, or all the collections of the server are exported.
+The other settings are taken from contentdm_record_exporter.py, contentdm_file_exporter.py
+and contentdm_client.py.
+"""
+
+import json
+from concurrent.futures import (ProcessPoolExecutor,
+                                as_completed)
+from pathlib import Path
+import contentdm_client
+import contentdm_file_exporter
+import contentdm_metrics
+import contentdm_pipeline
+import contentdm_record_exporter
+
+# Settings
+
+# Aliases of the collections to export. Leave empty to export all the collections listed
+# by dmGetCollectionList.
+ALIASES = []
+
+# Local path; each collection is exported to its own folder inside.
+REL_PATH = "/Users/Demo/migration/my_project/"
+
+# Number of collections exported at the same time. The request rate and the requests in
+# flight set in contentdm_client.py are shared between them.
+MAX_PARALLEL_COLLECTIONS = 4
+
+# Also download the files of the collections, while the records are exported.
+EXPORT_FILES = True
+
+
+def get_collection_aliases():
+    """
+    Return the aliases of all the collections of the CONTENTdm server.
+    """
+    query_url = contentdm_record_exporter.MAIN_URL + 'dmGetCollectionList/json'
+    collections = json.loads(contentdm_client.get_api_content(query_url, use_cache=False))
+    return [collection['alias'].lstrip('/') for collection in collections]
+
+
+def share_server_capacity(num_processes):
+    """
+    Share the request rate, the requests in flight and the bandwidth set in
+    contentdm_client.py between the processes. Runs once in every worker process, which
+    then exports several collections.
+    """
+    if contentdm_client.MAX_REQUESTS_PER_SECOND:
+        contentdm_client.MAX_REQUESTS_PER_SECOND /= num_processes
+        contentdm_client.MIN_REQUESTS_PER_SECOND /= num_processes
+    contentdm_client.MAX_REQUESTS_PER_HOST = max(
+        1, contentdm_client.MAX_REQUESTS_PER_HOST // num_processes)
+    contentdm_client.MAX_DOWNLOAD_BYTES_PER_SECOND /= num_processes
+    contentdm_client.reset()
+
+
+def export_collection(alias, rel_path, export_files):
+    """
+    Export one collection. Runs in a worker process. Return None on success, or the
+    error which stopped the export.
+    """
+    # The worker processes are reused, so the metrics of the collections they exported
+    # before are dropped; the ETA then starts with this export.
+    contentdm_metrics.reset()
+
+    Path(rel_path).mkdir(parents=True, exist_ok=True)
+    contentdm_record_exporter.configure(alias, rel_path)
+    contentdm_file_exporter.configure(alias, rel_path)
+    # Every collection writes its metrics to its own folder.
+    if contentdm_metrics.METRICS_FILE:
+        contentdm_metrics.METRICS_FILE = str(Path(rel_path,
+                                                  Path(contentdm_metrics.METRICS_FILE).name))
+
+    try:
+        if export_files:
+            contentdm_pipeline.run_pipeline()
+        else:
+            total_recs, num_chunks = contentdm_record_exporter.run_preliminary_query()
+            with contentdm_metrics.reporting():
+                contentdm_record_exporter.run_batch(total_recs,
+                                                    num_chunks,
+                                                    contentdm_record_exporter.START_AT)
+    except SystemExit as e:
+        # The exporters exit(1) when CONTENTdm can not be reached or too many records
+        # failed, and exit() when the collection has no records. The pipeline raises the
+        # exit of its record export.
+        if e.code:
+            return 'export stopped (exit status {})'.format(e.code)
+    except Exception as e:
+        return repr(e)
+    return None
+
+
+def run_collections():
+    aliases = ALIASES or get_collection_aliases()
+    num_processes = min(MAX_PARALLEL_COLLECTIONS, len(aliases))
+    print('Exporting {} collections, {} at a time'.format(len(aliases), num_processes))
+
+    failed = []
+    with ProcessPoolExecutor(max_workers=num_processes,
+                             initializer=share_server_capacity,
+                             initargs=(num_processes,)) as executor:
+        futures = {executor.submit(export_collection,
+                                   alias,
+                                   '{}{}/'.format(REL_PATH, alias),
+                                   EXPORT_FILES): alias
+                   for alias in aliases}
+        for future in as_completed(futures):
+            alias = futures[future]
+            error = future.result()
+            if error:
+                failed.append(alias)
+                print('Collection {} failed: {}'.format(alias, error))
+            else:
+                print('Collection {} exported'.format(alias))
+
+    if failed:
+        print('Failed collections: ', ', '.join(failed))
+
+
+if __name__ == '__main__':
+    run_collections()
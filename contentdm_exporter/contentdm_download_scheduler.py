@@ -0,0 +1,164 @@
+# Copyright (C) 2021 TIND.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+Scheduling of the file downloads by size and free disk space. The large files are
+started first and only a few at a time, so that they do not hold up all the workers
+while the small files wait, and no download starts unless the disk keeps enough free
+space for it.
+"""
+
+import shutil
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+
+class DiskSpaceGuard(object):
+    """
+    Keeps min_free_space bytes free on the volume of path. Every download reserves its
+    size before it starts and releases it once done, so the files in flight are counted
+    before they are written. When the disk is low, the downloads pause until space is
+    freed, checking every check_interval seconds; after max_wait seconds, the guard gives
+    up and no other download starts.
+    """
+
+    def __init__(self, path, min_free_space, check_interval, max_wait):
+        self.path = str(path)
+        self.min_free_space = min_free_space
+        self.check_interval = check_interval
+        self.max_wait = max_wait
+        self.stopped = False
+        self._reserved = 0
+        self._paused_since = None
+        self._lock = threading.Lock()
+
+    def acquire(self, size):
+        """
+        Wait until size bytes can be reserved. Return False if the guard gave up.
+        """
+        wait = self.reserve(size)
+        while wait:
+            time.sleep(wait)
+            wait = self.reserve(size)
+        return wait is not None
+
+    def reserve(self, size):
+        """
+        Reserve size bytes (None if unknown) for a download. Return 0 if they were
+        reserved, the number of seconds to wait before trying again, or None if the
+        guard gave up.
+        """
+        size = size or 0
+        if not self.min_free_space:
+            return 0
+        with self._lock:
+            if self.stopped:
+                return None
+            free_space = shutil.disk_usage(self.path).free - self._reserved
+            if free_space - size >= self.min_free_space:
+                if self._paused_since is not None:
+                    print('Enough disk space again, resuming the downloads')
+                    self._paused_since = None
+                self._reserved += size
+                return 0
+            now = time.monotonic()
+            if self._paused_since is None:
+                print('Only {} MB of disk space left, pausing the downloads'.format(
+                    free_space // 1024 ** 2))
+                self._paused_since = now
+            if now - self._paused_since >= self.max_wait:
+                print('Still not enough disk space after {} seconds, stopping the '
+                      'downloads'.format(self.max_wait))
+                self.stopped = True
+                return None
+            return self.check_interval
+
+    def release(self, size):
+        with self._lock:
+            self._reserved -= size or 0
+
+
+class TransferScheduler(object):
+    """
+    Runs the downloads on num_workers threads. Files of large_file_size bytes or more
+    are started largest first, at most max_large_transfers at a time, while the other
+    workers go through the smaller files in order; a worker only goes over
+    max_large_transfers when no smaller file is left. Files of unknown size count as
+    small.
+    """
+
+    def __init__(self, download, num_workers, large_file_size, max_large_transfers,
+                 disk_space_guard):
+        self.download = download
+        self.num_workers = num_workers
+        self.large_file_size = large_file_size
+        self.max_large_transfers = max(1, max_large_transfers)
+        self.disk_space_guard = disk_space_guard
+
+    def run(self, downloads, sizes):
+        """
+        Download the (dmrecord, output_path, filename) downloads, whose sizes are given
+        in the same order. Return the results in the order of the downloads; None for
+        the downloads which were not started because the disk was full.
+        """
+        results = [None] * len(downloads)
+        large = deque(sorted((i for i, size in enumerate(sizes)
+                              if size and size >= self.large_file_size),
+                             key=lambda i: -sizes[i]))
+        small = deque(i for i, size in enumerate(sizes)
+                      if not size or size < self.large_file_size)
+        lock = threading.Lock()
+        num_large_transfers = [0]
+
+        def next_download():
+            with lock:
+                if large and (num_large_transfers[0] < self.max_large_transfers
+                              or not small):
+                    num_large_transfers[0] += 1
+                    return large.popleft(), True
+                if small:
+                    return small.popleft(), False
+                return None, False
+
+        def work():
+            while True:
+                i, is_large = next_download()
+                if i is None:
+                    return
+                try:
+                    if not self.disk_space_guard.acquire(sizes[i]):
+                        return
+                    try:
+                        results[i] = self.download(*downloads[i])
+                    finally:
+                        self.disk_space_guard.release(sizes[i])
+                finally:
+                    if is_large:
+                        with lock:
+                            num_large_transfers[0] -= 1
+
+        with ThreadPoolExecutor(max_workers=self.num_workers) as executor:
+            futures = [executor.submit(work)
+                       for _ in range(min(self.num_workers, len(downloads)))]
+            for future in futures:
+                future.result()
+        return results
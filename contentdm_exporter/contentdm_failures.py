@@ -0,0 +1,126 @@
+# Copyright (C) 2021 TIND.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+Ledger of the records and files which failed to export, stored in SQLite. Both exporters
+write to it instead of stopping at the first failure, and an entry is removed as soon as
+its record or file is exported. The records and files of the ledger can then be exported
+again on their own, without going through the whole collection.
+"""
+
+import sqlite3
+import threading
+import time
+from collections import namedtuple
+
+# chunk and position are those of the record in the query of the collection, or None if
+# unknown, e.g. for the records of a delta export.
+RecordFailure = namedtuple('RecordFailure',
+                           ['pointer', 'chunk', 'position', 'error', 'attempts'])
+
+# path is relative to the download folder, like in the download manifest.
+FileFailure = namedtuple('FileFailure', ['path', 'pointer', 'error', 'attempts'])
+
+
+class FailureLedger(object):
+
+    def __init__(self, path):
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(path), check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS records ('
+                           'pointer TEXT PRIMARY KEY, '
+                           'chunk INTEGER, '
+                           'position INTEGER, '
+                           'error TEXT, '
+                           'attempts INTEGER, '
+                           'failed REAL)')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS files ('
+                           'path TEXT PRIMARY KEY, '
+                           'pointer TEXT, '
+                           'error TEXT, '
+                           'attempts INTEGER, '
+                           'failed REAL)')
+        self._conn.commit()
+        # Kept in memory, so that the records and files exported without trouble, the
+        # vast majority, cost no write.
+        self._record_pointers = {row[0] for row in
+                                 self._conn.execute('SELECT pointer FROM records')}
+        self._file_paths = {row[0] for row in self._conn.execute('SELECT path FROM files')}
+
+    def add_record(self, pointer, chunk, position, error):
+        """
+        Add a record which failed to export. The chunk and position already known are
+        kept if they are None.
+        """
+        with self._lock:
+            self._conn.execute('INSERT INTO records VALUES (?, ?, ?, ?, 1, ?) '
+                               'ON CONFLICT (pointer) DO UPDATE SET '
+                               'chunk = COALESCE(excluded.chunk, chunk), '
+                               'position = COALESCE(excluded.position, position), '
+                               'error = excluded.error, '
+                               'attempts = attempts + 1, '
+                               'failed = excluded.failed',
+                               (pointer, chunk, position, str(error), time.time()))
+            self._conn.commit()
+            self._record_pointers.add(pointer)
+
+    def remove_record(self, pointer):
+        with self._lock:
+            if pointer in self._record_pointers:
+                self._conn.execute('DELETE FROM records WHERE pointer = ?', (pointer,))
+                self._conn.commit()
+                self._record_pointers.discard(pointer)
+
+    def get_records(self):
+        with self._lock:
+            rows = self._conn.execute('SELECT pointer, chunk, position, error, attempts '
+                                      'FROM records ORDER BY chunk, position').fetchall()
+        return [RecordFailure(*row) for row in rows]
+
+    def add_file(self, path, pointer, error):
+        with self._lock:
+            self._conn.execute('INSERT INTO files VALUES (?, ?, ?, 1, ?) '
+                               'ON CONFLICT (path) DO UPDATE SET '
+                               'pointer = excluded.pointer, '
+                               'error = excluded.error, '
+                               'attempts = attempts + 1, '
+                               'failed = excluded.failed',
+                               (path, pointer, str(error), time.time()))
+            self._conn.commit()
+            self._file_paths.add(path)
+
+    def remove_file(self, path):
+        with self._lock:
+            if path in self._file_paths:
+                self._conn.execute('DELETE FROM files WHERE path = ?', (path,))
+                self._conn.commit()
+                self._file_paths.discard(path)
+
+    def get_files(self):
+        with self._lock:
+            rows = self._conn.execute('SELECT path, pointer, error, attempts '
+                                      'FROM files ORDER BY path').fetchall()
+        return [FileFailure(*row) for row in rows]
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
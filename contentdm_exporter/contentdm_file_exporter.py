@@ -24,9 +24,33 @@ This script loops through the input XML and find all files. It then query CONTEN
 the files.
 """
 
+import hashlib
+import json
+import os
+import threading
+import time
 import requests
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from pathlib import Path
-from defusedxml.lxml import parse
+from defusedxml.lxml import (fromstring,
+                             parse)
+from contentdm_client import (CONNECT_TIMEOUT,
+                              ContentdmRequestError,
+                              get,
+                              get_bandwidth_limiter,
+                              head)
+from contentdm_download_scheduler import (DiskSpaceGuard,
+                                          TransferScheduler)
+from contentdm_failures import FailureLedger
+from contentdm_journal import ExportJournal
+from contentdm_manifest import (DownloadManifest,
+                                hash_file)
+from contentdm_metrics import (increment,
+                               observe,
+                               reporting)
+from contentdm_structure import get_page_index
+from contentdm_xml import iter_records_from_file
 
 # Settings
 FILE_URL = 'https://cdm16694.contentdm.oclc.org/utils/getfile/collection/'
@@ -42,47 +66,565 @@ MIG_INPUT_FOLDER = REL_PATH + 'output/'
 # Path to the output polder where the downloaded files will be stored.
 MIG_OUTPUT_FOLDER = REL_PATH + "Download/"
 
+# The journal of the record export holds the page index of every record, so the
+# compound objects do not need to be walked again. Records missing from it are walked.
+JOURNAL_FILE = MIG_INPUT_FOLDER + "{}_journal.sqlite".format(ALIAS)
+
+# Number of files downloaded at the same time.
+NUM_DOWNLOAD_WORKERS = 4
+
+# Files are streamed to disk in blocks of this many bytes, whatever their size.
+DOWNLOAD_BLOCK_SIZE = 1024 * 1024
+
+# Files of LARGE_FILE_SIZE bytes or more are downloaded largest first, at most
+# MAX_LARGE_TRANSFERS at a time, so that the other workers keep going through the smaller
+# files. The sizes are taken from the manifest and the interrupted downloads; with
+# LOOKUP_FILE_SIZES, the other files are looked up with a HEAD request to CONTENTdm each.
+# Files of unknown size count as small.
+LARGE_FILE_SIZE = 100 * 1024 ** 2
+MAX_LARGE_TRANSFERS = 2
+LOOKUP_FILE_SIZES = False
+
+# Bytes kept free on the disk of MIG_OUTPUT_FOLDER. A download only starts if the disk
+# keeps that much free space once the files in flight are written; otherwise the
+# downloads pause, checking every DISK_SPACE_CHECK_INTERVAL seconds, and stop if no space
+# is freed within MAX_DISK_SPACE_WAIT seconds. Run the script again to download the rest.
+# 0 disables the check.
+MIN_FREE_DISK_SPACE = 1024 ** 3
+DISK_SPACE_CHECK_INTERVAL = 60
+MAX_DISK_SPACE_WAIT = 3600
+
+# The bandwidth of all the downloads together is capped in contentdm_client.py.
+
+# The manifest records the size, SHA-256 checksum and pointer of every downloaded file.
+# A file already on disk is only skipped if its size matches the manifest.
+MANIFEST_FILE = MIG_OUTPUT_FOLDER + "{}_manifest.sqlite".format(ALIAS)
+
+# Store the files with the same content once, as hard links. A file already downloaded
+# from the same pointer is linked without downloading it again.
+DEDUPLICATE = True
+
+# Instead of exporting, check the downloaded files against the manifest and download
+# again the missing ones and the ones whose size differs. With VERIFY_CHECKSUMS, the
+# checksums are compared too, which reads every file.
+VERIFY_DOWNLOADS = False
+VERIFY_CHECKSUMS = False
+
+# Files which fail to download are added to the failure ledger of the record export, and
+# removed from it once downloaded.
+FAILURES_FILE = MIG_INPUT_FOLDER + "{}_failures.sqlite".format(ALIAS)
+
+# Instead of exporting, download again the files of the failure ledger, or all the files
+# of the records with these pointers. Only these files are requested from CONTENTdm.
+RETRY_FAILED_DOWNLOADS = False
+REDOWNLOAD_POINTERS = []
+
+_manifest = None
+_manifest_lock = threading.Lock()
+_failure_ledger = None
+_failure_ledger_lock = threading.Lock()
+_disk_space_guard = None
+_disk_space_guard_lock = threading.Lock()
+
+
+def configure(alias, rel_path=None):
+    """
+    Point the exporter to another collection and local path, updating the settings
+    derived from them. Used when the script is imported instead of edited.
+    """
+    global ALIAS, REL_PATH, MIG_INPUT_FOLDER, MIG_OUTPUT_FOLDER, JOURNAL_FILE, MANIFEST_FILE
+    global FAILURES_FILE, _disk_space_guard
+
+    ALIAS = alias
+    if rel_path is not None:
+        REL_PATH = rel_path
+    MIG_INPUT_FOLDER = REL_PATH + 'output/'
+    MIG_OUTPUT_FOLDER = REL_PATH + "Download/"
+    JOURNAL_FILE = MIG_INPUT_FOLDER + "{}_journal.sqlite".format(ALIAS)
+    MANIFEST_FILE = MIG_OUTPUT_FOLDER + "{}_manifest.sqlite".format(ALIAS)
+    FAILURES_FILE = MIG_INPUT_FOLDER + "{}_failures.sqlite".format(ALIAS)
+    close_manifest()
+    close_failure_ledger()
+    _disk_space_guard = None
+
 
 def get_all_records_from_file(file_path):
+    """
+    Return the collection element of a structure file, with all its records. Kept for the
+    scripts which import it; the exporter streams the records with
+    iter_records_from_file().
+    """
     xml = parse(str(file_path))
     collection = xml.getroot()
     return collection
 
 
-def download_file(dmrecord, output_path, filename):
+def get_manifest():
+    """
+    Return the download manifest, opening it on first use.
+    """
+    global _manifest
+    with _manifest_lock:
+        if _manifest is None:
+            Path(MANIFEST_FILE).parent.mkdir(parents=True, exist_ok=True)
+            _manifest = DownloadManifest(MANIFEST_FILE)
+        return _manifest
+
+
+def close_manifest():
+    global _manifest
+    with _manifest_lock:
+        if _manifest is not None:
+            _manifest.close()
+            _manifest = None
+
+
+def get_failure_ledger():
+    """
+    Return the failure ledger, opening it on first use.
+    """
+    global _failure_ledger
+    with _failure_ledger_lock:
+        if _failure_ledger is None:
+            Path(FAILURES_FILE).parent.mkdir(parents=True, exist_ok=True)
+            _failure_ledger = FailureLedger(FAILURES_FILE)
+        return _failure_ledger
+
+
+def close_failure_ledger():
+    global _failure_ledger
+    with _failure_ledger_lock:
+        if _failure_ledger is not None:
+            _failure_ledger.close()
+            _failure_ledger = None
+
+
+def get_disk_space_guard():
+    """
+    Return the disk space guard of MIG_OUTPUT_FOLDER, creating it on first use.
+    """
+    global _disk_space_guard
+    with _disk_space_guard_lock:
+        if _disk_space_guard is None:
+            Path(MIG_OUTPUT_FOLDER).mkdir(parents=True, exist_ok=True)
+            _disk_space_guard = DiskSpaceGuard(MIG_OUTPUT_FOLDER, MIN_FREE_DISK_SPACE,
+                                               DISK_SPACE_CHECK_INTERVAL,
+                                               MAX_DISK_SPACE_WAIT)
+        return _disk_space_guard
+
+
+def get_manifest_path(local_file_name):
+    """
+    Files are identified in the manifest by their path relative to MIG_OUTPUT_FOLDER.
+    """
+    return Path(os.path.relpath(str(local_file_name), MIG_OUTPUT_FOLDER)).as_posix()
+
+
+def check_local_file(dmrecord, local_file_name):
+    """
+    Return True if the file on disk is complete according to the manifest. Files which
+    were downloaded before the manifest existed are added to it. A file whose size
+    differs from the manifest is removed, so that it is downloaded again.
+    """
+    manifest = get_manifest()
+    path = get_manifest_path(local_file_name)
+    entry = manifest.get(path)
+    size = local_file_name.stat().st_size
+    if entry is None:
+        manifest.add(path, dmrecord, size, None)
+        return True
+    if entry.size == size:
+        return True
+    print('File is corrupt ({} bytes instead of {}), downloading it again: {}'.format(
+        size, entry.size, local_file_name))
+    local_file_name.unlink()
+    manifest.remove(path)
+    return False
+
+
+def link_existing_file(entries, local_file_name):
+    """
+    Hard link local_file_name to the first file of the manifest entries which is still
+    intact. Return the entry of the linked file, or None if none could be linked.
+    """
+    for entry in entries:
+        existing_file_name = Path(MIG_OUTPUT_FOLDER, entry.path)
+        try:
+            if existing_file_name.stat().st_size != entry.size:
+                continue
+            os.link(str(existing_file_name), str(local_file_name))
+        except OSError:
+            # Missing file, another file system, or no hard links on this one.
+            continue
+        return entry
+    return None
+
+
+def load_partial_download(temp_file_name):
+    """
+    Return the information saved about an interrupted download, or None if there is
+    nothing to resume.
+    """
+    info_file_name = Path(str(temp_file_name) + '.json')
+    if not temp_file_name.is_file() or not info_file_name.is_file():
+        return None
+    with open(str(info_file_name)) as f:
+        info = json.load(f)
+    info['bytes_written'] = temp_file_name.stat().st_size
+    return info
+
+
+def save_partial_download(temp_file_name, info):
+    """
+    Save the expected size, validators and bytes written of a download next to its
+    temporary file, so an interrupted download can be resumed with a Range request.
+    """
+    with open(str(temp_file_name) + '.json', 'w') as f:
+        f.write(json.dumps(info))
+
+
+def remove_partial_download(temp_file_name):
+    for file_name in (temp_file_name, Path(str(temp_file_name) + '.json')):
+        if file_name.is_file():
+            file_name.unlink()
+
+
+def download_file(dmrecord, output_path, filename, redownload=False):
+    """
+    Export file from CONTENTdm. See _download_file() for the return value; the
+    duration and the result of the download are added to the metrics.
+    """
+    start = time.perf_counter()
+    result = _download_file(dmrecord, output_path, filename, redownload)
+    record_download(dmrecord, Path(output_path, filename), result,
+                    time.perf_counter() - start)
+    return result
+
+
+def record_download(dmrecord, local_file_name, result, duration):
+    """
+    Add the result and the duration of a download to the metrics, and the file to the
+    failure ledger if it could not be downloaded.
+    """
+    path = get_manifest_path(local_file_name)
+    if result is True:
+        status = 'downloaded'
+    elif result == 'local':
+        status = 'local'
+    elif result == 'Requested item not found':
+        status = 'not_found'
+    else:
+        status = 'failed'
+    observe('download_seconds', duration, status=status)
+    increment('files', status=status)
+    if status in ('downloaded', 'local'):
+        get_failure_ledger().remove_file(path)
+    else:
+        get_failure_ledger().add_file(path, dmrecord, result or 'Download failed')
+
+
+def skip_download(dmrecord, local_file_name):
+    """
+    Return the result of the download if the file does not need to be downloaded: 'local'
+    if it is already on disk, True if it was linked to the same file downloaded for
+    another record. Return None if the file must be downloaded.
+    """
+    # A file whose size does not match the manifest is removed and downloaded again.
+    if local_file_name.is_file() and check_local_file(dmrecord, local_file_name):
+        # TIND specific usage as we import the function from another script.
+        return 'local'
+
+    # The file was already downloaded from the same pointer for another record.
+    if DEDUPLICATE:
+        manifest = get_manifest()
+        entry = link_existing_file(manifest.find_by_pointer(dmrecord), local_file_name)
+        if entry:
+            manifest.add(get_manifest_path(local_file_name), dmrecord, entry.size,
+                         entry.sha256)
+            increment('files_deduplicated', by='pointer')
+            return True
+    return None
+
+
+def get_download_url(dmrecord, filename):
+    return FILE_URL + ALIAS + '/id/' + dmrecord + '/filename/' + filename
+
+
+def get_download_size(dmrecord, output_path, filename, redownload=False):
+    """
+    Return the number of bytes the download will write, or None if unknown. The size
+    is taken from the manifest or the interrupted download, or from a HEAD request with
+    LOOKUP_FILE_SIZES.
+    """
+    local_file_name = Path(output_path, filename)
+    if local_file_name.is_file() and not redownload:
+        return 0
+    manifest = get_manifest()
+    entry = manifest.get(get_manifest_path(local_file_name))
+    if entry:
+        return entry.size
+    entries = manifest.find_by_pointer(dmrecord)
+    if entries:
+        # The file will be linked to the one already downloaded.
+        return 0 if DEDUPLICATE else entries[0].size
+    info = load_partial_download(Path(output_path, filename + '.part'))
+    if info and info['expected_size']:
+        return info['expected_size'] - info['bytes_written']
+    if not LOOKUP_FILE_SIZES:
+        return None
+    try:
+        with head(get_download_url(dmrecord, filename), retries=1,
+                  headers={'Accept-Encoding': 'identity'}) as response:
+            content_length = response.headers.get('Content-Length')
+            if response.status_code == 200 and content_length and content_length.isdigit():
+                return int(content_length)
+    except ContentdmRequestError:
+        pass
+    return None
+
+
+def get_download_sizes(downloads, redownload=False):
+    """
+    Return the sizes of the downloads, see get_download_size().
+    """
+    with ThreadPoolExecutor(max_workers=NUM_DOWNLOAD_WORKERS) as executor:
+        return list(executor.map(lambda download: get_download_size(*download, redownload),
+                                 downloads))
+
+
+def get_download_request(dmrecord, filename, temp_file_name):
+    """
+    Return the url, the headers and the saved information of the download. An
+    interrupted download is resumed with a Range request; If-Range makes the server send
+    the whole file again if it changed since.
+    """
+    download_url = get_download_url(dmrecord, filename)
+
+    # Ranges and sizes are only reliable on the raw bytes, so no compression.
+    headers = {'Accept-Encoding': 'identity'}
+    info = load_partial_download(temp_file_name)
+    if info and info['bytes_written']:
+        headers['Range'] = 'bytes={}-'.format(info['bytes_written'])
+        if info.get('etag') or info.get('last_modified'):
+            headers['If-Range'] = info.get('etag') or info.get('last_modified')
+    return download_url, headers, info
+
+
+def get_error_result(dmrecord, body):
+    """
+    Return the result of a download which got an error response.
+    """
+    if body == 'Requested item not found':
+        print('File does not exists. Record: ', dmrecord)
+        return 'Requested item not found'
+    return False
+
+
+def is_requested_range(info, response_headers):
+    """
+    Return whether a 206 response starts where the interrupted download stopped, or at
+    the start of the file for a new download. Any other range can not be written to the
+    partial file.
+    """
+    bytes_written = info['bytes_written'] if info else 0
+    return response_headers.get('Content-Range', '').startswith(
+        'bytes {}-'.format(bytes_written))
+
+
+def start_download(local_file_name, temp_file_name, info, status_code, response_headers):
+    """
+    Return the information of the download, the number of bytes already written and
+    the hasher, once the server answered with a 200, or a 206 with the range we asked
+    for (see is_requested_range()). A download resumes where it stopped if the server
+    sent that range; otherwise it starts over.
+    """
+    expected_size = response_headers.get('Content-Length')
+    if status_code == 206:
+        # Content-Range ends with the total size of the file.
+        expected_size = response_headers.get('Content-Range', '').rpartition('/')[2]
+        if info and info['bytes_written']:
+            print('Resuming download at {} bytes: {}'.format(info['bytes_written'],
+                                                             local_file_name))
+            if expected_size.isdigit():
+                info['expected_size'] = int(expected_size)
+            return info, info['bytes_written'], hash_file(temp_file_name)
+
+    # A new download, or the server ignored the Range header and sent the whole file.
+    if expected_size and expected_size.isdigit():
+        expected_size = int(expected_size)
+    else:
+        expected_size = None
+    info = {'expected_size': expected_size,
+            'etag': response_headers.get('ETag'),
+            'last_modified': response_headers.get('Last-Modified'),
+            'bytes_written': 0}
+    save_partial_download(temp_file_name, info)
+    return info, 0, hashlib.sha256()
+
+
+def finish_download(dmrecord, local_file_name, temp_file_name, info, size, hasher):
+    """
+    Check the size of the downloaded file, move it in place or link it to a file with
+    the same content, and add it to the manifest. Return the result of the download.
+    """
+    if info['expected_size'] and size != info['expected_size']:
+        info['bytes_written'] = size
+        save_partial_download(temp_file_name, info)
+        print('File download incomplete ({} of {} bytes): {}'.format(
+            size, info['expected_size'], local_file_name))
+        return False
+
+    if size < 1000:
+        with open(str(temp_file_name), 'rb') as f:
+            if f.read() == b'Requested item not found':
+                remove_partial_download(temp_file_name)
+                print('File does not exists. Record: ', dmrecord)
+                return 'Requested item not found'
+
+    # Store the same content once.
+    manifest = get_manifest()
+    sha256 = hasher.hexdigest()
+    if DEDUPLICATE and link_existing_file(manifest.find_by_checksum(sha256, size),
+                                          local_file_name):
+        increment('files_deduplicated', by='checksum')
+    else:
+        temp_file_name.replace(local_file_name)
+    remove_partial_download(temp_file_name)
+    manifest.add(get_manifest_path(local_file_name), dmrecord, size, sha256)
+    return True
+
+
+def _download_file(dmrecord, output_path, filename, redownload=False):
     """
     Export file from CONTENTdm
     filename is the parameter in the CONTENTdm query which defines the local file
     name. It has nothing to do with what the name is on the server.
+    The file is streamed to a temporary file which is renamed once complete, so an
+    interrupted download never leaves a truncated file behind. The next run resumes an
+    interrupted download where it stopped, if the server supports Range requests.
+    The checksum is computed while streaming, and the file is added to the manifest.
+    With redownload, a file already on disk is downloaded again, and only replaced once
+    the new download is complete.
     """
     local_file_name = Path(output_path, filename)
+    temp_file_name = Path(output_path, filename + '.part')
 
     # If the file already exists, skip downloading it again.
-    if not local_file_name.is_file():
-        download_url = FILE_URL + ALIAS + '/id/' + dmrecord + '/filename/' + filename
-        # Download file
-        try:
-            req = requests.get(download_url, timeout=3600)
-            if len(req.content) < 1000:
-                if req.text == 'Requested item not found':
-                    print('File does not exists. Record: ', dmrecord)
-                    return 'Requested item not found'
-            if req.status_code == 200:
-                with open(str(local_file_name), 'wb') as f:
-                    f.write(req.content)
-                return True
-            else:
-                return False
-        except requests.exceptions.Timeout as e:
-            print('File download timeout: ', e)
-            return e
-        return False
-    else:
-        # TIND specific usage as we import the function from another script.
-        return 'local'
+    if not redownload:
+        result = skip_download(dmrecord, local_file_name)
+        if result is not None:
+            return result
+
+    download_url, headers, info = get_download_request(dmrecord, filename, temp_file_name)
+
+    # Download file
+    size = 0
+    try:
+        with get(download_url, timeout=(CONNECT_TIMEOUT, 3600), stream=True,
+                 headers=headers) as req:
+            if req.status_code == 416:
+                # The server does not accept our range; start over.
+                remove_partial_download(temp_file_name)
+                return _download_file(dmrecord, output_path, filename, redownload)
+            if req.status_code not in (200, 206):
+                return get_error_result(dmrecord, req.text)
+            if req.status_code == 206 and not is_requested_range(info, req.headers):
+                if not info or not info['bytes_written']:
+                    print('Unexpected range {} for a new download: {}'.format(
+                        req.headers.get('Content-Range'), local_file_name))
+                    return False
+                # The range is not the one we asked for; start over.
+                remove_partial_download(temp_file_name)
+                return _download_file(dmrecord, output_path, filename, redownload)
+
+            info, size, hasher = start_download(local_file_name, temp_file_name, info,
+                                                req.status_code, req.headers)
+            bandwidth_limiter = get_bandwidth_limiter()
+            with open(str(temp_file_name), 'ab' if size else 'wb') as f:
+                for block in req.iter_content(DOWNLOAD_BLOCK_SIZE):
+                    f.write(block)
+                    hasher.update(block)
+                    size += len(block)
+                    increment('download_bytes', len(block))
+                    bandwidth_limiter.acquire(len(block))
+    except ContentdmRequestError as e:
+        print('File download failed: ', e)
+        return e
+    except requests.exceptions.RequestException as e:
+        # The connection broke in the middle of the transfer. Keep what we have for
+        # the next run.
+        if info:
+            info['bytes_written'] = size
+            save_partial_download(temp_file_name, info)
+        print('File download failed: ', e)
+        return e
+
+    return finish_download(dmrecord, local_file_name, temp_file_name, info, size, hasher)
+
+
+def download_files(downloads, redownload=False):
+    """
+    Download the files concurrently, scheduled by size. downloads is a list of
+    (dmrecord, output_path, filename) as returned by get_record_downloads(). The result
+    of the files not downloaded because the disk is full is None. See _download_file()
+    for redownload.
+    """
+    scheduler = TransferScheduler(partial(download_file, redownload=redownload),
+                                  NUM_DOWNLOAD_WORKERS, LARGE_FILE_SIZE,
+                                  MAX_LARGE_TRANSFERS, get_disk_space_guard())
+    results = scheduler.run(downloads, get_download_sizes(downloads, redownload))
+    num_not_started = sum(1 for result in results if result is None)
+    if num_not_started:
+        print('{} files were not downloaded for lack of disk space'.format(num_not_started))
+    return results
+
+
+def verify_downloads():
+    """
+    Check the downloaded files against the manifest, and download again the files which
+    are missing or whose size differs. With VERIFY_CHECKSUMS, the files are also
+    checksummed. Return the results of the downloads.
+    """
+    manifest = get_manifest()
+    downloads = []
+    entries = manifest.get_entries()
+    for entry in entries:
+        local_file_name = Path(MIG_OUTPUT_FOLDER, entry.path)
+        if not local_file_name.is_file():
+            problem = 'Missing file'
+        elif local_file_name.stat().st_size != entry.size:
+            problem = 'Wrong size'
+        elif VERIFY_CHECKSUMS:
+            sha256 = hash_file(local_file_name).hexdigest()
+            if entry.sha256 is None:
+                # The file was on disk before the manifest existed; record its checksum.
+                manifest.add(entry.path, entry.pointer, entry.size, sha256)
+                continue
+            if sha256 == entry.sha256:
+                continue
+            problem = 'Wrong checksum'
+        else:
+            continue
+
+        print('{}: {}'.format(problem, local_file_name))
+        if local_file_name.is_file():
+            local_file_name.unlink()
+        manifest.remove(entry.path)
+        downloads.append((entry.pointer, local_file_name.parent, local_file_name.name))
+
+    print('Downloading {} of {} files again'.format(len(downloads), len(entries)))
+    results = download_files(downloads)
+    close_manifest()
+    close_failure_ledger()
+    return results
 
 
 def get_page_info(elem):
+    """
+    Return whether a page element is a page of a PDF, its pageptr and the path of its
+    file. Kept for the scripts which import it; the exporter uses the page index of
+    contentdm_structure.py.
+    """
     has_pdfpage = False
     page_recid = ''
     pathinfo = None
@@ -97,100 +639,154 @@ def get_page_info(elem):
     return has_pdfpage, page_recid, pathinfo
 
 
-if __name__ == '__main__':
+def get_record_downloads(record, pages=None):
+    """
+    Create the local folder of the record and return the files to download as a list of
+    (dmrecord, output_path, filename). pages is the page index of the record if it is
+    known; otherwise the compound object is walked.
+    """
+    downloads = []
+
+    # Decide about local path to download files
+    dmrecord = record.xpath('dmrecord')[0].text  # We could also have used cdmid
+
+    output_path = Path(MIG_OUTPUT_FOLDER)
+    if not output_path.is_dir():
+        output_path.mkdir()
+
+    output_path = Path(MIG_OUTPUT_FOLDER, ALIAS)
+    if not output_path.is_dir():
+        output_path.mkdir()
+    output_path = Path(output_path, '{:06}'.format(int(dmrecord)))
+    if not output_path.is_dir():
+        output_path.mkdir()
+
+    # Check if the record has an element "structure" with children
+    structures = record.xpath('structure')
+    if structures and len(structures[0]) > 0:
+        download_pdf = False
+        # First, let's check that it is only one element in structure
+        if len(structures) > 1:
+            print('We have multiple structure elements! ', dmrecord)
+
+        if pages is None:
+            pages = get_page_index(structures[0])
+
+        # We have children
+        # if this is a pdf compound object with '.pdfpage' children we need to handle
+        # things differently
+        j = 1
+        for page in pages:
+            if page.pagefile and page.pagefile.endswith('.pdfpage'):
+                download_pdf = True
+            else:
+                # this is a normal compound object
+                filename = '{:06}_{:06}{}'.format(int(dmrecord),
+                                                  j,
+                                                  Path(page.pagefile or '').suffix)
+
+                downloads.append((page.pageptr, output_path, filename))
+                j += 1
+
+        if download_pdf:
+            # use the parent dmrecord to get the full pdf
+            filename = '{:06}_{:06}{}'.format(int(dmrecord),
+                                              1,
+                                              '.pdf')
+
+            downloads.append((dmrecord, output_path, filename))
+
+    else:
+        # This is a single item
+        pathinfo = Path(record.xpath('find')[0].text)
+
+        extension = pathinfo.suffix
+
+        filename = '{:06}_{:06}{}'.format(int(dmrecord),
+                                          1,
+                                          extension)
+
+        downloads.append((dmrecord, output_path, filename))
+
+    return downloads
+
+
+def get_file_downloads(file_path, journal=None):
+    """
+    Return the files to download for all the records of a structure file. The page
+    index of the records is taken from the journal when possible.
+    """
+    # Loop through records and collect their files. The records are read one at a
+    # time to keep the memory use flat.
+    downloads = []
+    for i, record in enumerate(iter_records_from_file(file_path)):
+        print(i)
+        pages = journal.get_pages(record.findtext('cdmid')) if journal else None
+        downloads.extend(get_record_downloads(record, pages))
+    return downloads
+
+
+def run_file_export():
+    """
+    Download the files of all the records of the structure files in MIG_INPUT_FOLDER.
+    """
+    journal = ExportJournal(JOURNAL_FILE) if Path(JOURNAL_FILE).is_file() else None
+
     # Loop through all files in path, except DS_Store (MacOS specific files).
+    # The downloads of all the structure files are scheduled together, so that a large
+    # file does not hold up the files of the next structure files.
     input_folder = Path(MIG_INPUT_FOLDER)
+    downloads = []
     for file_path in sorted(input_folder.glob('*.xml')):
+        downloads.extend(get_file_downloads(file_path, journal))
+    download_files(downloads)
+    if get_disk_space_guard().stopped:
+        print('Downloads stopped for lack of disk space. Free some space and run the '
+              'script again to download the rest.')
 
-        collection = get_all_records_from_file(file_path)
-        # Loop through records
-        for i, record in enumerate(collection):
-            print(i)
-            # Decide about local path to download files
-            dmrecord = record.xpath('dmrecord')[0].text  # We could also have used cdmid
-
-            output_path = Path(MIG_OUTPUT_FOLDER)
-            if not output_path.is_dir():
-                output_path.mkdir()
-
-            output_path = Path(MIG_OUTPUT_FOLDER, ALIAS)
-            if not output_path.is_dir():
-                output_path.mkdir()
-            output_path = Path(output_path, '{:06}'.format(int(dmrecord)))
-            if not output_path.is_dir():
-                output_path.mkdir()
-
-            # Check if the record has an element "structure" with children
-            structures = record.xpath('structure')
-            if structures and len(structures[0]) > 0:
-                download_pdf = False
-                # First, let's check that it is only one element in structure
-                if len(structures) > 1:
-                    print('We have multiple structure elements! ', dmrecord)
-
-                # We have children
-                # if this is a pdf compound object with '.pdfpage' children we need to handle
-                # things differently
-                j = 1
-                for elem in structures[0]:
-                    if elem.tag == 'page':
-                        has_pdfpage, page_recid, pathinfo = get_page_info(elem)
-                        if has_pdfpage:
-                            download_pdf = True
-                        else:
-                            # this is a normal compound object
-                            filename = '{:06}_{:06}{}'.format(int(dmrecord),
-                                                              j,
-                                                              pathinfo.suffix)
-
-                            download_file(page_recid, output_path, filename)
-                            j += 1
-
-                    if elem.tag == 'node':
-                        for sub_elem in elem:
-                            if sub_elem.tag == 'page':
-                                has_pdfpage, page_recid, pathinfo = get_page_info(sub_elem)
-                                if has_pdfpage:
-                                    download_pdf = True
-                                else:
-                                    # this is a normal compound object
-                                    filename = '{:06}_{:06}{}'.format(int(page_recid),
-                                                                      j,
-                                                                      pathinfo.suffix)
-
-                                    download_file(page_recid, output_path, filename)
-                                    j += 1
-                            if sub_elem.tag == 'node':
-                                for sub_sub_elem in sub_elem:
-                                    if sub_sub_elem.tag == 'page':
-                                        has_pdfpage, page_recid, pathinfo = get_page_info(sub_sub_elem)
-                                        if has_pdfpage:
-                                            download_pdf = True
-                                        else:
-                                            # this is a normal compound object
-                                            filename = '{:06}_{:06}{}'.format(int(dmrecord),
-                                                                              j,
-                                                                              pathinfo.suffix)
-
-                                            download_file(page_recid, output_path, filename)
-                                            j += 1
-
-                if download_pdf:
-                    # use the parent dmrecord to get the full pdf
-                    filename = '{:06}_{:06}{}'.format(int(dmrecord),
-                                                      1,
-                                                      '.pdf')
-
-                    download_file(dmrecord, output_path, filename)
+    if journal:
+        journal.close()
+    close_manifest()
+    close_failure_ledger()
 
-            else:
-                # This is a single item
-                pathinfo = Path(record.xpath('find')[0].text)
 
-                extension = pathinfo.suffix
+def retry_failed_downloads(pointers=None):
+    """
+    Download again the files of the failure ledger, or all the files of the records with
+    the pointers if given. The records are taken from the journal of the record export.
+    """
+    downloads = []
+    if pointers is None:
+        for failure in get_failure_ledger().get_files():
+            local_file_name = Path(MIG_OUTPUT_FOLDER, failure.path)
+            downloads.append((failure.pointer, local_file_name.parent, local_file_name.name))
+    else:
+        journal = ExportJournal(JOURNAL_FILE)
+        for pointer in pointers:
+            exported_record = journal.get_record(str(pointer))
+            if exported_record is None:
+                print('Record {} is not in the journal of the record export'.format(pointer))
+                continue
+            xml, pages = exported_record
+            downloads.extend(get_record_downloads(fromstring(xml), pages))
+        journal.close()
+
+    print('Downloading {} files again'.format(len(downloads)))
+    # The files on disk are only replaced by complete downloads.
+    results = download_files(downloads, redownload=pointers is not None)
+    num_downloaded = sum(1 for result in results if result is True)
+    print('{} files downloaded, {} failed'.format(num_downloaded,
+                                                  len(results) - num_downloaded))
+    close_manifest()
+    close_failure_ledger()
+    return results
 
-                filename = '{:06}_{:06}{}'.format(int(dmrecord),
-                                                  1,
-                                                  extension)
 
-                download_file(dmrecord, output_path, filename)
+if __name__ == '__main__':
+    with reporting():
+        if VERIFY_DOWNLOADS:
+            verify_downloads()
+        elif RETRY_FAILED_DOWNLOADS or REDOWNLOAD_POINTERS:
+            retry_failed_downloads(REDOWNLOAD_POINTERS or None)
+        else:
+            run_file_export()
@@ -0,0 +1,187 @@
+# Copyright (C) 2021 TIND.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+Progress journal of the record export. Every exported record is stored in a SQLite
+database as soon as it is fetched, and every chunk is marked as done once its
+structure file is written. An interrupted export can then skip the finished chunks
+and resume in the middle of the chunk it was working on.
+"""
+
+import datetime
+import json
+import sqlite3
+import threading
+from contentdm_structure import load_page_index
+
+
+class ExportJournal(object):
+
+    def __init__(self, path):
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(path), check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS chunks ('
+                           'chunk INTEGER PRIMARY KEY, '
+                           'start_at INTEGER, '
+                           'num_records INTEGER)')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS records ('
+                           'chunk INTEGER, '
+                           'position INTEGER, '
+                           'pointer TEXT, '
+                           'xml BLOB, '
+                           'page_metadata TEXT, '
+                           'pages TEXT, '
+                           'PRIMARY KEY (chunk, position))')
+        # Journals of earlier versions have no page index.
+        columns = [row[1] for row in self._conn.execute('PRAGMA table_info(records)')]
+        if 'pages' not in columns:
+            self._conn.execute('ALTER TABLE records ADD COLUMN pages TEXT')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS records_pointer ON records (pointer)')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS state ('
+                           'key TEXT PRIMARY KEY, '
+                           'value TEXT)')
+        self._conn.commit()
+
+    def get_export_date(self):
+        """
+        Return the date the output is up to date with, or None for a new export.
+        """
+        with self._lock:
+            row = self._conn.execute('SELECT value FROM state WHERE key = ?',
+                                     ('export_date',)).fetchone()
+        return datetime.datetime.strptime(row[0], '%Y%m%d').date() if row else None
+
+    def set_export_date(self, export_date):
+        with self._lock:
+            self._conn.execute('INSERT OR REPLACE INTO state VALUES (?, ?)',
+                               ('export_date', export_date.strftime('%Y%m%d')))
+            self._conn.commit()
+
+    def is_chunk_done(self, chunk):
+        with self._lock:
+            row = self._conn.execute('SELECT 1 FROM chunks WHERE chunk = ?',
+                                     (chunk,)).fetchone()
+        return row is not None
+
+    def get_chunk(self, chunk):
+        """
+        Return (start_at, num_records) of the chunk if it is done, or None.
+        """
+        with self._lock:
+            return self._conn.execute('SELECT start_at, num_records FROM chunks '
+                                      'WHERE chunk = ?', (chunk,)).fetchone()
+
+    def get_records(self, chunk):
+        """
+        Return a dict of position: (pointer, xml, page_metadata, pages) for the records
+        of the chunk already exported. pages is the page index of the record, or None if
+        it was exported by an earlier version.
+        """
+        with self._lock:
+            rows = self._conn.execute('SELECT position, pointer, xml, page_metadata, pages '
+                                      'FROM records WHERE chunk = ?',
+                                      (chunk,)).fetchall()
+        return {position: (pointer, xml, json.loads(page_metadata), load_pages(pages))
+                for position, pointer, xml, page_metadata, pages in rows}
+
+    def add_record(self, chunk, position, pointer, xml, page_metadata, pages=None):
+        with self._lock:
+            self._conn.execute('INSERT OR REPLACE INTO records VALUES (?, ?, ?, ?, ?, ?)',
+                               (chunk, position, pointer, xml, json.dumps(page_metadata),
+                                None if pages is None else json.dumps(pages)))
+            self._conn.commit()
+
+    def remove_records(self, chunk, from_position):
+        """
+        Remove the records of the chunk from the position on, e.g. those left by an
+        earlier export of the chunk with more records.
+        """
+        with self._lock:
+            self._conn.execute('DELETE FROM records WHERE chunk = ? AND position >= ?',
+                               (chunk, from_position))
+            self._conn.commit()
+
+    def get_pages(self, pointer):
+        """
+        Return the page index of the record with the pointer, or None if it is unknown.
+        """
+        with self._lock:
+            row = self._conn.execute('SELECT pages FROM records '
+                                     'WHERE pointer = ? ORDER BY chunk DESC',
+                                     (pointer,)).fetchone()
+        return load_pages(row[0]) if row else None
+
+    def get_record(self, pointer):
+        """
+        Return (xml, pages) of the record with the pointer, or None if the record was
+        never exported.
+        """
+        with self._lock:
+            row = self._conn.execute('SELECT xml, pages FROM records '
+                                     'WHERE pointer = ? ORDER BY chunk DESC',
+                                     (pointer,)).fetchone()
+        return (row[0], load_pages(row[1])) if row else None
+
+    def get_pointer(self, chunk, position):
+        """
+        Return the pointer of the record exported at the position of the chunk, or None.
+        """
+        with self._lock:
+            row = self._conn.execute('SELECT pointer FROM records '
+                                     'WHERE chunk = ? AND position = ?',
+                                     (chunk, position)).fetchone()
+        return row[0] if row else None
+
+    def find_record(self, pointer):
+        """
+        Return (chunk, position) of the record with the pointer, or None if the record
+        was never exported.
+        """
+        with self._lock:
+            return self._conn.execute('SELECT chunk, position FROM records '
+                                      'WHERE pointer = ? ORDER BY chunk DESC',
+                                      (pointer,)).fetchone()
+
+    def get_last_chunk(self):
+        with self._lock:
+            row = self._conn.execute('SELECT MAX(chunk) FROM chunks').fetchone()
+        return row[0] or 0
+
+    def remove_chunk(self, chunk):
+        with self._lock:
+            self._conn.execute('DELETE FROM chunks WHERE chunk = ?', (chunk,))
+            self._conn.execute('DELETE FROM records WHERE chunk = ?', (chunk,))
+            self._conn.commit()
+
+    def mark_chunk_done(self, chunk, start_at, num_records):
+        with self._lock:
+            self._conn.execute('INSERT OR REPLACE INTO chunks VALUES (?, ?, ?)',
+                               (chunk, start_at, num_records))
+            self._conn.commit()
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+def load_pages(pages):
+    return None if pages is None else load_page_index(json.loads(pages))
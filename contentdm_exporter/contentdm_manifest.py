@@ -0,0 +1,118 @@
+# Copyright (C) 2021 TIND.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+"""
+Manifest of the downloaded files, stored in SQLite. It records the size, the SHA-256
+checksum and the CONTENTdm pointer of every file, so downloads can be verified without
+querying CONTENTdm, and files with the same content can be stored once.
+"""
+
+import hashlib
+import sqlite3
+import threading
+import time
+from collections import namedtuple
+
+# Files are read in blocks of this many bytes to compute their checksum.
+HASH_BLOCK_SIZE = 1024 * 1024
+
+ManifestEntry = namedtuple('ManifestEntry', ['path', 'pointer', 'size', 'sha256'])
+
+
+class DownloadManifest(object):
+    """
+    The files are identified by their path relative to the download folder. sha256 is
+    None for files found on disk but not downloaded by us, until they are verified.
+    """
+
+    def __init__(self, path):
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(path), check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS files ('
+                           'path TEXT PRIMARY KEY, '
+                           'pointer TEXT, '
+                           'size INTEGER, '
+                           'sha256 TEXT, '
+                           'added REAL)')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS files_sha256 ON files (sha256)')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS files_pointer ON files (pointer)')
+        self._conn.commit()
+
+    def get(self, path):
+        with self._lock:
+            row = self._conn.execute('SELECT path, pointer, size, sha256 FROM files '
+                                     'WHERE path = ?', (path,)).fetchone()
+        return ManifestEntry(*row) if row else None
+
+    def add(self, path, pointer, size, sha256):
+        with self._lock:
+            self._conn.execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?)',
+                               (path, pointer, size, sha256, time.time()))
+            self._conn.commit()
+
+    def remove(self, path):
+        with self._lock:
+            self._conn.execute('DELETE FROM files WHERE path = ?', (path,))
+            self._conn.commit()
+
+    def find_by_checksum(self, sha256, size):
+        """
+        Return the entries of the files with this content.
+        """
+        with self._lock:
+            rows = self._conn.execute('SELECT path, pointer, size, sha256 FROM files '
+                                      'WHERE sha256 = ? AND size = ?',
+                                      (sha256, size)).fetchall()
+        return [ManifestEntry(*row) for row in rows]
+
+    def find_by_pointer(self, pointer):
+        """
+        Return the entries of the files downloaded from this pointer.
+        """
+        with self._lock:
+            rows = self._conn.execute('SELECT path, pointer, size, sha256 FROM files '
+                                      'WHERE pointer = ? AND sha256 IS NOT NULL',
+                                      (pointer,)).fetchall()
+        return [ManifestEntry(*row) for row in rows]
+
+    def get_entries(self):
+        with self._lock:
+            rows = self._conn.execute('SELECT path, pointer, size, sha256 FROM files '
+                                      'ORDER BY path').fetchall()
+        return [ManifestEntry(*row) for row in rows]
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+def hash_file(file_path, hasher=None):
+    """
+    Return the SHA-256 hasher updated with the content of the file.
+    """
+    if hasher is None:
+        hasher = hashlib.sha256()
+    with open(str(file_path), 'rb') as f:
+        for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b''):
+            hasher.update(block)
+    return hasher
@@ -0,0 +1,335 @@
+# Copyright (C) 2021 TIND.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+"""
+Metrics of an export run: latency histograms and counters of the API calls, parsing,
+writes and downloads, and the progress of the export with an ETA.
+
+The exporters record what they do with timer(), observe() and increment(). While an
+export runs, a reporter thread prints the progress and writes a summary of the metrics
+to METRICS_FILE every METRICS_INTERVAL seconds, as JSON or in the Prometheus text format.
+"""
+
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+# Settings
+
+# Path of the file the metrics are written to, e.g.
+# "/Users/Demo/migration/my_project/output/metrics.json". None disables it.
+METRICS_FILE = None
+
+# 'json' for a JSON summary, 'prometheus' for the Prometheus text format (e.g. for the
+# textfile collector of the node exporter).
+METRICS_FORMAT = 'json'
+
+# Seconds between two reports of the progress and the metrics.
+METRICS_INTERVAL = 30
+
+# Upper bounds in seconds of the buckets of the latency histograms.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+
+class Histogram(object):
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # The last one is +Inf.
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                break
+        else:
+            i = len(self.buckets)
+        self.counts[i] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q):
+        """
+        Estimate the q quantile as the upper bound of the bucket it falls in.
+        """
+        if not self.count:
+            return None
+        rank = q * self.count
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            if cumulative >= rank:
+                return bound
+        return float('inf')
+
+
+class Metrics(object):
+    """
+    The counters and histograms of a run, each identified by a name and labels.
+    """
+
+    def __init__(self):
+        self.start_time = time.time()
+        self.total_records = None
+        self._counters = {}
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+    def increment(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, seconds, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            if key not in self._histograms:
+                self._histograms[key] = Histogram(LATENCY_BUCKETS)
+            self._histograms[key].observe(seconds)
+
+    def get_counter(self, name, **labels):
+        """
+        Return the sum of the counters of a name matching the labels.
+        """
+        with self._lock:
+            return sum(value for (counter_name, counter_labels), value in self._counters.items()
+                       if counter_name == name
+                       and all(item in counter_labels for item in labels.items()))
+
+    def get_progress(self):
+        """
+        Return the progress of the record export. The rate only counts the records
+        exported in this run, not the ones skipped because they were already exported.
+        """
+        elapsed = time.time() - self.start_time
+        done = self.get_counter('records')
+        exported = self.get_counter('records', status='exported')
+        rate = exported / elapsed if elapsed > 0 else 0
+        progress = {'elapsed_seconds': elapsed,
+                    'records_done': done,
+                    'records_expected': self.total_records,
+                    'records_per_second': rate,
+                    'pages_per_second': self.get_counter('pages') / elapsed if elapsed > 0 else 0,
+                    'download_bytes_per_second':
+                        self.get_counter('download_bytes') / elapsed if elapsed > 0 else 0,
+                    'eta_seconds': None}
+        if self.total_records and rate:
+            progress['eta_seconds'] = max(0, self.total_records - done) / rate
+        return progress
+
+    def to_json(self):
+        with self._lock:
+            counters = {}
+            for (name, labels), value in sorted(self._counters.items()):
+                counters.setdefault(name, {})[format_labels(labels)] = value
+            histograms = {}
+            for (name, labels), histogram in sorted(self._histograms.items()):
+                histograms.setdefault(name, {})[format_labels(labels)] = {
+                    'count': histogram.count,
+                    'sum': histogram.sum,
+                    'mean': histogram.sum / histogram.count,
+                    'p50': histogram.quantile(0.5),
+                    'p95': histogram.quantile(0.95),
+                    'p99': histogram.quantile(0.99)}
+        return json.dumps({'time': time.time(),
+                           'progress': self.get_progress(),
+                           'counters': counters,
+                           'histograms': histograms}, indent=2)
+
+    def to_prometheus(self):
+        lines = []
+        with self._lock:
+            seen = set()
+            for (name, labels), value in sorted(self._counters.items()):
+                metric = 'contentdm_{}_total'.format(name)
+                if metric not in seen:
+                    seen.add(metric)
+                    lines.append('# TYPE {} counter'.format(metric))
+                lines.append('{}{} {}'.format(metric, format_prometheus_labels(labels), value))
+            for (name, labels), histogram in sorted(self._histograms.items()):
+                metric = 'contentdm_{}'.format(name)
+                if metric not in seen:
+                    seen.add(metric)
+                    lines.append('# TYPE {} histogram'.format(metric))
+                cumulative = 0
+                for bound, count in zip(histogram.buckets + ('+Inf',), histogram.counts):
+                    cumulative += count
+                    lines.append('{}_bucket{} {}'.format(
+                        metric, format_prometheus_labels(labels + (('le', str(bound)),)),
+                        cumulative))
+                lines.append('{}_sum{} {}'.format(metric, format_prometheus_labels(labels),
+                                                  histogram.sum))
+                lines.append('{}_count{} {}'.format(metric, format_prometheus_labels(labels),
+                                                    histogram.count))
+
+        progress = self.get_progress()
+        for name in ('records_expected', 'records_per_second', 'pages_per_second',
+                     'download_bytes_per_second', 'eta_seconds'):
+            if progress[name] is not None:
+                lines.append('# TYPE contentdm_{} gauge'.format(name))
+                lines.append('contentdm_{} {}'.format(name, progress[name]))
+        return '\n'.join(lines) + '\n'
+
+
+def format_labels(labels):
+    return ','.join('{}={}'.format(name, value) for name, value in labels)
+
+
+def format_prometheus_labels(labels):
+    if not labels:
+        return ''
+    return '{{{}}}'.format(','.join('{}="{}"'.format(name, value) for name, value in labels))
+
+
+def format_duration(seconds):
+    seconds = int(seconds)
+    return '{}:{:02}:{:02}'.format(seconds // 3600, seconds // 60 % 60, seconds % 60)
+
+
+_metrics = Metrics()
+_reporter = None
+_reporter_users = 0
+_reporter_stop = threading.Event()
+_lock = threading.Lock()
+
+
+def reset():
+    """
+    Start over with empty metrics. Called in the child after a fork, so every process
+    reports its own metrics.
+    """
+    global _metrics, _reporter, _reporter_users, _reporter_stop, _lock
+    _metrics = Metrics()
+    _reporter = None
+    _reporter_users = 0
+    _reporter_stop = threading.Event()
+    _lock = threading.Lock()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=reset)
+
+
+def get_metrics():
+    return _metrics
+
+
+def increment(name, value=1, **labels):
+    _metrics.increment(name, value, **labels)
+
+
+def observe(name, seconds, **labels):
+    _metrics.observe(name, seconds, **labels)
+
+
+@contextmanager
+def timer(name, **labels):
+    """
+    Observe the time spent in the block in the histogram name.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        _metrics.observe(name, time.perf_counter() - start, **labels)
+
+
+def set_total_records(total):
+    """
+    Set the number of records the export is expected to go through, for the ETA.
+    """
+    _metrics.total_records = total
+
+
+def report():
+    """
+    Print the progress and write the metrics to METRICS_FILE.
+    """
+    progress = _metrics.get_progress()
+    if progress['records_expected']:
+        line = 'Progress: {} of {} records, {:.1f} records/s'.format(
+            progress['records_done'], progress['records_expected'],
+            progress['records_per_second'])
+        if progress['eta_seconds'] is not None:
+            line += ', ETA ' + format_duration(progress['eta_seconds'])
+        print(line)
+
+    if METRICS_FILE:
+        if METRICS_FORMAT == 'prometheus':
+            content = _metrics.to_prometheus()
+        else:
+            content = _metrics.to_json()
+        # Readers never see a half written file.
+        temp_file_path = Path(str(METRICS_FILE) + '.part')
+        with open(str(temp_file_path), 'w') as f:
+            f.write(content)
+        temp_file_path.replace(METRICS_FILE)
+
+
+def _run_reporter(stop):
+    while not stop.wait(METRICS_INTERVAL):
+        report()
+
+
+def start_reporter():
+    """
+    Start reporting every METRICS_INTERVAL seconds. Every call must be matched by a call
+    to stop_reporter(); the reporter runs until the last one.
+    """
+    global _reporter, _reporter_users
+    with _lock:
+        _reporter_users += 1
+        if _reporter is None:
+            _reporter_stop.clear()
+            _reporter = threading.Thread(target=_run_reporter, args=(_reporter_stop,),
+                                         daemon=True)
+            _reporter.start()
+
+
+def stop_reporter():
+    """
+    Stop the reporter once all its users are done, and write the final report.
+    """
+    global _reporter, _reporter_users
+    with _lock:
+        _reporter_users -= 1
+        if _reporter_users > 0 or _reporter is None:
+            return
+        _reporter_stop.set()
+        _reporter.join()
+        _reporter = None
+    report()
+
+
+@contextmanager
+def reporting():
+    """
+    Report the progress and the metrics while the block runs.
+    """
+    start_reporter()
+    try:
+        yield
+    finally:
+        stop_reporter()
@@ -0,0 +1,153 @@
+# Copyright (C) 2021 TIND.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+Page metadata output. The page metadata of each chunk is written as JSON Lines next to
+its structure file, one line per page:
+
+    {"cdmid": "30", "pageptr": "31", "metadata": {"title": "...", ...}}
+
+A SQLite index maps every pageptr to its shard and offset, so the metadata of a page can
+be looked up without reading the shards.
+"""
+
+import json
+import sqlite3
+import threading
+from pathlib import Path
+
+
+class PageMetadataShard(object):
+    """
+    Context manager writing the page metadata of one chunk. The shard is written to a
+    temporary file which replaces file_path on success. A shard without any page is
+    removed. entries holds (pageptr, offset, length) of every line for the index.
+    """
+
+    def __init__(self, file_path):
+        self.file_path = Path(file_path)
+        self.temp_file_path = Path(str(file_path) + '.part')
+        self.entries = []
+        self._file = None
+
+    def __enter__(self):
+        return self
+
+    def write_page(self, cdmid, pageptr, metadata):
+        if self._file is None:
+            self._file = open(str(self.temp_file_path), 'wb')
+        line = (json.dumps({'cdmid': cdmid,
+                            'pageptr': pageptr,
+                            'metadata': metadata}) + '\n').encode('utf-8')
+        self.entries.append((pageptr, self._file.tell(), len(line)))
+        self._file.write(line)
+
+    def write(self, cdmid, page_metadata):
+        """
+        Write the page metadata of a record, as returned by fetch_record().
+        """
+        for pageptr, metadata in page_metadata.items():
+            self.write_page(cdmid, pageptr, metadata)
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self._file is not None:
+            self._file.close()
+        if exc_type is not None:
+            return False
+        if self._file is not None:
+            self.temp_file_path.replace(self.file_path)
+        elif self.file_path.is_file():
+            self.file_path.unlink()
+        return False
+
+
+def iter_page_metadata_shard(file_path):
+    """
+    Yield (cdmid, pageptr, metadata) for every page of a shard.
+    """
+    with open(str(file_path), 'rb') as f:
+        for line in f:
+            page = json.loads(line)
+            yield page['cdmid'], page['pageptr'], page['metadata']
+
+
+def write_compound_file_metadata_json(shard_paths, file_path):
+    """
+    Combine the shards into the single JSON object {pageptr: metadata} written by
+    earlier versions. The shards are streamed, so memory use stays flat.
+    """
+    temp_file_path = Path(str(file_path) + '.part')
+    with open(str(temp_file_path), 'w') as f:
+        f.write('{')
+        separator = ''
+        for shard_path in shard_paths:
+            for cdmid, pageptr, metadata in iter_page_metadata_shard(shard_path):
+                f.write('{}{}: {}'.format(separator, json.dumps(pageptr), json.dumps(metadata)))
+                separator = ', '
+        f.write('}')
+    temp_file_path.replace(file_path)
+
+
+class PageMetadataIndex(object):
+    """
+    Index of the pageptr of every page to the shard and offset of its metadata. The
+    shards are expected in the folder of the index.
+    """
+
+    def __init__(self, path):
+        self.folder = Path(path).parent
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(path), check_same_thread=False)
+        self._conn.execute('CREATE TABLE IF NOT EXISTS pages ('
+                           'pageptr TEXT PRIMARY KEY, '
+                           'shard TEXT, '
+                           'offset INTEGER, '
+                           'length INTEGER)')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS pages_shard ON pages (shard)')
+        self._conn.commit()
+
+    def add_shard(self, shard_name, entries):
+        """
+        Index the pages of a shard, replacing what was indexed for it before.
+        """
+        with self._lock:
+            self._conn.execute('DELETE FROM pages WHERE shard = ?', (shard_name,))
+            self._conn.executemany('INSERT OR REPLACE INTO pages VALUES (?, ?, ?, ?)',
+                                   [(pageptr, shard_name, offset, length)
+                                    for pageptr, offset, length in entries])
+            self._conn.commit()
+
+    def get(self, pageptr):
+        """
+        Return the metadata of the page, or None if the page is not indexed.
+        """
+        with self._lock:
+            row = self._conn.execute('SELECT shard, offset, length FROM pages '
+                                     'WHERE pageptr = ?', (str(pageptr),)).fetchone()
+        if row is None:
+            return None
+        shard, offset, length = row
+        with open(str(Path(self.folder, shard)), 'rb') as f:
+            f.seek(offset)
+            return json.loads(f.read(length))['metadata']
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
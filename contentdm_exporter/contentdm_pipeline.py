@@ -0,0 +1,157 @@
+# Copyright (C) 2021 TIND.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+This script exports the records and the files of a CONTENTdm collection at the same time.
+The records exported by contentdm_record_exporter.py are handed over to the file
+exporter through a bounded queue, so the files of a record are downloaded while the
+next records are still being exported.
+The settings of both scripts are used.
+"""
+
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+import contentdm_file_exporter
+import contentdm_record_exporter
+from contentdm_metrics import reporting
+
+# Settings
+
+# Number of exported records waiting for their files to be downloaded. The record
+# export pauses when the queue is full.
+QUEUE_SIZE = 100
+
+# Number of files waiting for a download worker.
+MAX_PENDING_DOWNLOADS = 100
+
+
+class PipelineStopped(Exception):
+    """
+    Raised in the record export when the downloads stopped.
+    """
+
+
+def export_records(record_queue, errors, stop):
+    """
+    Export the records and put each of them in the queue with its page index. None marks
+    the end. The export stops once the stop event is set. The error which stopped the
+    export, including the SystemExit of exit(), is added to errors.
+    """
+    def put_record(record, pages):
+        if stop.is_set():
+            raise PipelineStopped()
+        record_queue.put((record, pages))
+
+    try:
+        total_recs, num_chunks = contentdm_record_exporter.run_preliminary_query()
+        contentdm_record_exporter.run_batch(
+            total_recs,
+            num_chunks,
+            contentdm_record_exporter.START_AT,
+            record_callback=put_record)
+    except BaseException as e:
+        errors.append(e)
+    finally:
+        record_queue.put(None)
+
+
+def download_record_files(record_queue):
+    """
+    Download the files of the records coming from the queue until the export is done.
+    The downloads pause while the disk is low, and are left out once the disk space guard
+    gave up.
+    """
+    pending_downloads = threading.BoundedSemaphore(MAX_PENDING_DOWNLOADS)
+    disk_space_guard = contentdm_file_exporter.get_disk_space_guard()
+
+    def download(dmrecord, output_path, filename):
+        try:
+            # The sizes are not known yet, so this only pauses while the disk is low.
+            if not disk_space_guard.acquire(None):
+                return None
+            return contentdm_file_exporter.download_file(dmrecord, output_path, filename)
+        except Exception as e:
+            # e.g. the disk is full. The file is left to the next run.
+            print('File download failed: ', e)
+            contentdm_file_exporter.record_download(dmrecord, Path(output_path, filename), e,
+                                                    0)
+            return e
+        finally:
+            pending_downloads.release()
+
+    # Errors the downloads could not even record, raised once the downloads are done.
+    download_errors = []
+
+    def check_download(future):
+        if future.exception() is not None:
+            download_errors.append(future.exception())
+
+    with ThreadPoolExecutor(
+            max_workers=contentdm_file_exporter.NUM_DOWNLOAD_WORKERS) as executor:
+        while True:
+            item = record_queue.get()
+            if item is None:
+                break
+            record, pages = item
+            for download_args in contentdm_file_exporter.get_record_downloads(record, pages):
+                # Wait for a download slot, which in turn pauses the record export once
+                # the queue is full.
+                pending_downloads.acquire()
+                executor.submit(download, *download_args).add_done_callback(check_download)
+    if download_errors:
+        raise download_errors[0]
+
+
+def run_pipeline():
+    if contentdm_record_exporter.ALIAS != contentdm_file_exporter.ALIAS:
+        print('ALIAS differs between contentdm_record_exporter.py and '
+              'contentdm_file_exporter.py.')
+        exit(1)
+
+    record_queue = queue.Queue(maxsize=QUEUE_SIZE)
+    errors = []
+    stop = threading.Event()
+    producer = threading.Thread(target=export_records, args=(record_queue, errors, stop))
+    with reporting():
+        producer.start()
+        try:
+            download_record_files(record_queue)
+        finally:
+            # If the downloads stopped, e.g. on an error or Ctrl-C, stop the record export
+            # and empty the queue until it is done, as it may be waiting for room in it.
+            stop.set()
+            while producer.is_alive():
+                try:
+                    while True:
+                        record_queue.get_nowait()
+                except queue.Empty:
+                    pass
+                producer.join(0.1)
+    contentdm_file_exporter.close_manifest()
+    contentdm_file_exporter.close_failure_ledger()
+    # The record export stopped, e.g. after MAX_FAILED_RECORDS failures.
+    if errors:
+        raise errors[0]
+
+
+if __name__ == '__main__':
+    run_pipeline()
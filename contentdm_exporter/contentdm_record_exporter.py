@@ -24,13 +24,34 @@ It then loop through the records and query CONTENTdm for record metadata,
 compound object metadata and (optional) bibliographic metadata stored on the file/page-level.
 """
 
+import datetime
 import json
-import requests
 import math
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from defusedxml.lxml import (tostring,
                              fromstring)
 from lxml.builder import E
+from contentdm_client import (ContentdmRequestError,
+                              get_api_content)
+from contentdm_failures import FailureLedger
+from contentdm_journal import ExportJournal
+from contentdm_metrics import (increment,
+                               reporting,
+                               set_total_records,
+                               timer)
+from contentdm_page_metadata import (PageMetadataIndex,
+                                     PageMetadataShard,
+                                     iter_page_metadata_shard,
+                                     write_compound_file_metadata_json)
+from contentdm_record_store import (RecordStore,
+                                    record_to_json,
+                                    write_json_lines_records)
+from contentdm_structure import (Page,
+                                 iter_pages)
+from contentdm_xml import (iter_records_from_file,
+                           write_structure_file)
 
 # Settings
 
@@ -46,12 +67,38 @@ REL_PATH = "/Users/Demo/migration/my_project/"
 # path to the output folder where you'll find the final xml file
 MIG_OUTPUT_FOLDER = REL_PATH + "output/"
 
+# The journal keeps track of the exported records and chunks, so an interrupted export
+# resumes where it stopped. Delete the file to start the export from scratch.
+JOURNAL_FILE = MIG_OUTPUT_FOLDER + "{}_journal.sqlite".format(ALIAS)
+
+# Delta mode only exports the records created or modified since the last run, and patches
+# them into the existing structure files. The date of the last run is kept in
+# DELTA_STATE_FILE, which is written at the end of every complete export.
+DELTA_MODE = False
+DELTA_STATE_FILE = MIG_OUTPUT_FOLDER + "{}_delta_state.json".format(ALIAS)
+
+# Records which can not be exported are added to the failure ledger and left out, so a
+# bad record does not stop the export. The export still stops once MAX_FAILED_RECORDS
+# records failed, as CONTENTdm is then probably down; 0 never stops.
+FAILURES_FILE = MIG_OUTPUT_FOLDER + "{}_failures.sqlite".format(ALIAS)
+MAX_FAILED_RECORDS = 50
+
+# Instead of exporting the collection, export again the records with these pointers, or
+# the records of the failure ledger with REEXPORT_FAILED, and merge them into the
+# existing output. Only these records are requested from CONTENTdm.
+REEXPORT_POINTERS = []
+REEXPORT_FAILED = False
+
 # Set num for progress_bar_chunks
 NUM_PROGRESS_BAR_CHUNKS = 50
 
-#  Don't change CHUNK_SIZE unless CONTENTdm is timing out.
+# Number of records per structure file, and per dmQuery. When CONTENTdm times out, the
+# dmQuery page size is lowered automatically; the structure files keep CHUNK_SIZE records.
 CHUNK_SIZE = 100
 
+# Number of chunks exported at the same time. Their records share the NUM_WORKERS workers.
+NUM_PARALLEL_CHUNKS = 1
+
 # Don't change $start_at unless from 1 you are exporting a range of records. If you
 # want to export a range, use the number of the first record in the range.
 START_AT = 1
@@ -66,11 +113,43 @@ LAST_REC = 0
 # A second approach is to do it in a separate script to avoid slowing down the core export.
 EXPORT_PAGE_METADATA = False
 
-# Other variables used by the script.
-compound_file_metadata = {}  # Export page metadata in a JSON file.
+# The page metadata is written next to each structure file, as
+# {ALIAS}_page_metadata_NNN.jsonl. PAGE_METADATA_INDEX_FILE maps every pageptr to its
+# shard. Set WRITE_COMPOUND_FILE_METADATA_JSON to also combine the shards into the single
+# compound_file_metadata.json file at the end of the export.
+PAGE_METADATA_INDEX_FILE = MIG_OUTPUT_FOLDER + "{}_page_metadata_index.sqlite".format(ALIAS)
+WRITE_COMPOUND_FILE_METADATA_JSON = True
+
+# Compact outputs of the records written along with the structure files, for the tools
+# which read the records back: 'jsonl.gz' writes {ALIAS}_records_NNN.jsonl.gz next to each
+# structure file, to stream them, and 'sqlite' writes RECORD_STORE_FILE, keyed by cdmid,
+# to look them up. Both keep the compound structure and the page metadata. See
+# contentdm_record_store.py.
+RECORD_OUTPUT_FORMATS = []
+RECORD_STORE_FILE = MIG_OUTPUT_FOLDER + "{}_records.sqlite".format(ALIAS)
+
+# Number of records fetched from CONTENTdm at the same time.
+NUM_WORKERS = 8
 
+# Number of pages of a compound object fetched at the same time, when exporting the
+# page metadata.
+NUM_PAGE_WORKERS = 8
 
+# Pool size, timeouts, retries and the request rate are set in contentdm_client.py.
+
+# Other variables used by the script.
 rec_num = 0  # Record counter
+_rec_num_lock = threading.Lock()
+_query_size = CHUNK_SIZE  # Current dmQuery page size, lowered when CONTENTdm times out.
+_query_size_lock = threading.Lock()
+_num_failed_records = 0
+_failure_ledger = None
+_failure_ledger_lock = threading.Lock()
+_record_store = None
+_record_store_lock = threading.Lock()
+
+# Errors which make a record fail, rather than the export.
+FETCH_ERRORS = (ContentdmRequestError, ValueError, SyntaxError)
 
 
 # Create a query map
@@ -93,20 +172,64 @@ query_map = {
     'format': 'json'}
 
 
-def query_contentdm(start_at,
-                    current_chunk=None,
-                    num_chunks=None):
+def configure(alias, rel_path=None):
     """
-    Query CONTENTdm with the values in $query_map and return an array of records.
+    Point the exporter to another collection and local path, updating the settings
+    derived from them. Used when the script is imported instead of edited.
+    """
+    global ALIAS, REL_PATH, MIG_OUTPUT_FOLDER, JOURNAL_FILE, DELTA_STATE_FILE
+    global PAGE_METADATA_INDEX_FILE, FAILURES_FILE, RECORD_STORE_FILE
+    global rec_num, _query_size, _num_failed_records
+
+    ALIAS = alias
+    if rel_path is not None:
+        REL_PATH = rel_path
+    MIG_OUTPUT_FOLDER = REL_PATH + "output/"
+    JOURNAL_FILE = MIG_OUTPUT_FOLDER + "{}_journal.sqlite".format(ALIAS)
+    DELTA_STATE_FILE = MIG_OUTPUT_FOLDER + "{}_delta_state.json".format(ALIAS)
+    PAGE_METADATA_INDEX_FILE = MIG_OUTPUT_FOLDER + "{}_page_metadata_index.sqlite".format(ALIAS)
+    FAILURES_FILE = MIG_OUTPUT_FOLDER + "{}_failures.sqlite".format(ALIAS)
+    RECORD_STORE_FILE = MIG_OUTPUT_FOLDER + "{}_records.sqlite".format(ALIAS)
+    query_map['alias'] = ALIAS
+    rec_num = 0
+    _query_size = CHUNK_SIZE
+    _num_failed_records = 0
+    close_failure_ledger()
+    close_record_store()
+
+
+def get_failure_ledger():
     """
+    Return the failure ledger, opening it on first use.
+    """
+    global _failure_ledger
+    with _failure_ledger_lock:
+        if _failure_ledger is None:
+            Path(FAILURES_FILE).parent.mkdir(parents=True, exist_ok=True)
+            _failure_ledger = FailureLedger(FAILURES_FILE)
+        return _failure_ledger
+
+
+def close_failure_ledger():
+    global _failure_ledger
+    with _failure_ledger_lock:
+        if _failure_ledger is not None:
+            _failure_ledger.close()
+            _failure_ledger = None
+
 
-    query_url = '{main_url}dmQuery/{alias}/{searchstrings}/{fields}/{sortby}/{maxrecs}/{start_at}/{docptr}/{suggest}/{facets}/{format}'.format(
+def get_query_url(start_at, searchstrings=None, maxrecs=None):
+    """
+    Return the dmQuery url with the values in $query_map. searchstrings and maxrecs
+    override the values of $query_map, e.g. to filter on dmmodified.
+    """
+    return '{main_url}dmQuery/{alias}/{searchstrings}/{fields}/{sortby}/{maxrecs}/{start_at}/{docptr}/{suggest}/{facets}/{format}'.format(
         main_url=MAIN_URL,
         alias=query_map['alias'],
-        searchstrings=query_map['searchstrings'],
+        searchstrings=searchstrings or query_map['searchstrings'],
         fields=query_map['fields'],
         sortby=query_map['sortby'],
-        maxrecs=query_map['maxrecs'],
+        maxrecs=maxrecs or query_map['maxrecs'],
         start_at=start_at,
         supress=query_map['supress'],
         docptr=query_map['docptr'],
@@ -114,48 +237,87 @@ def query_contentdm(start_at,
         facets=query_map['facets'],
         format=query_map['format'])
 
+
+def parse_query_results(body):
+    with timer('parse_seconds', kind='query'):
+        return json.loads(body)
+
+
+def query_contentdm(start_at,
+                    current_chunk=None,
+                    num_chunks=None,
+                    searchstrings=None,
+                    use_cache=True,
+                    maxrecs=None,
+                    retries=None):
+    """
+    Query CONTENTdm with the values in $query_map and return an array of records.
+    searchstrings and maxrecs override the values of $query_map, e.g. to filter on
+    dmmodified. retries overrides the number of retries of the client.
+    """
+    query_url = get_query_url(start_at, searchstrings, maxrecs)
+
     # Query CONTENTdm and return records; if failure, log problem.
     try:
-        req = requests.get(query_url)
-        items = json.loads(req.content)
-    except:
+        body = get_api_content(query_url, use_cache=use_cache, retries=retries)
+        items = parse_query_results(body)
+    except (ContentdmRequestError, ValueError) as e:
+        print('Query failed: ', e)
         items = []
-        pass
 
     return items
 
 
-# Perform a preliminary query to determine how many records are in the current collection,
-# and to determine the number of queries required to get all the records.
-prelim_results = query_contentdm(START_AT)
+def run_preliminary_query():
+    """
+    Perform a preliminary query to determine how many records are in the current collection,
+    and to determine the number of queries required to get all the records.
+    Return the total number of records and the number of chunks.
+    """
+    # Only the pager is needed, so keep the query small.
+    return count_records(query_contentdm(START_AT, maxrecs=1))
+
+
+def count_records(prelim_results):
+    """
+    Return the total number of records and the number of chunks from the results of the
+    preliminary query.
+    """
+    if not prelim_results:
+        print('Could not connect to CONTENTdm to count the records.')
+        exit(1)
 
-# We add one chunk, then round down using sprintf().
-print('Total number of records in collection: ', prelim_results['pager']['total'])
-num_chunks = prelim_results['pager']['total'] / CHUNK_SIZE + 1
-num_chunks = math.floor(num_chunks)
+    # We add one chunk, then round down using sprintf().
+    print('Total number of records in collection: ', prelim_results['pager']['total'])
+    num_chunks = prelim_results['pager']['total'] / CHUNK_SIZE + 1
+    num_chunks = math.floor(num_chunks)
 
-# Die if there are no records.
-if not prelim_results['pager']['total']:
-    exit()
+    # Die if there are no records.
+    if not prelim_results['pager']['total']:
+        exit()
 
+    return prelim_results['pager']['total'], num_chunks
 
-def get_compound_object_info(alias, pointer, format='json'):
+
+def get_compound_object_info_url(alias, pointer, format='json'):
     """
-    Gets the item's compound info. "code" contains '-2' if the item is not compound.
     The alias starts with a slash, which is stripped away to keep the query url as
     simple to read as possible.
     """
     if alias.startswith('/'):
         alias = alias[1:]
+    return MAIN_URL + 'dmGetCompoundObjectInfo/' + alias + '/' + pointer + '/' + format
 
+
+def get_compound_object_info(alias, pointer, format='json'):
+    """
+    Gets the item's compound info. "code" contains '-2' if the item is not compound.
+    """
+    body = get_api_content(get_compound_object_info_url(alias, pointer, format))
     if format == 'json':
-        query_url = MAIN_URL + 'dmGetCompoundObjectInfo/' + alias + '/' + pointer + '/json'
-        req = requests.get(query_url)
-        compound_info = json.loads(req.content)
+        compound_info = json.loads(body)
     elif format == 'xml':
-        query_url = MAIN_URL + 'dmGetCompoundObjectInfo/' + alias + '/' + pointer + '/xml'
-        req = requests.get(query_url)
-        compound_info = req.text
+        compound_info = body.decode('utf-8')
     return compound_info
 
 
@@ -163,7 +325,8 @@ def process_compound_object(compound_info):
     """
     Processes each record in the browse results.
     """
-    cpd = fromstring(compound_info.encode('utf-8'))
+    with timer('parse_seconds', kind='compound_object'):
+        cpd = fromstring(compound_info.encode('utf-8'))
 
     has_type = False
     for elem in cpd:
@@ -179,172 +342,881 @@ def process_compound_object(compound_info):
     return ""
 
 
+def get_item_info_url(alias, item_number, format='xml'):
+    if alias.startswith('/'):
+        alias = alias[1:]
+    return MAIN_URL + 'dmGetItemInfo/' + alias + '/' + item_number + '/' + format
+
+
+def strip_xml_declaration(item):
+    string_positon = item.index('?>') + 2
+    return item[string_positon:]
+
+
 def get_item_info(alias, item_number, format='xml'):
     """
     Get the item information. Item can be parent record metadata or file/page metadata.
     """
-    if alias.startswith('/'):
-        alias = alias[1:]
+    body = get_api_content(get_item_info_url(alias, item_number, format))
     if format == 'xml':
-        query_url = MAIN_URL + 'dmGetItemInfo/' + alias + '/' + item_number + '/xml'
-        req = requests.get(query_url)
-        item = req.text
-        string_positon = item.index('?>') + 2
-        item = item[string_positon:]
+        item = strip_xml_declaration(body.decode('utf-8'))
     elif format == 'json':
-        query_url = MAIN_URL + 'dmGetItemInfo/' + alias + '/' + item_number + '/json'
-        req = requests.get(query_url)
-        item = json.loads(req.content)
+        item = json.loads(body)
     return item
 
 
-def add_file_level_information(elem, results_record):
-    global compound_file_metadata
-    file_level_id = None
-    for page_elem in elem:
-        if page_elem.tag == 'pageptr':
-            file_level_id = page_elem.text
+def get_page_metadata(alias, pageptr):
+    """
+    Get the page metadata with a single request. See parse_page_metadata() for the
+    return value.
+    """
+    return parse_page_metadata(get_item_info(alias, pageptr, format='xml'))
+
 
-    # Add file metadata inside the compound object
-    if file_level_id:
-        file_level_info = get_item_info(results_record['collection'],
-                                        file_level_id,
-                                        format='xml')
+def parse_page_metadata(file_level_info):
+    """
+    Return the page metadata as a pagemetadata element (None if empty) and as a dict
+    for the JSON file, both without the empty fields.
+    """
+    with timer('parse_seconds', kind='page'):
         file_level_xml = fromstring(file_level_info)
+
+    pagemetadata = E.pagemetadata()
+    file_level_dict = {}
+    for field in file_level_xml:
+        if field.text:
+            file_level_dict[field.tag] = field.text
         # Strip away fields if no text or no child elements.
-        pagemetadata = E.pagemetadata()
-        for field in file_level_xml:
-            if field.text or len(field) > 0:
-                pagemetadata.append(field)
-        if len(pagemetadata) > 0:
-            # Append the page metadata to the page element.
+        if field.text or len(field) > 0:
+            pagemetadata.append(field)
+
+    if len(pagemetadata) == 0:
+        pagemetadata = None
+    return pagemetadata, file_level_dict
+
+
+def get_page_pointers(page_elems):
+    """
+    Return (page element, pageptr) for every page which has a pageptr.
+    """
+    pages = []
+    for elem in page_elems:
+        file_level_id = elem.findtext('pageptr')
+        if file_level_id:
+            pages.append((elem, file_level_id))
+        else:
+            print('Compound object has no file level ID (pageptr)', tostring(elem))
+    return pages
+
+
+def add_page_metadata(pages, fetched_pages, page_metadata):
+    """
+    Add the page metadata fetched for each of the (page element, pageptr) pages to its
+    element, and to page_metadata with the pageptr as the key.
+    """
+    for (elem, file_level_id), (pagemetadata, file_level_dict) in zip(pages,
+                                                                      fetched_pages):
+        # Add file metadata inside the compound object
+        if pagemetadata is not None:
             elem.append(pagemetadata)
-    else:
-        print('Compound object has no file level ID (pageptr)', tostring(elem))
-
-    # Add the file metadata to a separate file (JSON). Use pageptr as the key
-    if file_level_id:
-        file_level_info_json = get_item_info(results_record['collection'],
-                                             file_level_id,
-                                             format='json')
-        # Strip away empty values
-        updated_file_level_info = {}
-        for key, val in file_level_info_json.items():
-            if val:
-                updated_file_level_info[key] = val
-        if updated_file_level_info:
-            compound_file_metadata[file_level_id] = updated_file_level_info
+        # Add the file metadata to a separate file (JSON). Use pageptr as the key
+        if file_level_dict:
+            page_metadata[file_level_id] = file_level_dict
+
+
+def add_file_level_information(page_elems, results_record, page_metadata):
+    """
+    Add the page metadata to each page element, and to page_metadata with the pageptr as
+    the key. The pages are fetched concurrently.
+    """
+    pages = get_page_pointers(page_elems)
+    with ThreadPoolExecutor(max_workers=NUM_PAGE_WORKERS) as executor:
+        fetched_pages = executor.map(
+            lambda page: get_page_metadata(results_record['collection'], page[1]), pages)
+        # The page elements are only modified from this thread.
+        add_page_metadata(pages, fetched_pages, page_metadata)
+
+
+def get_output_file_name(processed_chunks):
+    return Path(MIG_OUTPUT_FOLDER,
+                '{}_structure_{:03}.xml'.format(ALIAS, processed_chunks))
+
+
+def get_page_metadata_file_name(processed_chunks):
+    return Path(MIG_OUTPUT_FOLDER,
+                '{}_page_metadata_{:03}.jsonl'.format(ALIAS, processed_chunks))
+
+
+def open_page_metadata_index():
+    """
+    Return the page metadata index, or None if the page metadata is not exported.
+    """
+    if not EXPORT_PAGE_METADATA:
+        return None
+    return PageMetadataIndex(PAGE_METADATA_INDEX_FILE)
+
+
+def get_records_file_name(processed_chunks):
+    return Path(MIG_OUTPUT_FOLDER,
+                '{}_records_{:03}.jsonl.gz'.format(ALIAS, processed_chunks))
+
+
+def get_record_store():
+    """
+    Return the SQLite record store, opening it on first use.
+    """
+    global _record_store
+    with _record_store_lock:
+        if _record_store is None:
+            _record_store = RecordStore(RECORD_STORE_FILE)
+        return _record_store
 
-    else:
-        print('Compound object has no file level ID (pageptr)', tostring(elem))
 
+def close_record_store():
+    global _record_store
+    with _record_store_lock:
+        if _record_store is not None:
+            _record_store.close()
+            _record_store = None
+
+
+def write_record_outputs(processed_chunks, records):
+    """
+    Write the records of a chunk, in the order of its structure file, to the compact
+    outputs of RECORD_OUTPUT_FORMATS.
+    """
+    if not RECORD_OUTPUT_FORMATS:
+        return
+    with timer('write_seconds', kind='record_outputs'):
+        records = [record_to_json(record) for record in records]
+        if 'jsonl.gz' in RECORD_OUTPUT_FORMATS:
+            write_json_lines_records(get_records_file_name(processed_chunks), records)
+        if 'sqlite' in RECORD_OUTPUT_FORMATS:
+            get_record_store().write_chunk(processed_chunks, records)
+
+
+def has_record_outputs(processed_chunks):
+    """
+    Return False if a compact output of the chunk is missing, e.g. when
+    RECORD_OUTPUT_FORMATS was changed after the chunk was exported.
+    """
+    if ('jsonl.gz' in RECORD_OUTPUT_FORMATS
+            and not get_records_file_name(processed_chunks).is_file()):
+        return False
+    if 'sqlite' in RECORD_OUTPUT_FORMATS and not get_record_store().has_chunk(processed_chunks):
+        return False
+    return True
+
+
+def save_compound_file_metadata_json():
+    if EXPORT_PAGE_METADATA and WRITE_COMPOUND_FILE_METADATA_JSON:
+        shard_paths = sorted(Path(MIG_OUTPUT_FOLDER).glob(
+            '{}_page_metadata_*.jsonl'.format(ALIAS)))
+        write_compound_file_metadata_json(
+            shard_paths, Path(MIG_OUTPUT_FOLDER, 'compound_file_metadata.json'))
+
+
+def fetch_record(results_record):
+    """
+    Query CONTENTdm for the metadata and compound object information of a record.
+    Return the new xml record object, the page metadata of the record and its page
+    index (see contentdm_structure.py).
+    """
+    page_metadata = {}
+
+    # Get bibliographic record metadata
+    bib_info = get_item_info(results_record['collection'],
+                             str(results_record['pointer']),
+                             format='xml')
+
+    # Get the records compound information.
+    compound_info = get_compound_object_info(results_record['collection'],
+                                             str(results_record['pointer']),
+                                             'xml')
+
+    record, page_elems, pages = build_record(results_record, bib_info, compound_info)
+
+    # Compound objects can contain metadata for each page.
+    # Get the page metadata and store it inside the page object and as
+    # a separate file (JSON). We can consider doing this in a separate
+    # script to save some time exporting the main records.
+    if page_elems and EXPORT_PAGE_METADATA:
+        # Append the page metadata to the page elements.
+        add_file_level_information(page_elems, results_record, page_metadata)
+
+    return record, page_metadata, pages
+
+
+def try_fetch_record(results_record):
+    """
+    Return the result of fetch_record(), or the error if the record could not be
+    exported.
+    """
+    try:
+        return fetch_record(results_record)
+    except FETCH_ERRORS as e:
+        return e
+
+
+def add_failed_record(pointer, chunk, position, error):
+    """
+    Add a record which could not be exported to the failure ledger. Exit once
+    MAX_FAILED_RECORDS records failed.
+    """
+    global _num_failed_records
 
-def save_output_xml_to_file(collection, processed_chunks):
+    print('Record {} failed: {}'.format(pointer, error))
+    get_failure_ledger().add_record(pointer, chunk, position, error)
+    increment('records', status='failed')
+    with _rec_num_lock:
+        _num_failed_records += 1
+        num_failed_records = _num_failed_records
+    if MAX_FAILED_RECORDS and num_failed_records >= MAX_FAILED_RECORDS:
+        print('{} records failed, stopping the export. They are listed in {}'.format(
+            num_failed_records, FAILURES_FILE))
+        exit(1)
+
+
+def fetch_records(results_records):
+    """
+    Fetch the records concurrently. Return the results of fetch_record() for the
+    records which could be exported; the others are added to the failure ledger.
+    """
+    with ThreadPoolExecutor(max_workers=NUM_WORKERS) as executor:
+        return collect_fetched_records(results_records,
+                                       executor.map(try_fetch_record, results_records))
+
+
+def collect_fetched_records(results_records, results):
+    """
+    Return the results of try_fetch_record() for the records which could be exported,
+    in order, and add the others to the failure ledger.
+    """
+    fetched_records = []
+    for results_record, fetched_record in zip(results_records, results):
+        if isinstance(fetched_record, Exception):
+            add_failed_record(str(results_record['pointer']), None, None, fetched_record)
+            continue
+        fetched_records.append(fetched_record)
+        increment('records', status='exported')
+    return fetched_records
+
+
+def build_record(results_record, bib_info, compound_info):
+    """
+    Build the new xml record object from the item info and the compound object info of
+    a record. Return the record, its page elements and its page index.
+    """
+    pages = []
+    page_elems = []
+
+    # Create a new xml record object.
+    record = E.record()
+
+    # Append CONTENTdm record ID to new record object.
+    cdmid = E.cdmid()
+    cdmid.text = str(results_record['pointer'])
+    record.append(cdmid)
+
+    # Append each field to the new record object.
+    with timer('parse_seconds', kind='item_info'):
+        bib_xml = fromstring(bib_info)
+    for field in bib_xml:
+        record.append(field)
+
+    compound_info = process_compound_object(compound_info)
+    if compound_info:
+        with timer('parse_seconds', kind='compound_object'):
+            compound_xml = fromstring(compound_info)
+        compound_xml.tag = 'structure'
+        # Find the pages at any depth, once. The page index is kept for the downloads.
+        for page, path, ordinal in iter_pages(compound_xml):
+            page_elems.append(page)
+            pages.append(Page(page.findtext('pageptr'), page.findtext('pagefile'), path,
+                              ordinal))
+        increment('pages', len(pages))
+        # Append the compound object to the record
+        record.append(compound_xml)
+
+    return record, page_elems, pages
+
+
+def get_query_size(num_records_left):
+    with _query_size_lock:
+        return min(_query_size, num_records_left)
+
+
+def get_query_retries(query_size):
+    return None if query_size == 1 else 1
+
+
+def shrink_query_size(chunk_start, query_size):
+    """
+    Halve the dmQuery page size after a query of query_size records failed. Exit if a
+    single record could not be queried.
+    """
+    global _query_size
+    if query_size == 1:
+        print("Could not connect to CONTENTdm to start retrieving chunk starting at: ",
+              chunk_start)
+        exit(1)
+    with _query_size_lock:
+        _query_size = max(1, min(_query_size, query_size) // 2)
+        print('CONTENTdm is struggling, querying {} records at a time'.format(_query_size))
+
+
+def grow_query_size():
+    global _query_size
+    with _query_size_lock:
+        _query_size = min(CHUNK_SIZE, _query_size + max(1, CHUNK_SIZE // 10))
+
+
+def run_queries(queries):
+    """
+    Run the dmQuery calls of a generator such as iter_chunk_queries(), and return what
+    it returns. The generator yields the arguments of every call to query_contentdm(),
+    and is sent back its results, so that the asyncio exporter can run the same
+    generators.
+    """
+    try:
+        query_args = next(queries)
+        while True:
+            query_args = queries.send(query_contentdm(**query_args))
+    except StopIteration as e:
+        return e.value
+
+
+def iter_chunk_queries(chunk_start, num_records):
+    """
+    Generator of the dmQuery calls of the num_records records of the chunk starting at
+    chunk_start; see run_queries(). Returns the records. The chunk is queried in pages
+    of _query_size records. When CONTENTdm fails to answer, the page size is halved and
+    the same records are queried again; the page size grows back towards CHUNK_SIZE as
+    queries succeed.
+    """
+    records = []
+    while len(records) < num_records:
+        query_size = get_query_size(num_records - len(records))
+        # Only retry at the smallest page size; otherwise it is faster to shrink the page.
+        results = yield {'start_at': chunk_start + len(records),
+                         'maxrecs': query_size,
+                         'retries': get_query_retries(query_size)}
+        if not results:
+            shrink_query_size(chunk_start, query_size)
+            continue
+
+        grow_query_size()
+        records.extend(results['records'])
+        # The end of the collection.
+        if len(results['records']) < query_size:
+            break
+    return records[:num_records]
+
+
+def query_chunk_records(chunk_start, num_records):
+    """
+    Return the num_records records of the chunk starting at chunk_start, see
+    iter_chunk_queries().
+    """
+    return run_queries(iter_chunk_queries(chunk_start, num_records))
+
+
+def skip_exported_chunk(processed_chunks, chunk_start, num_records, journaled_records, journal,
+                        record_callback=None):
+    """
+    Return True if the chunk was already exported with the same start and number of
+    records. Its records are then counted and handed to record_callback from the
+    journal. A chunk exported with other settings, e.g. another LAST_REC, CHUNK_SIZE or
+    START_AT, is resumed from the records of the journal instead.
+    """
+    global rec_num
+
+    if (journal.get_chunk(processed_chunks) != (chunk_start, num_records)
+            or not get_output_file_name(processed_chunks).is_file()):
+        return False
+
+    print('Chunk already exported: ', processed_chunks)
+    if not has_record_outputs(processed_chunks):
+        write_record_outputs(processed_chunks,
+                             iter_records_from_file(get_output_file_name(processed_chunks)))
+    with _rec_num_lock:
+        rec_num += len(journaled_records)
+    increment('records', len(journaled_records), status='skipped')
+    for position in sorted(journaled_records):
+        pointer, xml, page_metadata, pages = journaled_records[position]
+        if record_callback:
+            record_callback(fromstring(xml), pages)
+    return True
+
+
+def get_missing_records(processed_chunks, records, journaled_records):
+    """
+    Return the records of the chunk missing from the journal. The pointer is compared
+    in case the collection changed since the interruption.
+    """
+    missing_records = [
+        results_record for position, results_record in enumerate(records)
+        if journaled_records.get(position, (None,))[0] != str(results_record['pointer'])]
+    if journaled_records:
+        print('Resuming chunk {} with {} records left'.format(processed_chunks,
+                                                              len(missing_records)))
+    return missing_records
+
+
+def write_chunk(processed_chunks, chunk_start, records, journaled_records, fetched_records,
+                journal, page_index, record_callback=None):
+    """
+    Write the records of the chunk to its structure file and page metadata shard, in
+    the order of the query. fetched_records yields the result of try_fetch_record() for
+    every record missing from the journal, in the same order. The records which failed
+    are added to the failure ledger and left out.
+    """
+    global rec_num
+
+    # Each record is written to the structure file, and its page metadata to the
+    # page metadata shard, as soon as it is fetched.
+    shard = PageMetadataShard(get_page_metadata_file_name(processed_chunks))
+    written_records = []
+    with write_structure_file(get_output_file_name(processed_chunks)) as write_record, shard:
+        for position, results_record in enumerate(records):
+            pointer = str(results_record['pointer'])
+            if journaled_records.get(position, (None,))[0] == pointer:
+                pointer, xml, page_metadata, pages = journaled_records[position]
+                with timer('parse_seconds', kind='journal'):
+                    record = fromstring(xml)
+                increment('records', status='skipped')
+            else:
+                fetched_record = next(fetched_records)
+                if isinstance(fetched_record, Exception):
+                    add_failed_record(pointer, processed_chunks, position, fetched_record)
+                    continue
+                record, page_metadata, pages = fetched_record
+                with timer('write_seconds', kind='journal'):
+                    journal.add_record(processed_chunks, position, pointer,
+                                       tostring(record), page_metadata, pages)
+                get_failure_ledger().remove_record(pointer)
+                increment('records', status='exported')
+
+            with _rec_num_lock:
+                rec_num += 1
+                print(rec_num)
+
+            with timer('write_seconds', kind='structure'):
+                write_record(record)
+            with timer('write_seconds', kind='page_metadata'):
+                shard.write(pointer, page_metadata)
+            if RECORD_OUTPUT_FORMATS:
+                written_records.append(record)
+            if record_callback:
+                record_callback(record, pages)
+
+    write_record_outputs(processed_chunks, written_records)
+    if page_index:
+        with timer('write_seconds', kind='page_index'):
+            page_index.add_shard(shard.file_path.name, shard.entries)
+    journal.remove_records(processed_chunks, len(records))
+    journal.mark_chunk_done(processed_chunks, chunk_start, len(records))
+
+
+def export_chunk(processed_chunks, chunk_start, num_records, journal, page_index, executor,
+                 record_callback=None):
+    """
+    Export the records of one chunk to its structure file and page metadata shard,
+    resuming from the journal. The records are fetched by the executor.
+    """
+    # Records exported before an interruption are taken from the journal.
+    journaled_records = journal.get_records(processed_chunks)
+    if skip_exported_chunk(processed_chunks, chunk_start, num_records, journaled_records,
+                           journal, record_callback):
+        return
+
+    print('Start at: ', chunk_start)
+
+    # Query CONTENTdm for all records in a collection for the defined chunk.
+    records = query_chunk_records(chunk_start, num_records)
+    missing_records = get_missing_records(processed_chunks, records, journaled_records)
+
+    # Fetch the records concurrently. map() yields the records in the same order
+    # as the chunk, so the output keeps the order of the CONTENTdm query.
+    fetched_records = executor.map(try_fetch_record, missing_records)
+    write_chunk(processed_chunks, chunk_start, records, journaled_records, fetched_records,
+                journal, page_index, record_callback)
+
+
+def plan_chunks(total_recs, num_chunks, start_at):
+    """
+    Return (processed_chunks, chunk_start, num_records) for every chunk to export, and
+    set the number of records expected for the ETA.
+    """
+    # The number of records of each chunk is known upfront, so the chunks are independent.
+    # Only the chunks needed are exported if we are exporting a subset.
+    if LAST_REC != 0:
+        num_chunks = min(num_chunks, math.ceil(LAST_REC / CHUNK_SIZE))
+    chunks = []
+    for processed_chunks in range(1, num_chunks + 1):
+        chunk_start = start_at + CHUNK_SIZE * (processed_chunks - 1)
+        # The last chunk holds the records left, so that a finished chunk can be told
+        # apart from one exported with other settings, see skip_exported_chunk().
+        num_records = max(0, min(CHUNK_SIZE, total_recs - chunk_start + 1))
+        if LAST_REC != 0:
+            num_records = min(num_records, LAST_REC - CHUNK_SIZE * (processed_chunks - 1))
+        chunks.append((processed_chunks, chunk_start, num_records))
+
+    # The ETA is based on the number of records left to export.
+    total_to_export = total_recs - start_at + 1
+    if LAST_REC != 0:
+        total_to_export = min(total_to_export, LAST_REC)
+    set_total_records(total_to_export)
+    return chunks
+
+
+def run_batch(total_recs, num_chunks, start_at, record_callback=None):
+    """
+    Export the records of the collection, NUM_PARALLEL_CHUNKS chunks at a time.
+    record_callback, if given, is called with every record and its page index once the
+    record is written; within a chunk, in the order of the output. The page index is None
+    for records journaled by earlier versions.
+    """
+    print("Retrieving structural file for the %s collection..." % (ALIAS,))
 
     # Create output folder if it does not exists.
     output_path = Path(MIG_OUTPUT_FOLDER)
     if not output_path.is_dir():
         output_path.mkdir()
 
-    local_file_name = Path(output_path,
-                           '{}_structure_{:03}.xml'.format(ALIAS,
-                                                           processed_chunks))
-    with open(str(local_file_name), 'wb') as xmlfile:
-        xmlfile.write(tostring(collection, pretty_print=True, encoding='utf-8'))
+    chunks = plan_chunks(total_recs, num_chunks, start_at)
 
+    journal = ExportJournal(JOURNAL_FILE)
+    run_date = get_run_date(journal)
+    page_index = open_page_metadata_index()
+    executor = ThreadPoolExecutor(max_workers=NUM_WORKERS)
 
-def run_batch(total_recs, num_chunks, start_at):
-    global rec_num
-    global compound_file_metadata
+    with ThreadPoolExecutor(max_workers=NUM_PARALLEL_CHUNKS) as chunk_executor:
+        futures = [chunk_executor.submit(export_chunk, processed_chunks, chunk_start,
+                                         num_records, journal, page_index, executor,
+                                         record_callback)
+                   for processed_chunks, chunk_start, num_records in chunks]
+        # Stop at the first error, like the export of a single chunk.
+        try:
+            for future in futures:
+                future.result()
+        except BaseException:
+            for future in futures:
+                future.cancel()
+            raise
 
-    print("Retrieving structural file for the %s collection..." % (ALIAS,))
+    executor.shutdown()
+    finish_batch(journal, page_index, run_date, start_at, len(chunks))
 
-    processed_chunks = 1
-    while processed_chunks <= num_chunks:
-        # For each chunk, create a new collection xml object.
-        collection = E.collection()
-        print('Start at: ', start_at)
 
-        # Query CONTENTdm for all records in a collection for the defined chunk.
-        results = query_contentdm(start_at, processed_chunks, num_chunks)
+def get_run_date(journal):
+    """
+    Return the date the export started, saving today for a new export. Records modified
+    since are picked up by the next delta export, even when the export was resumed days
+    later.
+    """
+    run_date = journal.get_export_date()
+    if run_date is None:
+        run_date = datetime.date.today()
+        journal.set_export_date(run_date)
+    return run_date
+
+
+def remove_chunk(journal, page_index, processed_chunks):
+    """
+    Remove a chunk from the output and the journal.
+    """
+    for file_name in (get_output_file_name(processed_chunks),
+                      get_page_metadata_file_name(processed_chunks),
+                      get_records_file_name(processed_chunks)):
+        if file_name.is_file():
+            file_name.unlink()
+    if page_index:
+        page_index.add_shard(get_page_metadata_file_name(processed_chunks).name, [])
+    if 'sqlite' in RECORD_OUTPUT_FORMATS:
+        get_record_store().write_chunk(processed_chunks, [])
+    journal.remove_chunk(processed_chunks)
+
+
+def finish_batch(journal, page_index, run_date, start_at, num_chunks):
+    # The chunks after those of a complete export are left from an earlier export with
+    # another CHUNK_SIZE, or were added by delta exports; their records are in the
+    # chunks just exported.
+    if start_at == 1 and LAST_REC == 0:
+        for processed_chunks in range(num_chunks + 1, journal.get_last_chunk() + 1):
+            print('Removing chunk {}, left from an earlier export'.format(processed_chunks))
+            remove_chunk(journal, page_index, processed_chunks)
+
+    journal.close()
+    if page_index:
+        page_index.close()
+    close_failure_ledger()
+    close_record_store()
+
+    save_compound_file_metadata_json()
+
+    # Only a complete export can be used as the starting point of a delta export.
+    if start_at == 1 and LAST_REC == 0:
+        save_delta_state(run_date)
+
+
+def load_delta_state():
+    """
+    Return the date of the last complete or delta export, or None.
+    """
+    state_file = Path(DELTA_STATE_FILE)
+    if not state_file.is_file():
+        return None
+    with open(str(state_file)) as f:
+        state = json.load(f)
+    return datetime.datetime.strptime(state['last_run'], '%Y%m%d').date()
+
+
+def save_delta_state(run_date):
+    with open(DELTA_STATE_FILE, 'w') as f:
+        f.write(json.dumps({'last_run': run_date.strftime('%Y%m%d')}))
+
+
+def iter_modified_record_queries(since, until):
+    """
+    Generator of the dmQuery calls of the records created or modified between the two
+    dates (inclusive); see run_queries(). Returns the records. CONTENTdm only stores the
+    date of dmmodified, so the records modified on the day of the last run are exported
+    again.
+    """
+    searchstrings = 'dmmodified^{}-{}^all^and'.format(since.strftime('%Y%m%d'),
+                                                      until.strftime('%Y%m%d'))
+    records = []
+    start_at = 1
+    while True:
+        # The changes must come from CONTENTdm, not from the cache.
+        results = yield {'start_at': start_at,
+                         'searchstrings': searchstrings,
+                         'use_cache': False}
         if not results:
-            print("Could not connect to CONTENTdm to start retrieving chunk starting at: ",
+            print("Could not connect to CONTENTdm to query the modified records starting at: ",
                   start_at)
-            exit()
-        start_at = CHUNK_SIZE * processed_chunks + 1
-
-        # Loop through each record in the processed chunk.
-        for results_record in results['records']:
-            rec_num += 1
-            print(rec_num)
-
-            # Create a new xml record object.
-            record = E.record()
-
-            # Append CONTENTdm record ID to new record object.
-            cdmid = E.cdmid()
-            cdmid.text = str(results_record['pointer'])
-            record.append(cdmid)
-
-            # Get bibliographic record metadata
-            bib_info = get_item_info(results_record['collection'],
-                                     str(results_record['pointer']),
-                                     format='xml')
-
-            # Append each field to the new record object.
-            bib_xml = fromstring(bib_info)
-            for field in bib_xml:
-                record.append(field)
-
-            # Get the records compound information.
-            compound_info = get_compound_object_info(results_record['collection'],
-                                                     str(results_record['pointer']),
-                                                     'xml')
-            compound_info = process_compound_object(compound_info)
-            if compound_info:
-                compound_xml = fromstring(compound_info)
-                compound_xml.tag = 'structure'
-                # Compound objects can contain metadata for each page.
-                # Get the page metadata and store it inside the page object and as
-                # a separate file (JSON). We can consider doing this in a separate
-                # script to save some time exporting the main records.
-                if EXPORT_PAGE_METADATA:
-                    # Loop through the compound object and find each page.
-                    # # Append the page metadata to the page element.
-                    for elem in compound_xml:
-                        if elem.tag == 'page':
-                            add_file_level_information(elem, results_record)
-                        if elem.tag == 'node':
-                            for sub_elem in elem:
-                                if sub_elem.tag == 'page':
-                                    add_file_level_information(sub_elem, results_record)
-                                if sub_elem.tag == 'node':
-                                    for sub_sub_elem in sub_elem:
-                                        if sub_sub_elem.tag == 'page':
-                                            add_file_level_information(sub_sub_elem,
-                                                                       results_record)
-                # Append the compound object to the record
-                record.append(compound_xml)
-
-            # Append the record to the collection
-            collection.append(record)
-            if LAST_REC != 0:
-                if rec_num == LAST_REC:
-                    save_output_xml_to_file(collection, processed_chunks)
-
-                    # To get out of the while loop, make
-                    # processed_chunks higher than num_chunks.
-                    processed_chunks = num_chunks + 1
-                    break
-
-        save_output_xml_to_file(collection, processed_chunks)
-
-        processed_chunks += 1
-
-    if EXPORT_PAGE_METADATA:
-        with open(str(Path(MIG_OUTPUT_FOLDER, 'compound_file_metadata.json')), 'w') as f:
-            f.write(json.dumps(compound_file_metadata))
+            exit(1)
+        records.extend(results['records'])
+        start_at += CHUNK_SIZE
+        if not results['records'] or start_at > int(results['pager']['total']):
+            break
+    return records
+
+
+def query_modified_records(since, until):
+    """
+    Return all the records created or modified between the two dates (inclusive), see
+    iter_modified_record_queries().
+    """
+    return run_queries(iter_modified_record_queries(since, until))
+
+
+def merge_records_into_output(fetched_records, journal, page_index=None, positions=None):
+    """
+    Replace the records in the structure files they were exported to, and add the new
+    records to new structure files. The page metadata shards are updated the same way.
+    fetched_records is a list of (record, page_metadata, pages) as returned by
+    fetch_record(). positions maps the pointers of records missing from the journal to
+    their (chunk, position), e.g. for the records which failed in run_batch(); they are
+    inserted in their chunk instead of being added to a new structure file.
+    """
+
+    # Find the chunk of each record.
+    changed_chunks = {}
+    new_records = []
+    for record, page_metadata, pages in fetched_records:
+        pointer = record.findtext('cdmid')
+        found = journal.find_record(pointer) or (positions or {}).get(pointer)
+        if found:
+            chunk, position = found
+            changed_chunks.setdefault(chunk, []).append(
+                (position, record, page_metadata, pages))
+        else:
+            new_records.append((record, page_metadata, pages))
+
+    # Patch the existing structure files, one file at a time. The records are streamed
+    # from the old file to the new one, replacing the records which changed.
+    for chunk, chunk_records in sorted(changed_chunks.items()):
+        print('Updating {} records in chunk {}'.format(len(chunk_records), chunk))
+        journaled_records = journal.get_records(chunk)
+        journaled_positions = {journaled_records[position][0]: position
+                               for position in journaled_records}
+        replacements = {}
+        insertions = []
+        for position, record, page_metadata, pages in chunk_records:
+            if record.findtext('cdmid') in journaled_positions:
+                replacements[record.findtext('cdmid')] = record
+            else:
+                insertions.append((position, record))
+        insertions.sort(key=lambda insertion: insertion[0])
+        changed_pointers = {record.findtext('cdmid')
+                            for position, record, page_metadata, pages in chunk_records}
+        file_name = get_output_file_name(chunk)
+        with write_structure_file(file_name) as write_record:
+            for record in iter_records_from_file(file_name):
+                pointer = record.findtext('cdmid')
+                # Records missing from the chunk are inserted before the records which
+                # follow them in the query.
+                while (insertions
+                       and insertions[0][0] < journaled_positions.get(pointer, -1)):
+                    write_record(insertions.pop(0)[1])
+                write_record(replacements.pop(pointer, record))
+            # Records missing from the file are added at the end.
+            for position, record in insertions:
+                write_record(record)
+            for record in replacements.values():
+                write_record(record)
+        write_record_outputs(chunk, iter_records_from_file(file_name))
+
+        # Keep the pages of the other records and replace those of the changed ones.
+        shard_file_name = get_page_metadata_file_name(chunk)
+        with PageMetadataShard(shard_file_name) as shard:
+            if shard_file_name.is_file():
+                for cdmid, pageptr, metadata in iter_page_metadata_shard(shard_file_name):
+                    if cdmid not in changed_pointers:
+                        shard.write_page(cdmid, pageptr, metadata)
+            for position, record, page_metadata, pages in chunk_records:
+                shard.write(record.findtext('cdmid'), page_metadata)
+        if page_index:
+            page_index.add_shard(shard.file_path.name, shard.entries)
+
+        for position, record, page_metadata, pages in chunk_records:
+            journal.add_record(chunk, position, record.findtext('cdmid'),
+                               tostring(record), page_metadata, pages)
+            get_failure_ledger().remove_record(record.findtext('cdmid'))
+
+    # Add the new records to new structure files.
+    chunk = journal.get_last_chunk()
+    for i in range(0, len(new_records), CHUNK_SIZE):
+        chunk += 1
+        chunk_records = new_records[i:i + CHUNK_SIZE]
+        print('Adding {} new records in chunk {}'.format(len(chunk_records), chunk))
+        shard = PageMetadataShard(get_page_metadata_file_name(chunk))
+        with write_structure_file(get_output_file_name(chunk)) as write_record, shard:
+            for position, (record, page_metadata, pages) in enumerate(chunk_records):
+                write_record(record)
+                shard.write(record.findtext('cdmid'), page_metadata)
+                journal.add_record(chunk, position, record.findtext('cdmid'),
+                                   tostring(record), page_metadata, pages)
+                get_failure_ledger().remove_record(record.findtext('cdmid'))
+        write_record_outputs(chunk, [record for record, page_metadata, pages in chunk_records])
+        if page_index:
+            page_index.add_shard(shard.file_path.name, shard.entries)
+        journal.mark_chunk_done(chunk, None, len(chunk_records))
+
+
+def run_delta():
+    """
+    Export the records created or modified since the last run and patch them into the
+    existing output.
+    """
+    since, run_date = start_delta()
+    records = query_modified_records(since, run_date)
+    count_modified_records(records)
+    save_delta(fetch_records(records), run_date)
+
+
+def start_delta():
+    """
+    Return the date of the last export and the date of the delta export. Exit if the
+    collection was never exported.
+    """
+    since = load_delta_state()
+    if since is None:
+        print('No previous export found for the %s collection. Run a complete export first.'
+              % (ALIAS,))
+        exit(1)
+    print('Retrieving the records of the %s collection modified since %s...' % (ALIAS, since))
+    return since, datetime.date.today()
+
+
+def count_modified_records(records):
+    print('Number of records modified: ', len(records))
+    set_total_records(len(records))
+
+
+def save_delta(fetched_records, run_date):
+    """
+    Patch the records fetched by a delta export into the output.
+    """
+    journal = ExportJournal(JOURNAL_FILE)
+    page_index = open_page_metadata_index()
+    merge_records_into_output(fetched_records, journal, page_index)
+    journal.set_export_date(run_date)
+    journal.close()
+    if page_index:
+        page_index.close()
+    close_failure_ledger()
+    close_record_store()
+
+    save_compound_file_metadata_json()
+
+    save_delta_state(run_date)
+
+
+def get_failure_positions(journal, failures):
+    """
+    Return the (chunk, position) of the failed records which can be inserted back into
+    their structure file, by pointer, and the pointers of the failed records whose chunk
+    is not finished; the next run of run_batch() exports them.
+    """
+    positions = {}
+    unfinished = set()
+    for failure in failures:
+        if failure.chunk is None or journal.find_record(failure.pointer):
+            continue
+        if not journal.is_chunk_done(failure.chunk):
+            unfinished.add(failure.pointer)
+        # The collection may have changed since, and another record taken the position.
+        elif journal.get_pointer(failure.chunk, failure.position) is None:
+            positions[failure.pointer] = (failure.chunk, failure.position)
+    return positions, unfinished
+
+
+def run_reexport(pointers=None):
+    """
+    Export again the records with the pointers, or the records of the failure ledger if
+    pointers is None, and merge them into the existing output. Only these records are
+    requested from CONTENTdm.
+    """
+    failures = get_failure_ledger().get_records()
+    journal = ExportJournal(JOURNAL_FILE)
+    positions, unfinished = get_failure_positions(journal, failures)
+
+    if pointers is None:
+        pointers = [failure.pointer for failure in failures]
+    pointers = [str(pointer) for pointer in pointers]
+    for pointer in pointers:
+        if pointer in unfinished:
+            print('Record {} is left to the export of its chunk, which is not finished'.format(
+                pointer))
+    pointers = [pointer for pointer in pointers if pointer not in unfinished]
+
+    print('Exporting {} records of the {} collection again'.format(len(pointers), ALIAS))
+    set_total_records(len(pointers))
+    fetched_records = fetch_records([{'collection': ALIAS, 'pointer': pointer}
+                                     for pointer in pointers])
+
+    page_index = open_page_metadata_index()
+    merge_records_into_output(fetched_records, journal, page_index, positions)
+    journal.close()
+    if page_index:
+        page_index.close()
+    close_failure_ledger()
+    close_record_store()
+
+    save_compound_file_metadata_json()
 
 
 if __name__ == '__main__':
-    run_batch(prelim_results['pager']['total'], num_chunks, START_AT)
+    if REEXPORT_POINTERS or REEXPORT_FAILED:
+        with reporting():
+            run_reexport(REEXPORT_POINTERS or None)
+    else:
+        total_recs, num_chunks = run_preliminary_query()
+        with reporting():
+            if DELTA_MODE:
+                run_delta()
+            else:
+                run_batch(total_recs, num_chunks, START_AT)
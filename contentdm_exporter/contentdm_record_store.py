@@ -0,0 +1,211 @@
+# Copyright (C) 2021 TIND.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+Compact output of the records, for the tools which read them back without parsing the
+structure files. Every record is converted to JSON, keeping its compound structure and
+the metadata of its pages:
+
+    {"cdmid": "30",
+     "metadata": {"title": "...", "subjec": "", "dmrecord": "30", "find": "30.cpd"},
+     "structure": {"type": "Document", "children": [
+         {"page": {"pagetitle": "p31", "pagefile": "31.jp2", "pageptr": "31",
+                   "pagemetadata": {"title": "...", ...}}},
+         {"node": {"nodetitle": "a", "children": [{"page": {...}}, ...]}}]}}
+
+The pages and nodes of a structure or node are kept in order in its "children" list.
+The records are written either as gzip-compressed JSON Lines next to each structure file,
+to stream them, or to a SQLite database keyed by cdmid, to look them up.
+"""
+
+import gzip
+import json
+import sqlite3
+import threading
+from pathlib import Path
+
+# Elements whose pages and nodes go to the "children" list.
+CONTAINER_TAGS = ('structure', 'node')
+
+
+def element_to_json(elem):
+    """
+    Return the text of an element without children, or a dict of its children. The tree
+    is walked with an explicit stack, so there is no depth limit.
+    """
+    if len(elem) == 0:
+        return elem.text or ''
+    root = {}
+    stack = [(elem, root)]
+    while stack:
+        elem, result = stack.pop()
+        for child in elem:
+            if len(child):
+                value = {}
+                stack.append((child, value))
+            else:
+                value = child.text or ''
+            if elem.tag in CONTAINER_TAGS and child.tag in ('page', 'node'):
+                result.setdefault('children', []).append({child.tag: value})
+            else:
+                result[child.tag] = value
+    return root
+
+
+def record_to_json(record):
+    """
+    Return the JSON of a record element of a structure file.
+    """
+    metadata = element_to_json(record)
+    cdmid = metadata.pop('cdmid')
+    structure = metadata.pop('structure', None)
+    return {'cdmid': cdmid, 'metadata': metadata, 'structure': structure}
+
+
+def iter_structure_pages(structure):
+    """
+    Yield (page, path, ordinal) for every page of the structure of a record in JSON, like
+    contentdm_structure.iter_pages().
+    """
+    ordinal = 0
+    stack = [(iter((structure or {}).get('children', ())), ())]
+    while stack:
+        children, path = stack[-1]
+        for child in children:
+            if 'page' in child:
+                ordinal += 1
+                yield child['page'] or {}, path, ordinal
+            elif isinstance(child['node'], dict):
+                node = child['node']
+                stack.append((iter(node.get('children', ())),
+                              path + (node.get('nodetitle', ''),)))
+                break
+        else:
+            stack.pop()
+
+
+def write_json_lines_records(file_path, records):
+    """
+    Write the records, in JSON, to a gzip-compressed JSON Lines file, one line per
+    record. The file is written to a temporary file which replaces file_path.
+    """
+    temp_file_path = Path(str(file_path) + '.part')
+    # Level 6 is much faster than the default of 9, for almost the same size.
+    with gzip.open(str(temp_file_path), 'wt', encoding='utf-8', compresslevel=6) as f:
+        for record in records:
+            f.write(json.dumps(record, ensure_ascii=False, separators=(',', ':')) + '\n')
+    temp_file_path.replace(file_path)
+
+
+def iter_json_lines_records(file_path):
+    """
+    Yield the records, in JSON, of a gzip-compressed JSON Lines file.
+    """
+    with gzip.open(str(file_path), 'rt', encoding='utf-8') as f:
+        for line in f:
+            yield json.loads(line)
+
+
+class RecordStore(object):
+    """
+    SQLite store of the records in JSON, keyed by cdmid, with the chunk and position of
+    every record in the structure files. The pages table maps every pageptr to its record.
+    """
+
+    def __init__(self, path):
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(path), check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS records ('
+                           'cdmid TEXT PRIMARY KEY, '
+                           'chunk INTEGER, '
+                           'position INTEGER, '
+                           'record TEXT)')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS records_chunk '
+                           'ON records (chunk, position)')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS pages ('
+                           'pageptr TEXT PRIMARY KEY, '
+                           'cdmid TEXT, '
+                           'ordinal INTEGER)')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS pages_cdmid ON pages (cdmid)')
+        self._conn.commit()
+
+    def write_chunk(self, chunk, records):
+        """
+        Replace the records of a chunk with the records, in JSON, in the order of its
+        structure file.
+        """
+        rows = []
+        page_rows = []
+        for position, record in enumerate(records):
+            rows.append((record['cdmid'], chunk, position,
+                         json.dumps(record, ensure_ascii=False, separators=(',', ':'))))
+            for page, path, ordinal in iter_structure_pages(record['structure']):
+                page_rows.append((page.get('pageptr'), record['cdmid'], ordinal))
+        with self._lock:
+            self._conn.execute('DELETE FROM pages WHERE cdmid IN '
+                               '(SELECT cdmid FROM records WHERE chunk = ?)', (chunk,))
+            self._conn.execute('DELETE FROM records WHERE chunk = ?', (chunk,))
+            # A record moved from another chunk is replaced.
+            self._conn.executemany('DELETE FROM pages WHERE cdmid = ?',
+                                   [row[:1] for row in rows])
+            self._conn.executemany('INSERT OR REPLACE INTO records VALUES (?, ?, ?, ?)', rows)
+            self._conn.executemany('INSERT OR REPLACE INTO pages VALUES (?, ?, ?)', page_rows)
+            self._conn.commit()
+
+    def has_chunk(self, chunk):
+        with self._lock:
+            return self._conn.execute('SELECT 1 FROM records WHERE chunk = ? LIMIT 1',
+                                      (chunk,)).fetchone() is not None
+
+    def get(self, cdmid):
+        """
+        Return the record, in JSON, or None if it is not in the store.
+        """
+        with self._lock:
+            row = self._conn.execute('SELECT record FROM records WHERE cdmid = ?',
+                                     (str(cdmid),)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def find_page(self, pageptr):
+        """
+        Return (cdmid, ordinal) of the record the page belongs to, or None.
+        """
+        with self._lock:
+            return self._conn.execute('SELECT cdmid, ordinal FROM pages WHERE pageptr = ?',
+                                      (str(pageptr),)).fetchone()
+
+    def iter_records(self):
+        """
+        Yield all the records, in JSON, in the order of the structure files.
+        """
+        with self._lock:
+            cursor = self._conn.execute('SELECT record FROM records ORDER BY chunk, position')
+            rows = cursor.fetchmany(1000)
+        while rows:
+            for row in rows:
+                yield json.loads(row[0])
+            with self._lock:
+                rows = cursor.fetchmany(1000)
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,71 @@
+# Copyright (C) 2021 TIND.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+"""
+Traversal of the structure of compound objects. A structure holds pages and nodes, and
+nodes hold pages and other nodes, at any depth:
+
+    <structure><page>...</page><node><nodetitle>...</nodetitle><page>...</page>
+    <node>...</node></node></structure>
+"""
+
+from collections import namedtuple
+
+# A page of a compound object. path holds the titles of the nodes the page is in, and
+# ordinal the position of the page in the whole object, from 1.
+Page = namedtuple('Page', ['pageptr', 'pagefile', 'path', 'ordinal'])
+
+
+def iter_pages(structure):
+    """
+    Yield (page element, path, ordinal) for every page of the structure, in document
+    order. The tree is walked with an explicit stack, so there is no depth limit.
+    """
+    ordinal = 0
+    stack = [(iter(structure), ())]
+    while stack:
+        children, path = stack[-1]
+        for elem in children:
+            if elem.tag == 'page':
+                ordinal += 1
+                yield elem, path, ordinal
+            elif elem.tag == 'node':
+                # Walk the node before the rest of its parent.
+                stack.append((iter(elem), path + (elem.findtext('nodetitle') or '',)))
+                break
+        else:
+            stack.pop()
+
+
+def get_page_index(structure):
+    """
+    Return the flat list of the Pages of the structure.
+    """
+    return [Page(page.findtext('pageptr'), page.findtext('pagefile'), path, ordinal)
+            for page, path, ordinal in iter_pages(structure)]
+
+
+def load_page_index(pages):
+    """
+    Return the Pages of a page index loaded from JSON, where they are lists.
+    """
+    return [Page(pageptr, pagefile, tuple(path), ordinal)
+            for pageptr, pagefile, path, ordinal in pages]
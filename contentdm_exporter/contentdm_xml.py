@@ -0,0 +1,79 @@
+# Copyright (C) 2021 TIND.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+Streaming reader and writer for the structure files (<collection><record>...</record>
+...</collection>). Records are written and read one at a time, so the memory use does
+not depend on the number of records in a file.
+"""
+
+from contextlib import contextmanager
+from pathlib import Path
+from lxml.etree import (indent,
+                        iterparse,
+                        xmlfile)
+
+
+@contextmanager
+def write_structure_file(file_path):
+    """
+    Open a structure file for writing and yield a function writing one record to it.
+    The records are written to a temporary file, which replaces file_path once the
+    collection is closed. The output is the same as the pretty-printed collection.
+    """
+    temp_file_path = Path(str(file_path) + '.part')
+    with open(str(temp_file_path), 'wb') as f:
+        with xmlfile(f, encoding='utf-8') as xf:
+            with xf.element('collection'):
+
+                def write_record(record):
+                    indent(record, space='  ', level=1)
+                    record.tail = None
+                    xf.write('\n  ')
+                    xf.write(record)
+
+                yield write_record
+                xf.write('\n')
+        f.write(b'\n')
+    temp_file_path.replace(file_path)
+
+
+def iter_records_from_file(file_path):
+    """
+    Yield the records of a structure file one at a time. A record is cleared as soon as
+    the next one is read, so copy what you need to keep.
+    """
+    depth = 0
+    # The structure files are our own output, but stay away from entities and DTDs.
+    for event, elem in iterparse(str(file_path),
+                                 events=('start', 'end'),
+                                 resolve_entities=False,
+                                 no_network=True,
+                                 load_dtd=False):
+        if event == 'start':
+            depth += 1
+            continue
+        depth -= 1
+        # Only the children of <collection> are records.
+        if depth == 1:
+            yield elem
+            elem.clear(keep_tail=True)
+            while elem.getprevious() is not None:
+                del elem.getparent()[0]
@@ -0,0 +1,167 @@
+# Copyright (C) 2021 TIND.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+"""
+Tests of the on-disk cache of the API responses: contentdm_cache.py, and its use by
+get_api_content() in contentdm_client.py.
+"""
+
+import shutil
+import sys
+import tempfile
+import threading
+import unittest
+from pathlib import Path
+from unittest import mock
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT / 'contentdm_exporter'))
+sys.path.insert(0, str(ROOT / 'benchmarks'))
+
+import contentdm_client
+from contentdm_cache import ResponseCache
+from contentdm_client import (CacheMissError,
+                              get_api_content)
+from mock_contentdm_server import MockContentdmServer
+
+
+class Clock(object):
+    """
+    Replaces time.time(), moving on by a second at every call.
+    """
+
+    def __init__(self):
+        self.now = 1000000
+
+    def __call__(self):
+        self.now += 1
+        return self.now
+
+
+class ResponseCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.path = Path(self.folder, 'cache.sqlite')
+        self.clock = Clock()
+        self.time = mock.patch('contentdm_cache.time.time', self.clock)
+        self.time.start()
+
+    def tearDown(self):
+        self.time.stop()
+        shutil.rmtree(self.folder)
+
+    def test_get_and_put(self):
+        cache = ResponseCache(self.path, 0, 0)
+        self.assertIsNone(cache.get('a'))
+        cache.put('a', b'first')
+        cache.put('a', b'second')
+        self.assertEqual(cache.get('a'), b'second')
+        cache.close()
+
+        # The cache is kept on disk.
+        cache = ResponseCache(self.path, 0, 0)
+        self.assertEqual(cache.get('a'), b'second')
+        self.assertEqual(cache._size, len(b'second'))
+        cache.close()
+
+    def test_ttl(self):
+        cache = ResponseCache(self.path, 0, 100)
+        cache.put('a', b'body')
+        self.assertEqual(cache.get('a'), b'body')
+        self.clock.now += 100
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache._size, 0)
+        cache.close()
+
+    def test_lru_eviction(self):
+        cache = ResponseCache(self.path, 30, 0)
+        for key in ('a', 'b', 'c'):
+            cache.put(key, b'0123456789')
+        # a is used again, so b is the least recently used entry.
+        cache.get('a')
+        cache.put('d', b'0123456789')
+        self.assertIsNone(cache.get('b'))
+        for key in ('a', 'c', 'd'):
+            self.assertEqual(cache.get(key), b'0123456789')
+        self.assertEqual(cache._size, 30)
+        cache.close()
+
+
+class GetApiContentTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = MockContentdmServer(('127.0.0.1', 0), num_records=10, latency=0)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.settings = mock.patch.multiple(contentdm_client,
+                                            MAX_REQUESTS_PER_SECOND=0,
+                                            MAX_RETRIES=0,
+                                            CACHE_FILE=str(Path(self.folder, 'cache.sqlite')),
+                                            CACHE_ONLY=False)
+        self.settings.start()
+        contentdm_client.reset()
+        self.url = self.server.main_url + 'dmGetItemInfo/test/{}/xml'
+
+    def tearDown(self):
+        contentdm_client.get_cache().close()
+        self.settings.stop()
+        contentdm_client.reset()
+        shutil.rmtree(self.folder)
+
+    def get_num_requests(self):
+        return self.server.stats['requests'].get('dmGetItemInfo', 0)
+
+    def test_responses_are_cached(self):
+        num_requests = self.get_num_requests()
+        body = get_api_content(self.url.format(8))
+        self.assertEqual(get_api_content(self.url.format(8)), body)
+        self.assertEqual(self.get_num_requests(), num_requests + 1)
+
+        # Calls which must be fresh skip the cache.
+        self.assertEqual(get_api_content(self.url.format(8), use_cache=False), body)
+        self.assertEqual(self.get_num_requests(), num_requests + 2)
+
+    def test_errors_are_not_cached(self):
+        url = self.server.main_url + 'dmUnknown/test'
+        get_api_content(url)
+        self.assertIsNone(contentdm_client.get_cache().get(contentdm_client.get_cache_key(url)))
+
+    def test_cache_only(self):
+        body = get_api_content(self.url.format(8))
+        num_requests = self.get_num_requests()
+        contentdm_client.CACHE_ONLY = True
+        self.assertEqual(get_api_content(self.url.format(8)), body)
+        with self.assertRaises(CacheMissError):
+            get_api_content(self.url.format(16))
+        self.assertEqual(self.get_num_requests(), num_requests)
+
+
+if __name__ == '__main__':
+    unittest.main()
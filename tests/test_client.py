@@ -0,0 +1,207 @@
+# Copyright (C) 2021 TIND.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+"""
+Tests of the retries, backoff and rate governor of contentdm_client.py, against a local
+server which answers with the statuses it is given.
+"""
+
+import sys
+import threading
+import unittest
+from http.server import (BaseHTTPRequestHandler,
+                         ThreadingHTTPServer)
+from pathlib import Path
+from unittest import mock
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'contentdm_exporter'))
+
+import contentdm_client
+from contentdm_client import (BandwidthLimiter,
+                              ContentdmRequestError,
+                              RateLimiter,
+                              backoff_delay)
+
+
+class ScriptedHandler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        # The last response is repeated once the script is done.
+        with self.server.lock:
+            self.server.num_requests += 1
+            if len(self.server.responses) > 1:
+                status, headers = self.server.responses.pop(0)
+            else:
+                status, headers = self.server.responses[0]
+        body = 'HTTP {}'.format(status).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class ScriptedServer(ThreadingHTTPServer):
+
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), ScriptedHandler)
+        self.lock = threading.Lock()
+        self.responses = [(200, {})]
+        self.num_requests = 0
+
+    @property
+    def url(self):
+        return 'http://{}:{}/dmwebservices/index.php?q=dmGetItemInfo/test/1/xml'.format(
+            *self.server_address)
+
+
+class RequestTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = ScriptedServer()
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        self.server.num_requests = 0
+        self.settings = mock.patch.multiple(contentdm_client,
+                                            MAX_RETRIES=3,
+                                            MAX_REQUESTS_PER_SECOND=10,
+                                            MIN_REQUESTS_PER_SECOND=1,
+                                            CACHE_FILE=None)
+        self.settings.start()
+        contentdm_client.reset()
+        # Record the waits instead of sleeping.
+        self.sleep = mock.patch('contentdm_client.time.sleep')
+        self.sleeps = self.sleep.start()
+
+    def tearDown(self):
+        self.sleep.stop()
+        self.settings.stop()
+        contentdm_client.reset()
+
+    def test_retries_until_success(self):
+        self.server.responses = [(503, {}), (502, {}), (200, {})]
+        response = contentdm_client.get(self.server.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.server.num_requests, 3)
+
+    def test_gives_up_after_max_retries(self):
+        self.server.responses = [(500, {})]
+        with self.assertRaises(ContentdmRequestError):
+            contentdm_client.get(self.server.url)
+        self.assertEqual(self.server.num_requests, 4)
+
+        self.server.num_requests = 0
+        with self.assertRaises(ContentdmRequestError):
+            contentdm_client.get(self.server.url, retries=0)
+        self.assertEqual(self.server.num_requests, 1)
+
+    def test_other_errors_are_returned(self):
+        self.server.responses = [(404, {})]
+        response = contentdm_client.get(self.server.url)
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(self.server.num_requests, 1)
+
+    def test_connection_errors_are_retried(self):
+        url = 'http://127.0.0.1:1/dmwebservices/index.php?q=dmQuery'
+        with mock.patch('contentdm_client.backoff_delay', return_value=0) as delay, \
+                self.assertRaises(ContentdmRequestError):
+            contentdm_client.get(url)
+        self.assertEqual(delay.call_count, 3)
+
+    def test_throttling(self):
+        self.server.responses = [(429, {'Retry-After': '7'}), (429, {}), (200, {})]
+        rate_limiter = contentdm_client.get_rate_limiter()
+        contentdm_client.get(self.server.url)
+        # The rate is halved on each 429, then goes up again on the success.
+        self.assertAlmostEqual(rate_limiter.rate,
+                               10 / 4 + contentdm_client.RATE_INCREASE_STEP)
+        # The server's Retry-After is used for the first retry.
+        self.assertIn(mock.call(7.0), self.sleeps.call_args_list)
+
+    def test_get_api_content(self):
+        self.server.responses = [(503, {}), (200, {})]
+        self.assertEqual(contentdm_client.get_api_content(self.server.url), b'HTTP 200')
+
+
+class BackoffTest(unittest.TestCase):
+
+    def test_exponential_backoff(self):
+        with mock.patch.multiple(contentdm_client, BACKOFF_BASE=1, BACKOFF_MAX=60):
+            for attempt in range(10):
+                delay = backoff_delay(attempt)
+                self.assertGreaterEqual(delay, 0)
+                self.assertLessEqual(delay, min(60, 2 ** attempt))
+
+    def test_retry_after(self):
+        with mock.patch.multiple(contentdm_client, BACKOFF_BASE=1, BACKOFF_MAX=60):
+            self.assertEqual(backoff_delay(0, '30'), 30)
+            self.assertEqual(backoff_delay(0, '3600'), 60)
+            # An HTTP date is not supported; the backoff is used instead.
+            self.assertLessEqual(backoff_delay(0, 'Wed, 21 Oct 2015 07:28:00 GMT'), 1)
+
+
+class RateLimiterTest(unittest.TestCase):
+
+    def test_spacing(self):
+        rate_limiter = RateLimiter(10, 1)
+        waits = [rate_limiter.reserve() for i in range(5)]
+        self.assertLessEqual(waits[0], 0)
+        for i in range(1, 5):
+            self.assertAlmostEqual(waits[i], i / 10, delta=0.05)
+
+    def test_throttled_and_succeeded(self):
+        rate_limiter = RateLimiter(10, 1)
+        for i in range(10):
+            rate_limiter.throttled()
+        self.assertEqual(rate_limiter.rate, 1)
+        for i in range(1000):
+            rate_limiter.succeeded()
+        self.assertEqual(rate_limiter.rate, 10)
+
+    def test_disabled(self):
+        rate_limiter = RateLimiter(0, 1)
+        self.assertEqual([rate_limiter.reserve() for i in range(5)], [0] * 5)
+
+    def test_bandwidth_limiter(self):
+        bandwidth_limiter = BandwidthLimiter(1000)
+        self.assertLessEqual(bandwidth_limiter.reserve(500), 0)
+        self.assertAlmostEqual(bandwidth_limiter.reserve(500), 0.5, delta=0.05)
+        self.assertAlmostEqual(bandwidth_limiter.reserve(500), 1, delta=0.05)
+        self.assertEqual(BandwidthLimiter(0).reserve(500), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
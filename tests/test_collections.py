@@ -0,0 +1,110 @@
+# Copyright (C) 2021 TIND.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+"""
+Tests of the export of several collections in contentdm_collections.py, against the local
+stand-in server of benchmarks/mock_contentdm_server.py.
+"""
+
+import contextlib
+import io
+import shutil
+import sys
+import tempfile
+import threading
+import unittest
+from pathlib import Path
+from unittest import mock
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT / 'contentdm_exporter'))
+sys.path.insert(0, str(ROOT / 'benchmarks'))
+
+import contentdm_client
+import contentdm_collections
+import contentdm_record_exporter
+from mock_contentdm_server import MockContentdmServer
+
+
+class CollectionsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp() + '/'
+        self.settings = mock.patch.multiple(contentdm_client,
+                                            MAX_REQUESTS_PER_SECOND=0,
+                                            MAX_RETRIES=0,
+                                            CACHE_FILE=None)
+        self.settings.start()
+        contentdm_client.reset()
+        self.main_url = contentdm_record_exporter.MAIN_URL
+
+    def tearDown(self):
+        contentdm_record_exporter.MAIN_URL = self.main_url
+        contentdm_record_exporter.configure('test', self.folder)
+        self.settings.stop()
+        contentdm_client.reset()
+        shutil.rmtree(self.folder)
+
+    def export_collection(self, num_records):
+        """
+        Export the records of a collection of num_records records, and return the result
+        of export_collection().
+        """
+        server = MockContentdmServer(('127.0.0.1', 0), num_records=num_records, latency=0)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        contentdm_record_exporter.MAIN_URL = server.main_url
+        try:
+            with contextlib.redirect_stdout(io.StringIO()):
+                return contentdm_collections.export_collection('test', self.folder, False)
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def test_export_collection(self):
+        self.assertIsNone(self.export_collection(5))
+        self.assertEqual(len(list(Path(self.folder, 'output').glob('*.xml'))), 1)
+
+    def test_empty_collection(self):
+        self.assertIsNone(self.export_collection(0))
+
+    def test_unreachable_server(self):
+        contentdm_record_exporter.MAIN_URL = 'http://127.0.0.1:1/dmwebservices/index.php?q='
+        with contextlib.redirect_stdout(io.StringIO()):
+            result = contentdm_collections.export_collection('test', self.folder, False)
+        self.assertEqual(result, 'export stopped (exit status 1)')
+
+    def test_share_server_capacity(self):
+        with mock.patch.multiple(contentdm_client,
+                                 MAX_REQUESTS_PER_SECOND=40,
+                                 MIN_REQUESTS_PER_SECOND=2,
+                                 MAX_REQUESTS_PER_HOST=8,
+                                 MAX_DOWNLOAD_BYTES_PER_SECOND=1000):
+            contentdm_collections.share_server_capacity(4)
+            self.assertEqual(contentdm_client.MAX_REQUESTS_PER_SECOND, 10)
+            self.assertEqual(contentdm_client.MIN_REQUESTS_PER_SECOND, 0.5)
+            self.assertEqual(contentdm_client.MAX_REQUESTS_PER_HOST, 2)
+            self.assertEqual(contentdm_client.MAX_DOWNLOAD_BYTES_PER_SECOND, 250)
+            # The limiters are created again with the shared values.
+            self.assertEqual(contentdm_client.get_rate_limiter().max_rate, 10)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,382 @@
+# Copyright (C) 2021 TIND.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+"""
+Tests of the exporters against the local stand-in server of
+benchmarks/mock_contentdm_server.py. The outputs are compared with those of a clean
+export. Run them with `python -m unittest discover tests`.
+"""
+
+import asyncio
+import contextlib
+import datetime
+import io
+import shutil
+import sys
+import tempfile
+import threading
+import unittest
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT / 'contentdm_exporter'))
+sys.path.insert(0, str(ROOT / 'benchmarks'))
+
+import contentdm_async_client
+import contentdm_async_exporter
+import contentdm_client
+import contentdm_file_exporter
+import contentdm_record_exporter
+from contentdm_client import ContentdmRequestError
+from contentdm_journal import ExportJournal
+from contentdm_record_store import (RecordStore,
+                                    iter_json_lines_records,
+                                    record_to_json)
+from contentdm_xml import iter_records_from_file
+from mock_contentdm_server import MockContentdmServer
+
+ALIAS = 'test'
+NUM_RECORDS = 45
+CHUNK_SIZE = 20
+# Number of structure files of a complete export.
+NUM_CHUNKS = 3
+
+# Settings of contentdm_client.py used during the tests: no rate governor and no waiting
+# between the retries.
+CLIENT_SETTINGS = {
+    'MAX_REQUESTS_PER_SECOND': 0,
+    'MAX_RETRIES': 0,
+    'BACKOFF_BASE': 0,
+    'BACKOFF_MAX': 0,
+    'CACHE_FILE': None,
+}
+
+
+class Interrupted(Exception):
+    pass
+
+
+class ExporterTestCase(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = MockContentdmServer(('127.0.0.1', 0),
+                                         num_records=NUM_RECORDS,
+                                         latency=0,
+                                         file_sizes=(4096,))
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        for name, value in CLIENT_SETTINGS.items():
+            setattr(contentdm_client, name, value)
+        contentdm_client.reset()
+
+        cls.reference_folder = tempfile.mkdtemp()
+        cls.configure(cls.reference_folder + '/')
+        cls.export()
+        cls.reference = cls.get_output(cls.reference_folder + '/')
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+        shutil.rmtree(cls.reference_folder)
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp() + '/'
+        self.configure(self.folder)
+
+    def tearDown(self):
+        contentdm_record_exporter.configure(ALIAS, self.folder)
+        contentdm_file_exporter.configure(ALIAS, self.folder)
+        shutil.rmtree(self.folder)
+
+    @classmethod
+    def configure(cls, folder):
+        contentdm_record_exporter.MAIN_URL = cls.server.main_url
+        contentdm_record_exporter.CHUNK_SIZE = CHUNK_SIZE
+        contentdm_record_exporter.query_map['maxrecs'] = CHUNK_SIZE
+        contentdm_record_exporter.EXPORT_PAGE_METADATA = True
+        contentdm_record_exporter.WRITE_COMPOUND_FILE_METADATA_JSON = False
+        contentdm_record_exporter.LAST_REC = 0
+        contentdm_record_exporter.RECORD_OUTPUT_FORMATS = []
+        contentdm_record_exporter.configure(ALIAS, folder)
+        Path(contentdm_record_exporter.MIG_OUTPUT_FOLDER).mkdir(parents=True, exist_ok=True)
+        contentdm_file_exporter.FILE_URL = cls.server.file_url
+        contentdm_file_exporter.MIN_FREE_DISK_SPACE = 0
+        contentdm_file_exporter.configure(ALIAS, folder)
+
+    @staticmethod
+    def export(record_callback=None):
+        with contextlib.redirect_stdout(io.StringIO()):
+            total_recs, num_chunks = contentdm_record_exporter.run_preliminary_query()
+            contentdm_record_exporter.run_batch(total_recs, num_chunks, 1, record_callback)
+
+    @staticmethod
+    def get_output(folder):
+        """
+        Return the content of the structure files and page metadata shards, by file name.
+        """
+        return {file_path.name: file_path.read_bytes()
+                for pattern in ('*.xml', '*.jsonl')
+                for file_path in Path(folder, 'output').glob(pattern)}
+
+    def assertSameAsReference(self):
+        output = self.get_output(self.folder)
+        self.assertEqual(sorted(output), sorted(self.reference))
+        for file_name in self.reference:
+            self.assertEqual(output[file_name], self.reference[file_name], file_name)
+
+
+    def check_delta_export(self, run_delta):
+        """
+        Run a delta export with run_delta() after a complete export, with a record
+        modified and a record added on the server, and check the output.
+        """
+        self.export()
+        last_run = datetime.date(2021, 6, 1)
+        contentdm_record_exporter.save_delta_state(last_run)
+
+        # Record 3 is modified and record NUM_RECORDS + 1 is new since the last run.
+        modified_pointer = 3 * self.server.stride
+        new_pointer = (NUM_RECORDS + 1) * self.server.stride
+        build_record = contentdm_record_exporter.build_record
+        get_query_url = contentdm_record_exporter.get_query_url
+        queries = []
+
+        def modify_record(results_record, bib_info, compound_info):
+            if int(results_record['pointer']) == modified_pointer:
+                bib_info = bib_info.replace('Record 3<', 'Record 3, modified<')
+            return build_record(results_record, bib_info, compound_info)
+
+        def record_query(start_at, searchstrings=None, maxrecs=None):
+            queries.append(searchstrings)
+            return get_query_url(start_at, searchstrings, maxrecs)
+
+        self.configure(self.folder)
+        self.server.num_records = NUM_RECORDS + 1
+        contentdm_record_exporter.build_record = modify_record
+        contentdm_record_exporter.get_query_url = record_query
+        try:
+            with contextlib.redirect_stdout(io.StringIO()):
+                run_delta()
+        finally:
+            self.server.num_records = NUM_RECORDS
+            contentdm_record_exporter.build_record = build_record
+            contentdm_record_exporter.get_query_url = get_query_url
+
+        today = datetime.date.today()
+        self.assertEqual(queries[0], 'dmmodified^20210601-{}^all^and'.format(
+            today.strftime('%Y%m%d')))
+        self.assertEqual(contentdm_record_exporter.load_delta_state(), today)
+
+        # The modified record is patched in place, and the new record added to a new
+        # structure file.
+        output = self.get_output(self.folder)
+        modified_file = contentdm_record_exporter.get_output_file_name(1).name
+        new_file = contentdm_record_exporter.get_output_file_name(NUM_CHUNKS + 1).name
+        self.assertEqual(output.pop(modified_file),
+                         self.reference[modified_file].replace(b'Record 3<',
+                                                               b'Record 3, modified<'))
+        self.assertIn('<cdmid>{}</cdmid>'.format(new_pointer).encode(), output.pop(new_file))
+        for file_name in self.reference:
+            if file_name != modified_file:
+                self.assertEqual(output.pop(file_name), self.reference[file_name], file_name)
+        self.assertEqual(output, {})
+
+
+class RecordExporterTest(ExporterTestCase):
+
+    def test_resume_after_interruption(self):
+        exported = []
+
+        def interrupt(record, pages):
+            exported.append(record)
+            if len(exported) == CHUNK_SIZE + 5:
+                raise Interrupted()
+
+        with self.assertRaises(Interrupted):
+            self.export(interrupt)
+        self.configure(self.folder)
+        self.export()
+        self.assertSameAsReference()
+
+    def test_last_rec_then_complete_export(self):
+        contentdm_record_exporter.LAST_REC = CHUNK_SIZE + 5
+        self.export()
+        self.assertFalse(Path(contentdm_record_exporter.DELTA_STATE_FILE).is_file())
+
+        self.configure(self.folder)
+        self.export()
+        self.assertSameAsReference()
+
+    def test_reexport_failed_record(self):
+        failed_pointer = str(7 * self.server.stride)
+        get_item_info = contentdm_record_exporter.get_item_info
+
+        def fail_record(alias, item_number, format='xml'):
+            if item_number == failed_pointer:
+                raise ContentdmRequestError('Record {} is not available'.format(item_number))
+            return get_item_info(alias, item_number, format)
+
+        contentdm_record_exporter.get_item_info = fail_record
+        try:
+            self.export()
+        finally:
+            contentdm_record_exporter.get_item_info = get_item_info
+        failures = contentdm_record_exporter.get_failure_ledger().get_records()
+        self.assertEqual([failure.pointer for failure in failures], [failed_pointer])
+        self.assertNotEqual(self.get_output(self.folder), self.reference)
+
+        self.configure(self.folder)
+        with contextlib.redirect_stdout(io.StringIO()):
+            contentdm_record_exporter.run_reexport()
+        self.assertEqual(contentdm_record_exporter.get_failure_ledger().get_records(), [])
+        self.assertSameAsReference()
+
+    def test_resumed_export_keeps_its_start_date(self):
+        start_date = datetime.date(2021, 1, 1)
+        contentdm_record_exporter.LAST_REC = CHUNK_SIZE
+        self.export()
+        journal = ExportJournal(contentdm_record_exporter.JOURNAL_FILE)
+        journal.set_export_date(start_date)
+        journal.close()
+
+        self.configure(self.folder)
+        self.export()
+        self.assertEqual(contentdm_record_exporter.load_delta_state(), start_date)
+
+    def test_delta_export(self):
+        self.check_delta_export(contentdm_record_exporter.run_delta)
+
+    def test_record_outputs(self):
+        contentdm_record_exporter.LAST_REC = CHUNK_SIZE + 5
+        self.export()
+        # The outputs of the chunks exported without them are added when resuming.
+        self.configure(self.folder)
+        contentdm_record_exporter.RECORD_OUTPUT_FORMATS = ['jsonl.gz', 'sqlite']
+        self.export()
+        self.assertSameAsReference()
+
+        records = []
+        for chunk in range(1, NUM_CHUNKS + 1):
+            chunk_records = [record_to_json(record) for record in iter_records_from_file(
+                contentdm_record_exporter.get_output_file_name(chunk))]
+            self.assertEqual(list(iter_json_lines_records(
+                contentdm_record_exporter.get_records_file_name(chunk))), chunk_records)
+            records.extend(chunk_records)
+        self.assertEqual(len(records), NUM_RECORDS)
+        store = RecordStore(contentdm_record_exporter.RECORD_STORE_FILE)
+        self.assertEqual(list(store.iter_records()), records)
+        store.close()
+
+
+@unittest.skipIf(contentdm_async_client.aiohttp is None, 'requires aiohttp')
+class AsyncExporterTest(ExporterTestCase):
+
+    def setUp(self):
+        super().setUp()
+        contentdm_async_exporter.EXPORT_RECORDS = True
+        contentdm_async_exporter.EXPORT_FILES = False
+
+    def tearDown(self):
+        contentdm_record_exporter.DELTA_MODE = False
+        super().tearDown()
+
+    def export_async(self):
+        with contextlib.redirect_stdout(io.StringIO()):
+            asyncio.run(contentdm_async_exporter.run_export())
+
+    def test_export(self):
+        self.export_async()
+        self.assertSameAsReference()
+
+    def test_last_rec_then_complete_export(self):
+        contentdm_record_exporter.LAST_REC = CHUNK_SIZE + 5
+        self.export_async()
+        self.configure(self.folder)
+        self.export_async()
+        self.assertSameAsReference()
+
+    def test_delta_export(self):
+        def run_delta():
+            contentdm_record_exporter.DELTA_MODE = True
+            asyncio.run(contentdm_async_exporter.run_export())
+
+        self.check_delta_export(run_delta)
+
+
+class FileExporterTest(ExporterTestCase):
+
+    def setUp(self):
+        super().setUp()
+        with contextlib.redirect_stdout(io.StringIO()):
+            shutil.copytree(self.reference_folder + '/output', self.folder + 'output',
+                            dirs_exist_ok=True)
+            contentdm_file_exporter.run_file_export()
+        # The files of a record are downloaded to a folder named after its pointer.
+        self.pointer = str(1 * self.server.stride)
+        self.file_path = next(Path(contentdm_file_exporter.MIG_OUTPUT_FOLDER).glob(
+            '*/{:06d}/*'.format(int(self.pointer))))
+        self.content = self.file_path.read_bytes()
+
+    def redownload(self):
+        with contextlib.redirect_stdout(io.StringIO()):
+            return contentdm_file_exporter.retry_failed_downloads([self.pointer])
+
+    def test_redownload_replaces_file(self):
+        self.file_path.write_bytes(b'corrupt')
+        self.redownload()
+        self.assertEqual(self.file_path.read_bytes(), self.content)
+
+    def test_failed_redownload_keeps_file(self):
+        contentdm_file_exporter.FILE_URL = 'http://127.0.0.1:1/utils/getfile/collection/'
+        results = self.redownload()
+        self.assertNotIn(True, results)
+        self.assertEqual(self.file_path.read_bytes(), self.content)
+
+    def test_resume_with_unexpected_range(self):
+        temp_file_name = Path(str(self.file_path) + '.part')
+        temp_file_name.write_bytes(self.content[:100])
+        contentdm_file_exporter.save_partial_download(
+            temp_file_name, {'expected_size': len(self.content), 'etag': None,
+                             'last_modified': None, 'bytes_written': 100})
+        get = contentdm_file_exporter.get
+
+        def shift_range(url, headers=None, **kwargs):
+            # The server answers with another range than the one asked for.
+            if headers and 'Range' in headers:
+                headers = dict(headers, Range='bytes=200-')
+            return get(url, headers=headers, **kwargs)
+
+        contentdm_file_exporter.get = shift_range
+        try:
+            with contextlib.redirect_stdout(io.StringIO()):
+                result = contentdm_file_exporter.download_file(
+                    self.pointer, self.file_path.parent, self.file_path.name,
+                    redownload=True)
+        finally:
+            contentdm_file_exporter.get = get
+        self.assertIs(result, True)
+        self.assertEqual(self.file_path.read_bytes(), self.content)
+        self.assertFalse(temp_file_name.is_file())
+
+
+if __name__ == '__main__':
+    unittest.main()
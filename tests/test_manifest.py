@@ -0,0 +1,161 @@
+# Copyright (C) 2021 TIND.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+"""
+Tests of the download manifest of the file exporter: the deduplication of the files and
+the verification of the downloads, against the local stand-in server of
+benchmarks/mock_contentdm_server.py.
+"""
+
+import contextlib
+import io
+import shutil
+import sys
+import tempfile
+import threading
+import unittest
+from pathlib import Path
+from unittest import mock
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT / 'contentdm_exporter'))
+sys.path.insert(0, str(ROOT / 'benchmarks'))
+
+import contentdm_client
+import contentdm_file_exporter
+from mock_contentdm_server import MockContentdmServer
+
+# The files of the even pointers are shorter than the header of the synthetic files, so
+# they all have the same content. The files of the odd pointers are all different.
+FILE_SIZES = (10, 4096)
+
+
+class ManifestTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = MockContentdmServer(('127.0.0.1', 0), num_records=10, latency=0,
+                                         file_sizes=FILE_SIZES, compound_ratio=0)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        cls.settings = mock.patch.multiple(contentdm_client,
+                                           MAX_REQUESTS_PER_SECOND=0,
+                                           MAX_RETRIES=0,
+                                           CACHE_FILE=None)
+        cls.settings.start()
+        contentdm_client.reset()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.settings.stop()
+        contentdm_client.reset()
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp() + '/'
+        contentdm_file_exporter.FILE_URL = self.server.file_url
+        contentdm_file_exporter.MIN_FREE_DISK_SPACE = 0
+        contentdm_file_exporter.DEDUPLICATE = True
+        contentdm_file_exporter.VERIFY_CHECKSUMS = False
+        contentdm_file_exporter.configure('test', self.folder)
+        self.output_path = Path(contentdm_file_exporter.MIG_OUTPUT_FOLDER, 'test')
+        self.output_path.mkdir(parents=True)
+
+    def tearDown(self):
+        contentdm_file_exporter.DEDUPLICATE = True
+        contentdm_file_exporter.VERIFY_CHECKSUMS = False
+        contentdm_file_exporter.configure('test', self.folder)
+        shutil.rmtree(self.folder)
+
+    def download(self, pointer, filename):
+        """
+        Download the file of the record number to filename, and return the result.
+        """
+        with contextlib.redirect_stdout(io.StringIO()):
+            return contentdm_file_exporter.download_file(
+                str(pointer * self.server.stride), self.output_path, filename)
+
+    def get_num_downloads(self):
+        return self.server.stats['requests'].get('getfile', 0)
+
+    def get_inode(self, filename):
+        return Path(self.output_path, filename).stat().st_ino
+
+    def test_deduplicate_by_pointer(self):
+        num_downloads = self.get_num_downloads()
+        self.assertIs(self.download(1, 'a.jp2'), True)
+        self.assertIs(self.download(1, 'b.jp2'), True)
+        self.assertEqual(self.get_num_downloads(), num_downloads + 1)
+        self.assertEqual(self.get_inode('a.jp2'), self.get_inode('b.jp2'))
+        entries = contentdm_file_exporter.get_manifest().get_entries()
+        self.assertEqual([entry.path for entry in entries], ['test/a.jp2', 'test/b.jp2'])
+        self.assertEqual(entries[0]._replace(path=None), entries[1]._replace(path=None))
+
+    def test_deduplicate_by_checksum(self):
+        num_downloads = self.get_num_downloads()
+        self.assertIs(self.download(2, 'a.jp2'), True)
+        self.assertIs(self.download(4, 'b.jp2'), True)
+        self.assertEqual(self.get_num_downloads(), num_downloads + 2)
+        self.assertEqual(self.get_inode('a.jp2'), self.get_inode('b.jp2'))
+
+        # Different files are not linked.
+        self.download(3, 'c.jp2')
+        self.assertNotEqual(self.get_inode('a.jp2'), self.get_inode('c.jp2'))
+
+    def test_no_deduplication(self):
+        contentdm_file_exporter.DEDUPLICATE = False
+        self.download(2, 'a.jp2')
+        self.download(4, 'b.jp2')
+        self.download(2, 'c.jp2')
+        self.assertEqual(len({self.get_inode(filename)
+                              for filename in ('a.jp2', 'b.jp2', 'c.jp2')}), 3)
+
+    def test_skip_downloaded_file(self):
+        self.download(1, 'a.jp2')
+        self.assertEqual(self.download(1, 'a.jp2'), 'local')
+
+        # A file whose size differs from the manifest is downloaded again.
+        content = Path(self.output_path, 'a.jp2').read_bytes()
+        Path(self.output_path, 'a.jp2').write_bytes(content[:100])
+        self.assertIs(self.download(1, 'a.jp2'), True)
+        self.assertEqual(Path(self.output_path, 'a.jp2').read_bytes(), content)
+
+    def test_verify_downloads(self):
+        for n, filename in ((1, 'a.jp2'), (3, 'b.jp2'), (5, 'c.jp2')):
+            self.download(n, filename)
+        contents = {filename: Path(self.output_path, filename).read_bytes()
+                    for filename in ('a.jp2', 'b.jp2', 'c.jp2')}
+        Path(self.output_path, 'a.jp2').unlink()
+        Path(self.output_path, 'b.jp2').write_bytes(b'truncated')
+        # Same size, another content: only found by the checksums.
+        Path(self.output_path, 'c.jp2').write_bytes(contents['b.jp2'])
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.assertEqual(contentdm_file_exporter.verify_downloads(), [True, True])
+            self.assertEqual(Path(self.output_path, 'c.jp2').read_bytes(), contents['b.jp2'])
+            contentdm_file_exporter.VERIFY_CHECKSUMS = True
+            self.assertEqual(contentdm_file_exporter.verify_downloads(), [True])
+        for filename, content in contents.items():
+            self.assertEqual(Path(self.output_path, filename).read_bytes(), content)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,152 @@
+# Copyright (C) 2021 TIND.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+"""
+Tests of the compact outputs of the records in contentdm_record_store.py.
+"""
+
+import shutil
+import sys
+import tempfile
+import unittest
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'contentdm_exporter'))
+
+from contentdm_record_store import (RecordStore,
+                                    element_to_json,
+                                    iter_json_lines_records,
+                                    iter_structure_pages,
+                                    record_to_json,
+                                    write_json_lines_records)
+from contentdm_structure import iter_pages
+from lxml import etree
+
+RECORD = '''<record><cdmid>10</cdmid><title>Record 10</title><rights/>
+<structure><type>Document</type>
+<page><pagetitle>Cover</pagetitle><pagefile>11.jp2</pagefile><pageptr>11</pageptr>
+  <pagemetadata><title>Cover page</title><format/></pagemetadata></page>
+<node><nodetitle>Part 1</nodetitle>
+  <node><nodetitle>Chapter 1</nodetitle>
+    <page><pagetitle>Page 1</pagetitle><pagefile>12.jp2</pagefile><pageptr>12</pageptr></page>
+  </node>
+  <page><pagetitle>Page 2</pagetitle><pagefile>13.jp2</pagefile><pageptr>13</pageptr></page>
+</node>
+</structure></record>'''
+
+RECORD_JSON = {
+    'cdmid': '10',
+    'metadata': {'title': 'Record 10', 'rights': ''},
+    'structure': {'type': 'Document', 'children': [
+        {'page': {'pagetitle': 'Cover', 'pagefile': '11.jp2', 'pageptr': '11',
+                  'pagemetadata': {'title': 'Cover page', 'format': ''}}},
+        {'node': {'nodetitle': 'Part 1', 'children': [
+            {'node': {'nodetitle': 'Chapter 1', 'children': [
+                {'page': {'pagetitle': 'Page 1', 'pagefile': '12.jp2', 'pageptr': '12'}}]}},
+            {'page': {'pagetitle': 'Page 2', 'pagefile': '13.jp2', 'pageptr': '13'}}]}}]},
+}
+
+
+def make_record(cdmid, pageptrs=()):
+    """
+    Return the JSON of a record with a page for each pageptr.
+    """
+    structure = None
+    if pageptrs:
+        structure = {'type': 'Document',
+                     'children': [{'page': {'pageptr': pageptr}} for pageptr in pageptrs]}
+    return {'cdmid': cdmid, 'metadata': {'title': 'Record ' + cdmid}, 'structure': structure}
+
+
+class RecordToJsonTest(unittest.TestCase):
+
+    def setUp(self):
+        self.record = etree.fromstring(RECORD, etree.XMLParser(remove_blank_text=True))
+
+    def test_record_to_json(self):
+        self.assertEqual(record_to_json(self.record), RECORD_JSON)
+
+    def test_record_without_structure(self):
+        record = etree.fromstring('<record><cdmid>1</cdmid><title>A</title></record>')
+        self.assertEqual(record_to_json(record),
+                         {'cdmid': '1', 'metadata': {'title': 'A'}, 'structure': None})
+
+    def test_element_to_json(self):
+        self.assertEqual(element_to_json(etree.fromstring('<title>A</title>')), 'A')
+        self.assertEqual(element_to_json(etree.fromstring('<title/>')), '')
+
+    def test_iter_structure_pages(self):
+        pages = [(page['pageptr'], path, ordinal)
+                 for page, path, ordinal in iter_structure_pages(RECORD_JSON['structure'])]
+        self.assertEqual(pages, [(page.findtext('pageptr'), path, ordinal)
+                                 for page, path, ordinal in iter_pages(
+                                     self.record.find('structure'))])
+        self.assertEqual(list(iter_structure_pages(None)), [])
+
+
+class OutputTest(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_json_lines(self):
+        file_path = Path(self.folder, 'records.jsonl.gz')
+        records = [RECORD_JSON, make_record('20'), make_record('é')]
+        write_json_lines_records(file_path, records)
+        self.assertEqual(list(iter_json_lines_records(file_path)), records)
+        self.assertFalse(Path(self.folder, 'records.jsonl.gz.part').exists())
+
+    def test_record_store(self):
+        store = RecordStore(Path(self.folder, 'records.sqlite'))
+        store.write_chunk(1, [RECORD_JSON, make_record('20', ['21', '22'])])
+        store.write_chunk(2, [make_record('30')])
+        self.assertEqual(store.get(10), RECORD_JSON)
+        self.assertIsNone(store.get(11))
+        self.assertEqual(store.find_page('12'), ('10', 2))
+        self.assertEqual(store.find_page(22), ('20', 2))
+        self.assertTrue(store.has_chunk(2))
+        self.assertFalse(store.has_chunk(3))
+
+        # A chunk written again replaces its records and their pages.
+        store.write_chunk(1, [make_record('20', ['23']), RECORD_JSON])
+        self.assertIsNone(store.find_page('21'))
+        self.assertEqual(store.find_page('23'), ('20', 1))
+        store.close()
+
+        store = RecordStore(Path(self.folder, 'records.sqlite'))
+        self.assertEqual([record['cdmid'] for record in store.iter_records()],
+                         ['20', '10', '30'])
+        # A record moved to another chunk leaves the chunk it was in.
+        store.write_chunk(3, [make_record('30', ['31'])])
+        self.assertEqual([record['cdmid'] for record in store.iter_records()],
+                         ['20', '10', '30'])
+        self.assertFalse(store.has_chunk(2))
+        self.assertEqual(store.find_page('31'), ('30', 1))
+        store.write_chunk(3, [])
+        self.assertIsNone(store.get('30'))
+        store.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
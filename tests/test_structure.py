@@ -0,0 +1,143 @@
+# Copyright (C) 2021 TIND.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+"""
+Tests of the walk of compound objects in contentdm_structure.py, and of its use by the
+record and file exporters.
+"""
+
+import shutil
+import sys
+import tempfile
+import unittest
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'contentdm_exporter'))
+
+import contentdm_file_exporter
+import contentdm_record_exporter
+from contentdm_structure import (Page,
+                                 get_page_index,
+                                 iter_pages,
+                                 load_page_index)
+from lxml import etree
+
+# A compound object with pages at the top, and nodes three levels deep.
+COMPOUND_OBJECT = '''<?xml version="1.0" encoding="UTF-8"?>
+<cpd><type>Document</type>
+<page><pagetitle>Cover</pagetitle><pagefile>11.jp2</pagefile><pageptr>11</pageptr></page>
+<node><nodetitle>Part 1</nodetitle>
+  <page><pagetitle>Page 1</pagetitle><pagefile>12.jp2</pagefile><pageptr>12</pageptr></page>
+  <node><nodetitle>Chapter 1</nodetitle>
+    <node><nodetitle>Section 1</nodetitle>
+      <page><pagetitle>Page 2</pagetitle><pagefile>13.tif</pagefile><pageptr>13</pageptr></page>
+      <page><pagetitle>Page 3</pagetitle><pagefile>14.tif</pagefile><pageptr>14</pageptr></page>
+    </node>
+  </node>
+  <page><pagetitle>Page 4</pagetitle><pagefile>15.jp2</pagefile><pageptr>15</pageptr></page>
+</node>
+<page><pagetitle>Back</pagetitle><pagefile>16.jp2</pagefile><pageptr>16</pageptr></page>
+</cpd>'''
+
+ITEM_INFO = '<xml><title>Record 10</title><dmrecord>10</dmrecord><find>10.cpd</find></xml>'
+
+PAGES = [
+    Page('11', '11.jp2', (), 1),
+    Page('12', '12.jp2', ('Part 1',), 2),
+    Page('13', '13.tif', ('Part 1', 'Chapter 1', 'Section 1'), 3),
+    Page('14', '14.tif', ('Part 1', 'Chapter 1', 'Section 1'), 4),
+    Page('15', '15.jp2', ('Part 1',), 5),
+    Page('16', '16.jp2', (), 6),
+]
+
+
+class StructureTest(unittest.TestCase):
+
+    def setUp(self):
+        self.structure = etree.fromstring(COMPOUND_OBJECT.encode('utf-8'))
+
+    def test_iter_pages(self):
+        pages = [(page.findtext('pageptr'), path, ordinal)
+                 for page, path, ordinal in iter_pages(self.structure)]
+        self.assertEqual(pages, [(page.pageptr, page.path, page.ordinal) for page in PAGES])
+
+    def test_get_page_index(self):
+        self.assertEqual(get_page_index(self.structure), PAGES)
+
+    def test_load_page_index(self):
+        pages = [[page.pageptr, page.pagefile, list(page.path), page.ordinal]
+                 for page in PAGES]
+        self.assertEqual(load_page_index(pages), PAGES)
+
+    def test_empty_nodes(self):
+        structure = etree.fromstring('<cpd><node><nodetitle>Empty</nodetitle></node>'
+                                     '<node><node/></node></cpd>')
+        self.assertEqual(get_page_index(structure), [])
+
+    def test_build_record(self):
+        record, page_elems, pages = contentdm_record_exporter.build_record(
+            {'pointer': 10}, ITEM_INFO, COMPOUND_OBJECT)
+        self.assertEqual(pages, PAGES)
+        self.assertEqual([page.findtext('pagetitle') for page in page_elems],
+                         ['Cover', 'Page 1', 'Page 2', 'Page 3', 'Page 4', 'Back'])
+        self.assertEqual(record.findtext('cdmid'), '10')
+        self.assertEqual(len(record.find('structure').findall('.//page')), 6)
+
+
+class RecordDownloadsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp() + '/'
+        contentdm_file_exporter.configure('test', self.folder)
+        self.record, page_elems, pages = contentdm_record_exporter.build_record(
+            {'pointer': 10}, ITEM_INFO, COMPOUND_OBJECT)
+
+    def tearDown(self):
+        contentdm_file_exporter.configure('test', self.folder)
+        shutil.rmtree(self.folder)
+
+    def test_downloads_from_structure(self):
+        output_path = Path(contentdm_file_exporter.MIG_OUTPUT_FOLDER, 'test', '000010')
+        expected = [(page.pageptr, output_path,
+                     '000010_{:06}{}'.format(page.ordinal, Path(page.pagefile).suffix))
+                    for page in PAGES]
+        self.assertEqual(contentdm_file_exporter.get_record_downloads(self.record), expected)
+        self.assertEqual(contentdm_file_exporter.get_record_downloads(self.record, PAGES),
+                         expected)
+        self.assertTrue(output_path.is_dir())
+
+    def test_get_page_info(self):
+        page = etree.fromstring('<page><pagetitle>Page 2</pagetitle><pagefile>13.tif'
+                                '</pagefile><pageptr>13</pageptr></page>')
+        self.assertEqual(contentdm_file_exporter.get_page_info(page),
+                         (False, '13', Path('13.tif')))
+        page.find('pagefile').text = '13.pdfpage'
+        self.assertEqual(contentdm_file_exporter.get_page_info(page), (True, '13', None))
+
+    def test_pdf_download(self):
+        pages = [page._replace(pagefile=page.pageptr + '.pdfpage') for page in PAGES]
+        output_path = Path(contentdm_file_exporter.MIG_OUTPUT_FOLDER, 'test', '000010')
+        self.assertEqual(contentdm_file_exporter.get_record_downloads(self.record, pages),
+                         [('10', output_path, '000010_000001.pdf')])
+
+
+if __name__ == '__main__':
+    unittest.main()